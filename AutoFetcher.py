@@ -1,38 +1,113 @@
 from settings import config
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 import os
-import random
-from utils import unzipFile
+import json
+import threading
+from urllib.parse import urljoin
+from email.utils import formatdate
+from io import BytesIO
+from zipfile import ZipFile
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils import unzipFile, RequestedChunkingType
 import warnings
 # idea:
 # These pages are maintained quite consistently. 
 # two questions:
 # 1) How do we get the latest spec? How do we pass it into the data folder?
 # 2) When do we pull and when do we not?
+#
+# Downloads share one pooled session and run MAX_PARALLEL_DOWNLOADS at a time. Files are streamed to a .part file and
+# moved into place once complete, so an interrupted download is resumed with a Range request on the next run.
+# The ETag/Last-Modified of every downloaded link is kept in a state file in the doc dir and sent back as a conditional GET,
+# so a link whose file has not changed is answered with a 304 and not downloaded again.
+
+MAX_PARALLEL_DOWNLOADS = config.get("AUTOFETCHER_MAX_PARALLEL_DOWNLOADS", 4)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = config.get("AUTOFETCHER_TIMEOUT", 60)
+STATE_FILENAME = ".autofetcher_state.json"
+GETTABLE_EXTENSIONS = [".zip",".docx",".doc",".pdf"]
+
+class DownloadState:
+    """ETag/Last-Modified of the downloaded links, persisted as json: {link: {filename, etag, last_modified}}.
+    Shared by the download threads."""
+    def __init__(self,path:str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: dict[str,dict] = {}
+        if os.path.exists(path):
+            with open(path,'r',encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def get(self,link:str)->dict:
+        with self._lock:
+            return dict(self.entries.get(link,{}))
+
+    def record(self,link:str,filename:str,headers):
+        """@headers: response headers of the download of @link"""
+        with self._lock:
+            self.entries[link] = {
+                "filename":filename,
+                "etag":headers.get("ETag"),
+                "last_modified":headers.get("Last-Modified"),
+            }
+            self._save()
+
+    def record_partial(self,link:str,response:requests.Response):
+        with self._lock:
+            self.entries.setdefault(link,{})["partial_validator"] = response.headers.get("ETag") or response.headers.get("Last-Modified")
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".",exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path,'w',encoding='utf-8') as f:
+            json.dump(self.entries,f)
+        os.replace(tmp_path,self.path)
+
+def make_session(max_connections:int=MAX_PARALLEL_DOWNLOADS)->requests.Session:
+    """One keep-alive connection pool for all requests, with retries on connection errors and 5xx responses"""
+    session = requests.Session()
+    retry = Retry(total=3,backoff_factor=1,status_forcelist=[500,502,503,504],allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=max_connections,pool_maxsize=max_connections,max_retries=retry)
+    session.mount("http://",adapter)
+    session.mount("https://",adapter)
+    return session
 
 class AutoFetcher:
-    def __init__(self,fetch_endpoints:list[str],post_processing_func,doc_dir_path=config["DOC_DIR"]):
+    def __init__(self,fetch_endpoints:list[str],post_processing_func,doc_dir_path=config["DOC_DIR"],max_parallel_downloads:int=MAX_PARALLEL_DOWNLOADS,state_path:str|None=None):
         """@fetch_endpoints: list of the endpoints that the AF will query with a get request when `AF.run()` is invoked.\n
-        @post_processing_func: the function that is run on the fetched files."""
+        @post_processing_func: the function that is run on the fetched files.\n
+        @max_parallel_downloads: number of files downloaded at once.\n
+        @state_path: where the ETag/Last-Modified of downloaded links are kept. Defaults to a state file in `doc_dir_path`."""
         self.links = {}
         self.fetch_endpoints = fetch_endpoints
         self.post_processing_func = post_processing_func
         self.doc_dir_path=doc_dir_path
+        self.max_parallel_downloads = max_parallel_downloads
+        self.session = make_session(max_parallel_downloads)
+        self.state = DownloadState(state_path or os.path.join(doc_dir_path,STATE_FILENAME))
 
     def extractLinksFromEndpoint(self,endpoint,params):
         """For a specific endpoint we retrieve the page and collect all the links on that page. 
         Run this for pages which are collections of links.
         @params: search parameters for the request. Try to sort all the links by upload date. 
         The assumption is that the last link after sorting is the most recent one."""
-        response = requests.get(endpoint,params=params)
+        response = self.session.get(endpoint,params=params,timeout=DOWNLOAD_TIMEOUT)
         print(response)
         if response.status_code != 200:
             raise Exception("Error: Could not retrieve page content")
         soup = BeautifulSoup(response.content,'html.parser')
         self.links[endpoint] = []
         for link in soup.find_all('a'):
-            self.links[endpoint].append(link.get('href'))
+            href = link.get('href')
+            if href is None:
+                continue
+            # relative links (e.g. from a plain directory listing) are resolved against the page
+            self.links[endpoint].append(urljoin(response.url,href))
     
     def getMostRecentLink(self,endpoint):
         """Current assumption is that the last link is the most recent one"""
@@ -40,52 +115,230 @@ class AutoFetcher:
             raise Exception("Error: Run extractLinksFromEndpoint first")
         return self.links[endpoint][-1]
     
-    def downloadFileFromLink(self,link)->str:
-        """Makes the assumption that the last part of the address given is the name of the file to the downloaded
-        Note: currently set up to work with duplicates. If the filename already exists, it will append a random hash to the end of the filename and then try to download.
+    def _conditional_headers(self,link:str,filepath:str)->dict:
+        """If-None-Match/If-Modified-Since for a link we already have, so an unchanged file is answered with a 304"""
+        entry = self.state.get(link)
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers and os.path.exists(filepath):
+            # downloaded before the state file existed
+            headers["If-Modified-Since"] = formatdate(os.path.getmtime(filepath),usegmt=True)
+        return headers
+
+    def downloadFileFromLink(self,link)->str|None:
+        """Makes the assumption that the last part of the address given is the name of the file to the downloaded.
+        The file is streamed to disk and replaces an older copy of the same name. Nothing is downloaded if the server reports
+        the file unchanged since the last download, and a partly downloaded file is resumed where it stopped.
         @link: http[s] endpoint where a file can be downloaded with a get request
-        returns: filename (not abs path)"""
+        returns: filename (not abs path), or None if nothing new was downloaded"""
         filename = link.split("/")[-1]
 
-        if ".zip" not in filename and ".docx" not in filename and ".doc" not in filename and ".pdf" not in filename:
+        if not any(extension in filename for extension in GETTABLE_EXTENSIONS):
             warnings.warn(f"AutoFetcher: skipping {link} as it is not a gettable file")
-            return
+            return None
         filepath = os.path.join(self.doc_dir_path,filename)
-        while os.path.exists(filepath):
-            filepath = os.path.join(self.doc_dir_path,filename+f"{random.randint(0,65535)}")
+        part_path = filepath + ".part"
 
-        response = requests.get(link)
-        if response.status_code != 200:
-            raise Exception("Error: Could not retrieve page content")
+        headers = self._conditional_headers(link,filepath)
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if resume_from > 0:
+            # conditional headers would turn a changed file into a 412, If-Range gets us the whole new file instead
+            validator = self.state.get(link).get("partial_validator")
+            headers = {"Range":f"bytes={resume_from}-"}
+            if validator:
+                headers["If-Range"] = validator
+
+        with self.session.get(link,headers=headers,stream=True,timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 304:
+                print(f"AutoFetcher: {filename} is unchanged, skipping")
+                return None
+            if response.status_code == 416:
+                # the part file does not fit the file on the server any more, start over
+                os.remove(part_path)
+                return self.downloadFileFromLink(link)
+            if response.status_code not in (200,206):
+                raise Exception(f"Error: Could not retrieve page content ({response.status_code} for {link})")
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            # lets an interrupted download be resumed with If-Range
+            self.state.record_partial(link,response)
+            with open(part_path,mode) as file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+            os.replace(part_path,filepath)
+            self.state.record(link,filename,response.headers)
 
-        with open(filepath,'wb') as file:
-            file.write(response.content)
-        
         self.post_processing_func(filepath,self.doc_dir_path)
         return filename
 
-    def run(self,params=None,areEndpointsGettable=False,getAllFilesFromLink=False):
-        """@areEndpointsGettable: true if a file can be fetched from each endpoint with a get request.
-        False if there is at least one endpoint that must be parsed for a gettable link
-        `@getAllFilesFromLink`: True if you'd prefer to download all the files from the endpoint rather than only the most recently updated one"""
-        
-        file_list = []
+    def downloadFilesFromLinks(self,links:list[str])->list[str]:
+        """Downloads @links with at most max_parallel_downloads at once.
+        returns: the filenames that were downloaded, in the order of @links"""
+        links = list(dict.fromkeys(links))
+        with ThreadPoolExecutor(max_workers=self.max_parallel_downloads) as executor:
+            filenames = list(executor.map(self.downloadFileFromLink,links))
+        return [filename for filename in filenames if filename is not None]
+
+    def collectLinks(self,params=None,areEndpointsGettable=False,getAllFilesFromLink=False)->list[str]:
+        """The links `run` downloads, see `run` for the arguments"""
+        links = []
         for endpoint in self.fetch_endpoints:
             self.extractLinksFromEndpoint(endpoint,params)
             if not areEndpointsGettable:
                 if not getAllFilesFromLink:
-                    link = self.getMostRecentLink(endpoint)
-                    filename=self.downloadFileFromLink(link)
-                    file_list.append(filename)
+                    links.append(self.getMostRecentLink(endpoint))
                 else:
-                    print(f"self.links is {self.links}")
-                    for link in self.links[endpoint]:
-                        filename = self.downloadFileFromLink(link)
-                        file_list.append(filename)
+                    print(f"found {len(self.links[endpoint])} links at {endpoint}")
+                    links.extend(self.links[endpoint])
             else:
-                filename = self.downloadFileFromLink(endpoint)
-                file_list.append(filename)
-        return file_list
+                links.append(endpoint)
+        return links
+
+    def run(self,params=None,areEndpointsGettable=False,getAllFilesFromLink=False):
+        """@areEndpointsGettable: true if a file can be fetched from each endpoint with a get request.
+        False if there is at least one endpoint that must be parsed for a gettable link
+        `@getAllFilesFromLink`: True if you'd prefer to download all the files from the endpoint rather than only the most recently updated one
+        returns: the filenames that were downloaded. Files that were unchanged since the last run are left out."""
+        return self.downloadFilesFromLinks(self.collectLinks(params,areEndpointsGettable,getAllFilesFromLink))
+
+    ##############################
+    ## Download-to-index mode   ##
+    ##############################
+    def fetchFileIntoMemory(self,link)->tuple[str,bytes,dict]|None:
+        """Conditional GET of @link into memory, nothing is written to the doc dir.
+        The state file is not updated here: record the returned headers once the file has been used, so a file that failed
+        further down the line is fetched again on the next run.
+        returns: (filename, content, response headers), or None if the file is unchanged or not gettable"""
+        filename = link.split("/")[-1]
+        if not any(extension in filename for extension in GETTABLE_EXTENSIONS):
+            warnings.warn(f"AutoFetcher: skipping {link} as it is not a gettable file")
+            return None
+        headers = self._conditional_headers(link,os.path.join(self.doc_dir_path,filename))
+        with self.session.get(link,headers=headers,stream=True,timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 304:
+                print(f"AutoFetcher: {filename} is unchanged, skipping")
+                return None
+            if response.status_code != 200:
+                raise Exception(f"Error: Could not retrieve page content ({response.status_code} for {link})")
+            buffer = BytesIO()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
+            return filename, buffer.getvalue(), dict(response.headers)
+
+    @staticmethod
+    def docxMembers(filename:str,content:bytes)->tuple[list[tuple[str,bytes]],list[str]]:
+        """The .docx files in a download: every .docx member of a zip, or the download itself. Old .doc files are skipped since they need converting.
+        returns: (docx name and bytes of each docx, names of the documents that were skipped)"""
+        if filename.endswith(".docx"):
+            return [(filename,content)], []
+        if not filename.endswith(".zip"):
+            warnings.warn(f"AutoFetcher: {filename} holds no docx, skipping")
+            return [], [filename]
+        members, skipped = [], []
+        with ZipFile(BytesIO(content),'r') as zf:
+            for name in zf.namelist():
+                if name.endswith(".docx"):
+                    members.append((os.path.basename(name),zf.read(name)))
+                elif name.endswith(".doc"):
+                    warnings.warn(f"AutoFetcher: skipping {name} in {filename}, .doc files must be converted on disk first")
+                    skipped.append(name)
+        return members, skipped
+
+    @staticmethod
+    def docxKey(link:str,name:str)->str:
+        """Stream name of docx @name from @link. Two archives may hold docx of the same name, so the link is kept in front of it
+        (the chunker only looks at the part after the last '/', so chunks are the same as for the bare name)."""
+        return f"{link.rstrip('/')}/{name}"
+
+    def iterFetchedDocx(self,links:list[str],on_link_fetched:Callable[[str,str,dict,list[str],list[str]],None]|None=None,key_by_link:bool=False)->Iterator[tuple[str,bytes]]:
+        """Downloads @links into memory, at most max_parallel_downloads at once, and yields (docx name, docx bytes) for every docx
+        in them as soon as its download finishes. At most max_parallel_downloads archives are held in memory waiting to be consumed.
+        @on_link_fetched: called with (link, filename, headers, docx names, skipped names) before the docx of a link are yielded,
+        see `docxMembers` for what is skipped
+        @key_by_link: yield `docxKey(link, docx name)` instead of the bare docx name, here and to @on_link_fetched"""
+        links = list(dict.fromkeys(links))
+        with ThreadPoolExecutor(max_workers=self.max_parallel_downloads) as executor:
+            pending = {}
+            link_iter = iter(links)
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self.max_parallel_downloads:
+                    try:
+                        link = next(link_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[executor.submit(self.fetchFileIntoMemory,link)] = link
+                if not pending:
+                    return
+                done, _ = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    link = pending.pop(future)
+                    fetched = future.result()
+                    if fetched is None:
+                        continue
+                    filename, content, headers = fetched
+                    members, skipped = self.docxMembers(filename,content)
+                    del content
+                    if key_by_link:
+                        members = [(self.docxKey(link,name),member) for name,member in members]
+                    if on_link_fetched is not None:
+                        on_link_fetched(link,filename,headers,[name for name,_ in members],skipped)
+                    yield from members
+
+    def runIntoDB(self,db,params=None,areEndpointsGettable=False,getAllFilesFromLink=False,metadata_func=None,requested_chunking_type:RequestedChunkingType=RequestedChunkingType.SECTION)->dict[str,str]:
+        """Download-to-index mode: like `run`, but archives are opened in memory and their docx go straight to the chunker,
+        with chunks embedded and stored by @db (a DBClient) while other downloads are still running. Nothing is written to the doc dir.
+        A link is only recorded in the state file once every docx in it is stored, so a failed run picks up where it left off.
+        Links holding documents that cannot be read in memory (.doc, see `docxMembers`) are never recorded, so `run` still
+        downloads them for conversion; their docx are fetched and indexed again on every run, which only re-stores existing chunks.
+        @metadata_func, @requested_chunking_type: see DBClient.updateDBFromFileList.
+        returns: progress of every docx seen, `docxKey(link, docx name)` -> "fetched" or "indexed" """
+        progress: dict[str,str] = {}
+        docx_left: dict[str,set[str]] = {}
+        # docx are keyed by link and name (see docxKey), archives of different links may hold docx of the same name
+        link_of_docx: dict[str,str] = {}
+        fetched_links: dict[str,tuple[str,dict]] = {}
+        lock = threading.Lock()
+
+        def link_done(link:str):
+            filename, headers = fetched_links.pop(link)
+            self.state.record(link,filename,headers)
+            print(f"AutoFetcher: indexed every docx of {filename}")
+
+        def on_link_fetched(link:str,filename:str,headers:dict,docx_names:list[str],skipped:list[str]):
+            with lock:
+                for name in docx_names:
+                    progress[name] = "fetched"
+                if skipped:
+                    print(f"AutoFetcher: fetched {filename} ({len(docx_names)} docx), not recording it since {len(skipped)} documents in it need converting, fetch it with run")
+                    return
+                fetched_links[link] = (filename,headers)
+                docx_left[link] = set(docx_names)
+                for name in docx_names:
+                    link_of_docx[name] = link
+                if not docx_names:
+                    link_done(link)
+            print(f"AutoFetcher: fetched {filename} ({len(docx_names)} docx)")
+
+        def on_docx_indexed(name:str,chunk_ids:list[str]):
+            with lock:
+                progress[name] = "indexed"
+                link = link_of_docx.pop(name,None)
+                if link is None:
+                    return
+                docx_left[link].discard(name)
+                if not docx_left[link]:
+                    del docx_left[link]
+                    link_done(link)
+            num_indexed = sum(1 for state in progress.values() if state == "indexed")
+            print(f"AutoFetcher: indexed {name} ({len(chunk_ids)} chunks), {num_indexed}/{len(progress)} docx indexed so far")
+
+        links = self.collectLinks(params,areEndpointsGettable,getAllFilesFromLink)
+        db.updateDBFromDocxStream(self.iterFetchedDocx(links,on_link_fetched=on_link_fetched,key_by_link=True),metadata_func=metadata_func,requested_chunking_type=requested_chunking_type,on_file_done=on_docx_indexed)
+        return progress
 
 if __name__ == "__main__":
     params = {"sortby":"date"}
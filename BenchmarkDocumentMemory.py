@@ -0,0 +1,79 @@
+import gc
+import time
+import argparse
+import tracemalloc
+from utils import Document
+from CollectionNames import SPECS_AND_DISCUSSIONS as SPEC_COLL_NAME
+from settings import config
+
+# Memory and build time of a full collection load (as in DBClient.getAllDocsFromDB) with the slotted Document, whose document level
+# metadata is interned and shared by every chunk of a file, against the plain per-chunk dict representation it replaced.
+# Run from the repo root: python BenchmarkDocumentMemory.py [--db-dir ...] [--collection ...] [--limit N]
+# or without a DB: python BenchmarkDocumentMemory.py --synthetic 200000
+
+class PlainDocument:
+    """The Document representation before the slotted one: an instance __dict__ and a metadata dict of its own"""
+    def __init__(self, page_content:str, metadata:dict):
+        self.page_content = page_content
+        self.metadata = metadata
+
+def load_collection(db_dir:str,collection_name:str,limit:int|None)->tuple[list[str],list[dict]]:
+    import chromadb
+    collection = chromadb.PersistentClient(path=db_dir).get_collection(collection_name)
+    db_resp = collection.get(include=["documents", "metadatas"],limit=limit)
+    return db_resp['documents'], db_resp['metadatas']
+
+def synthetic_collection(num_docs:int,chunks_per_file:int=500)->tuple[list[str],list[dict]]:
+    """Chunks shaped like FULL_SECTION spec chunks, @chunks_per_file sections per spec"""
+    texts, metadatas = [], []
+    for i in range(num_docs):
+        spec = i // chunks_per_file
+        texts.append(f"section {i} text " * 20)
+        metadatas.append({
+            'source':f"38{spec:03d}-i70.docx",'section':f"{spec}.{i % chunks_per_file}",'version':"18.7.0",'docID':f"38.{spec:03d}",
+            'timestamp':"2025-06",'release':"18",'author':"MCC",'title':f"3GPP TS 38.{spec:03d}",'subject':"",
+        })
+    return texts, metadatas
+
+def measure(document_class:type,texts:list[str],metadatas:list[dict])->tuple[int,float]:
+    """Bytes still allocated once the documents are built, on top of the page contents (shared by both representations), and seconds to build them.
+    Each document gets a fresh copy of its metadata dict, the way every chroma row comes with one.
+    The build is timed on its own, as tracemalloc slows down every allocation."""
+    copies = [dict(metadata) for metadata in metadatas]
+    gc.collect()
+    start = time.perf_counter()
+    docs = [document_class(page_content=text,metadata=metadata) for text,metadata in zip(texts,copies)]
+    seconds = time.perf_counter() - start
+    del docs, copies
+    gc.collect()
+    tracemalloc.start()
+    docs = [document_class(page_content=text,metadata=dict(metadata)) for text,metadata in zip(texts,metadatas)]
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del docs
+    return allocated, seconds
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Compares the memory and build time of a full collection load with slotted and plain Documents")
+    argparser.add_argument('--db-dir', type=str, default=config.get("CHROMA_DIR"))
+    argparser.add_argument('--collection', '-c', type=str, default=SPEC_COLL_NAME)
+    argparser.add_argument('--limit', '-l', type=int, default=None, help="load at most this many chunks")
+    argparser.add_argument('--synthetic', '-s', type=int, default=None, help="benchmark this many generated chunks instead of a collection")
+    args = argparser.parse_args()
+
+    if args.synthetic is not None:
+        texts, metadatas = synthetic_collection(args.synthetic)
+    else:
+        texts, metadatas = load_collection(args.db_dir,args.collection,args.limit)
+    print(f"{len(texts)} chunks")
+
+    results = {}
+    for name,document_class in (("plain",PlainDocument),("slotted",Document)):
+        allocated, seconds = measure(document_class,texts,metadatas)
+        results[name] = (allocated,seconds)
+        print(f"{name:8s} {allocated/2**20:9.1f} MiB  {allocated/max(1,len(texts)):7.0f} B/chunk  built in {seconds:.2f}s ({1e6*seconds/max(1,len(texts)):.1f} us/chunk)")
+    if results["plain"][0] > 0:
+        print(f"slotted uses {100 * results['slotted'][0] / results['plain'][0]:.0f}% of the plain representation's memory")
+    if results["plain"][1] > 0:
+        print(f"slotted takes {results['slotted'][1] / results['plain'][1]:.1f}x as long to build")
@@ -0,0 +1,81 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+# Import time budget for the query path.
+# Imports each entrypoint in a fresh interpreter with `python -X importtime`, reports the slowest imports and fails if
+# the import takes longer than the budget or drags in an ingestion-only module.
+# Run from the repo root: python CheckImportBudget.py [--budget 3.0] [--top 20] [module ...]
+
+# frontend builds a Controller at import unless USE_REMOTE_DS is set, so its startup is measured here along with gradio's import
+QUERY_PATH_MODULES = ["ds_server", "controller", "MultiStageRetriever", "frontend"]
+# modules only needed to chunk and ingest documents
+INGESTION_ONLY_MODULES = [
+    "MetadataAwareChunker", "DocxStreamParser", "IngestionPipeline", "IngestionManifest",
+    "langchain_text_splitters", "markitdown", "docx", "pandas", "lxml",
+]
+DEFAULT_BUDGET_SECONDS = 3.0
+
+IMPORTTIME_LINE_REGX = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)\s*$")
+
+class ImportTiming:
+    def __init__(self,module:str,self_us:int,cumulative_us:int):
+        self.module = module
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+
+    def __repr__(self):
+        return f'{self.module}: {self.cumulative_us/1e6:.3f}s cumulative, {self.self_us/1e6:.3f}s self'
+
+def measure_imports(module:str)->tuple[list[ImportTiming],str]:
+    """Imports @module in a fresh interpreter. Returns the per-module timings and the error output if the import failed."""
+    result = subprocess.run(
+        [sys.executable,"-X","importtime","-c",f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),capture_output=True,text=True,
+    )
+    timings, errors = [], []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE_REGX.match(line)
+        if match is None:
+            if not line.startswith("import time:"):
+                errors.append(line)
+            continue
+        self_us, cumulative_us, name = match.groups()
+        timings.append(ImportTiming(name,int(self_us),int(cumulative_us)))
+    return timings, "\n".join(errors) if result.returncode != 0 else ""
+
+def check_module(module:str,budget_seconds:float,top:int)->bool:
+    timings, error = measure_imports(module)
+    if error:
+        print(f"[FAIL] import {module} failed:\n{error}")
+        return False
+    total = next((t.cumulative_us for t in timings if t.module == module),sum(t.self_us for t in timings)) / 1e6
+    print(f"\nimport {module}: {total:.3f}s (budget {budget_seconds:.3f}s), {len(timings)} modules")
+    print(f"slowest {top} imports by cumulative time:")
+    for timing in sorted(timings,key=lambda t: t.cumulative_us,reverse=True)[:top]:
+        print(f"  {timing.cumulative_us/1e6:8.3f}s  {timing.self_us/1e6:8.3f}s self  {timing.module}")
+
+    passed = True
+    imported = {t.module for t in timings}
+    leaked = [name for name in INGESTION_ONLY_MODULES if name in imported]
+    if leaked:
+        print(f"[FAIL] {module} imports ingestion-only modules: {leaked}")
+        passed = False
+    if total > budget_seconds:
+        print(f"[FAIL] {module} takes {total:.3f}s to import, over the {budget_seconds:.3f}s budget")
+        passed = False
+    if passed:
+        print(f"[OK] {module}")
+    return passed
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Checks the import time of the query path entrypoints")
+    argparser.add_argument('modules', nargs='*', default=QUERY_PATH_MODULES)
+    argparser.add_argument('--budget', '-b', type=float, default=DEFAULT_BUDGET_SECONDS, help="max seconds to import each module")
+    argparser.add_argument('--top', '-t', type=int, default=20, help="number of slowest imports to report")
+    args = argparser.parse_args()
+
+    results = [check_module(module,args.budget,args.top) for module in args.modules]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+import argparse
+import pyarrow as pa
+import pyarrow.compute as pc
+from collections.abc import Callable, Iterator
+from MetadataAwareChunker import iter_chunks_of_files, addExtraDocumentWideMetadataForContext, addExtraDocumentWideMetadataForReason, CHUNKING_MAX_WORKERS, CHUNKER_VERSION
+from utils import Document, RequestedChunkingType, getAllFilesInDirMatchingFormat
+from settings import config
+
+# On-disk snapshot of the FULL_SECTION chunks of a set of docx files, for the offline jobs (ConstructDiffDB, eval/*) that chunk the
+# same specs on every run. The chunks are written once to an Arrow IPC file with one column per metadata field, and later runs
+# memory map it: opening a corpus reads no chunk text until a chunk is looked at, and every process reading the same corpus
+# shares the page cache instead of holding its own copy of every string.
+# A corpus records the size and mtime of each source file, the metadata function it was built with and the chunker and schema
+# versions, and is rebuilt when any of them change. Use `getFullSectionCorpus` where a job would call `getFullSectionChunks`.
+
+CHUNK_CORPUS_DIR = config.get("CHUNK_CORPUS_DIR", "corpus")
+CORPUS_FILE_EXTENSION = ".arrow"
+FINGERPRINT_KEY = b"fingerprint"
+
+# chunk metadata fields that get a column of their own. Other keys, and values that are not strings, go to the json extra column
+METADATA_COLUMNS = ["source","docID","version","section","release","timestamp","author","title","subject"]
+TEXT_COLUMN = "text"
+EXTRA_COLUMN = "extra"
+CORPUS_SCHEMA = pa.schema([(name,pa.string()) for name in METADATA_COLUMNS] + [(TEXT_COLUMN,pa.large_string()),(EXTRA_COLUMN,pa.string())])
+INDEX_COLUMNS = ("docID","section","version")
+# bump when the columns or how chunks are written to them change
+CORPUS_SCHEMA_VERSION = 1
+
+def _func_name(func:Callable)->str:
+    return f"{func.__module__}.{func.__qualname__}"
+
+def corpus_fingerprint(file_list:list[str],addExtraDocumentWideMetadata:Callable[[str,str],dict])->dict:
+    """What a corpus is built from. A stored corpus is only reused if its fingerprint matches this."""
+    files = {}
+    for file in sorted(os.path.abspath(file) for file in file_list):
+        stat = os.stat(file)
+        files[file] = [stat.st_size,stat.st_mtime_ns]
+    return {"chunker_version":CHUNKER_VERSION,"schema_version":CORPUS_SCHEMA_VERSION,"chunking_type":RequestedChunkingType.FULL_SECTION.name,"metadata_func":_func_name(addExtraDocumentWideMetadata),"files":files}
+
+def corpus_path_for(file_list:list[str],addExtraDocumentWideMetadata:Callable[[str,str],dict],corpus_dir:str=CHUNK_CORPUS_DIR)->str:
+    """Default location of the corpus of @file_list: one file per set of sources and metadata function"""
+    key = json.dumps([sorted(os.path.abspath(file) for file in file_list),_func_name(addExtraDocumentWideMetadata)])
+    return os.path.join(corpus_dir,f"full_section_{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}{CORPUS_FILE_EXTENSION}")
+
+def _record_batch(docs:list[Document])->pa.RecordBatch:
+    columns = {name: [] for name in METADATA_COLUMNS}
+    extras = []
+    for doc in docs:
+        extra = {}
+        for key,value in doc.metadata.items():
+            if key not in columns or not isinstance(value,str):
+                extra[key] = value
+        for name in METADATA_COLUMNS:
+            value = doc.metadata.get(name)
+            columns[name].append(value if isinstance(value,str) else None)
+        extras.append(json.dumps(extra) if extra else None)
+    arrays = [pa.array(columns[name],type=pa.string()) for name in METADATA_COLUMNS]
+    arrays.append(pa.array([doc.page_content for doc in docs],type=pa.large_string()))
+    arrays.append(pa.array(extras,type=pa.string()))
+    return pa.RecordBatch.from_arrays(arrays,schema=CORPUS_SCHEMA)
+
+class ChunkView:
+    """One chunk of a ChunkCorpus. Has the page_content and metadata of a Document, both read out of the memory map on first access,
+    so it can be passed to anything that takes a Document without reading it."""
+    __slots__ = ("corpus","row","_metadata")
+
+    def __init__(self,corpus:"ChunkCorpus",row:int):
+        self.corpus = corpus
+        self.row = row
+        self._metadata = None
+
+    @property
+    def page_content(self)->str:
+        return self.corpus.value(TEXT_COLUMN,self.row)
+
+    @property
+    def metadata(self)->dict:
+        if self._metadata is None:
+            # keys the chunk did not have are stored as nulls, leave them out again
+            metadata = {}
+            for name in METADATA_COLUMNS:
+                value = self.corpus.value(name,self.row)
+                if value is not None:
+                    metadata[name] = value
+            extra = self.corpus.value(EXTRA_COLUMN,self.row)
+            if extra is not None:
+                metadata.update(json.loads(extra))
+            self._metadata = metadata
+        return self._metadata
+
+    def to_document(self)->Document:
+        return Document(page_content=self.page_content,metadata=dict(self.metadata))
+
+    def __repr__(self):
+        return f'metadata={self.metadata}, page_content="{self.page_content}"'
+
+class ChunkCorpus:
+    """Read side of a corpus file. The table is memory mapped, so opening it is cheap whatever its size.
+    Chunks are kept in the order they were chunked in, and the rows of one source file are contiguous."""
+    def __init__(self,path:str):
+        self.path = path
+        # the table's buffers point into the map, which stays open for as long as they are referenced
+        reader = pa.ipc.open_file(pa.memory_map(path,'r'))
+        self.fingerprint = json.loads(reader.schema.metadata[FINGERPRINT_KEY])
+        self.table = reader.read_all()
+        self._index: dict[tuple[str,str,str],int]|None = None
+
+    @classmethod
+    def build(cls,path:str,file_list:list[str],addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext,max_workers:int|None=CHUNKING_MAX_WORKERS)->"ChunkCorpus":
+        """Chunks @file_list and writes the corpus to @path, one record batch per file, so only one file's chunks are held at a time."""
+        os.makedirs(os.path.dirname(path) or ".",exist_ok=True)
+        schema = CORPUS_SCHEMA.with_metadata({FINGERPRINT_KEY:json.dumps(corpus_fingerprint(file_list,addExtraDocumentWideMetadata))})
+        tmp_path = path + ".tmp"
+        num_chunks = 0
+        with pa.OSFile(tmp_path,'wb') as sink, pa.ipc.new_file(sink,schema) as writer:
+            for _,chunks_by_type in iter_chunks_of_files(file_list,[RequestedChunkingType.FULL_SECTION],addExtraDocumentWideMetadata,max_workers=max_workers):
+                docs = chunks_by_type[RequestedChunkingType.FULL_SECTION]
+                if docs:
+                    writer.write_batch(_record_batch(docs))
+                    num_chunks += len(docs)
+        os.replace(tmp_path,path)
+        print(f"wrote {num_chunks} chunks of {len(file_list)} files to {path}")
+        return cls(path)
+
+    def is_built_from(self,file_list:list[str],addExtraDocumentWideMetadata:Callable[[str,str],dict])->bool:
+        try:
+            return self.fingerprint == corpus_fingerprint(file_list,addExtraDocumentWideMetadata)
+        except OSError:
+            return False
+
+    def value(self,column:str,row:int):
+        return self.table.column(column)[row].as_py()
+
+    def __len__(self)->int:
+        return self.table.num_rows
+
+    def __getitem__(self,row:int)->ChunkView:
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(f"row {row} out of range for a corpus of {len(self)} chunks")
+        return ChunkView(self,row)
+
+    def __iter__(self)->Iterator[ChunkView]:
+        for row in range(len(self)):
+            yield ChunkView(self,row)
+
+    def get(self,docID:str,section:str,version:str)->ChunkView|None:
+        """Looks a chunk up by (docID, section, version). The index is built from those three columns on first use."""
+        if self._index is None:
+            index = {}
+            for row,key in enumerate(zip(*(self.table.column(name).to_pylist() for name in INDEX_COLUMNS))):
+                index.setdefault(key,row)
+            self._index = index
+        row = self._index.get((docID,section,version))
+        return ChunkView(self,row) if row is not None else None
+
+    def where(self,**fields:str)->list[ChunkView]:
+        """Chunks whose metadata columns equal @fields, e.g. corpus.where(source="38211-i70.docx"). Filters on the columns without reading any text."""
+        mask = None
+        for name,value in fields.items():
+            if name not in METADATA_COLUMNS:
+                raise ValueError(f"Can only filter on {METADATA_COLUMNS}, not {name}")
+            condition = pc.fill_null(pc.equal(self.table.column(name),value),False)
+            mask = condition if mask is None else pc.and_(mask,condition)
+        if mask is None:
+            return list(self)
+        return [ChunkView(self,row) for row in pc.indices_nonzero(mask).to_pylist()]
+
+    def documents(self)->list[Document]:
+        """Copies every chunk out into a Document, for code that needs to modify them"""
+        return [view.to_document() for view in self]
+
+    def __repr__(self):
+        return f'ChunkCorpus(path={self.path}, num_chunks={len(self)}, num_files={len(self.fingerprint["files"])})'
+
+def getFullSectionCorpus(file_list:list[str],addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext,corpus_path:str|None=None,rebuild:bool=False,max_workers:int|None=CHUNKING_MAX_WORKERS)->ChunkCorpus:
+    """Drop-in for `getFullSectionChunks` in offline jobs: the same chunks, as views over a memory mapped corpus.
+    The corpus at @corpus_path (by default one under CHUNK_CORPUS_DIR derived from @file_list) is reused if it was built from the same
+    files, unchanged, with the same metadata function. Otherwise, or if @rebuild, the files are chunked and the corpus rewritten."""
+    corpus_path = corpus_path or corpus_path_for(file_list,addExtraDocumentWideMetadata)
+    if not rebuild and os.path.exists(corpus_path):
+        corpus = ChunkCorpus(corpus_path)
+        if corpus.is_built_from(file_list,addExtraDocumentWideMetadata):
+            return corpus
+        print(f"{corpus_path} is out of date, rebuilding it")
+    return ChunkCorpus.build(corpus_path,file_list,addExtraDocumentWideMetadata,max_workers=max_workers)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Builds (or refreshes) the FULL_SECTION chunk corpus of the docx files in a directory")
+    argparser.add_argument('doc_dir', type=str)
+    argparser.add_argument('--output', '-o', type=str, default=None, help="corpus file to write, defaults to one under CHUNK_CORPUS_DIR")
+    argparser.add_argument('--reason-metadata', action='store_true', help="fill document wide metadata with addExtraDocumentWideMetadataForReason")
+    argparser.add_argument('--rebuild', action='store_true')
+    args = argparser.parse_args()
+
+    file_list = [os.path.join(args.doc_dir,file) for file in getAllFilesInDirMatchingFormat(args.doc_dir)]
+    func = addExtraDocumentWideMetadataForReason if args.reason_metadata else addExtraDocumentWideMetadataForContext
+    print(getFullSectionCorpus(file_list,func,corpus_path=args.output,rebuild=args.rebuild))
@@ -1,6 +1,7 @@
 from ChangeTracker import ChangeTracker, get_version_preceding_first_in_release, get_doc_list_for_version_preceding_first
 from DBClient import DBClient
-from MetadataAwareChunker import getFullSectionChunks,addExtraDocumentWideMetadataForReason
+from MetadataAwareChunker import addExtraDocumentWideMetadataForReason
+from ChunkCorpus import getFullSectionCorpus
 import os
 from utils import getAllFilesInDirMatchingFormat,convertAllDocToDocx, getTokenCount, RequestedChunkingType
 from CollectionNames import DIFFS as DIFF_COLL_NAME
@@ -14,7 +15,7 @@ def get_sorted_versions(versionMap:dict)->list[str]:
     return versions
 
 if __name__ == "__main__":
-    db = DBClient(embedding_model_name="text-embedding-3-large",collection_name=DIFF_COLL_NAME,db_dir_path=DIFF_DB_DIR_PATH)
+    db = DBClient(collection_name=DIFF_COLL_NAME,db_dir_path=DIFF_DB_DIR_PATH)
 
     #convertAllDocToDocx(DIFF_DOC_DIR)
     file_list = getAllFilesInDirMatchingFormat(DIFF_DOC_DIR)
@@ -22,7 +23,7 @@ if __name__ == "__main__":
 
     docIDToversionToChunks = {}
 
-    all_chunks = getFullSectionChunks([os.path.join(DIFF_DOC_DIR,file) for file in file_list],addExtraDocumentWideMetadataForReason)
+    all_chunks = getFullSectionCorpus([os.path.join(DIFF_DOC_DIR,file) for file in file_list],addExtraDocumentWideMetadataForReason)
 
     for chunk in all_chunks:
         docID = chunk.metadata["docID"]
@@ -1,7 +1,7 @@
 from DBClient import DBClient
 from MetadataAwareChunker import addExtraDocumentWideMetadataForReason
 import os
-from utils import RequestedChunkingType, getAllFilesInDirMatchingFormat
+from utils import RequestedChunkingType, getAllFilesInDirMatchingFormat, convertAllDocToDocx
 from CollectionNames import REASONING_DOCS
 
 COLLECTION_NAME =  REASONING_DOCS
@@ -15,9 +15,10 @@ def parse_CR_docs(file_list,db:DBClient):
     db.updateDBFromFileList(file_list,metadata_func=addExtraDocumentWideMetadataForReason,doc_dir=DOC_DIR_PATH,requested_chunking_type=RequestedChunkingType.CR)
 
 if __name__ == "__main__":
-    db = DBClient(embedding_model_name="text-embedding-3-large",collection_name=COLLECTION_NAME,db_dir_path=DB_DIR_PATH)
+    db = DBClient(collection_name=COLLECTION_NAME,db_dir_path=DB_DIR_PATH)
 
-    #convertAllDocToDocx(DOC_DIR_PATH)
+    # many TDocs are still .doc, already converted files are skipped
+    convertAllDocToDocx(DOC_DIR_PATH)
     file_list = getAllFilesInDirMatchingFormat(DOC_DIR_PATH)
     print(file_list)
     #parse_nonCR_docs(file_list,db)
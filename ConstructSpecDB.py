@@ -12,7 +12,7 @@ def parse_spec_list(file_list,db: DBClient):
     db.updateDBFromFileList(file_list,metadata_func=addExtraDocumentWideMetadataForReason,doc_dir=DOC_DIR_PATH,requested_chunking_type=RequestedChunkingType.SECTION)
     
 if __name__ == "__main__":
-    db = DBClient(embedding_model_name="text-embedding-3-large",collection_name=COLLECTION_NAME,db_dir_path=DB_DIR_PATH)
+    db = DBClient(collection_name=COLLECTION_NAME,db_dir_path=DB_DIR_PATH)
 
     file_list = getAllFilesInDirMatchingFormat(DOC_DIR_PATH)
     parse_spec_list(file_list,db)
@@ -1,76 +1,179 @@
-from typing import Callable
-import uuid
-from utils import Document, getTokenCount, deterministic_id, RequestedChunkingType
-from MetadataAwareChunker import getSectionedChunks,addExtraDocumentWideMetadataForReason, getFullSectionChunks, getCRChunks
+from typing import Callable, TYPE_CHECKING
+import numpy as np
+from utils import Document, deterministic_id, RequestedChunkingType
+from EmbeddingBatcher import EmbeddingBatch, packEmbeddingBatches
 import chromadb
-from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
+from EmbeddingBackends import EMBEDDING_BACKEND, get_embedding_backend, check_collection_embedding_record
+from DocumentTable import DocumentTable, DOC_KEY_FIELD
+from SectionIndex import SectionIndex
+from QueryEmbeddingCache import query_embedding_cache
 from settings import config
 import os 
 import time
 from CollectionNames import SPECS_AND_DISCUSSIONS as SPEC_COLL_NAME, DIFFS as DIFF_COLL_NAME, REASONING_DOCS as TDOC_COLL_NAME
+if TYPE_CHECKING:
+    from IngestionManifest import IngestionPlan
+
+# Everything needed to chunk and ingest files (MetadataAwareChunker, IngestionManifest, IngestionPipeline and their docx/text splitting
+# dependencies) is imported inside the methods that ingest, so the query path (queryDB and friends) stays cheap to import.
+
+DELETE_BATCH_SIZE = 5000
+ID_LOOKUP_BATCH_SIZE = 5000
+# new collections keep document level metadata in the DocumentTable instead of on every chunk, see DocumentTable
+NORMALIZE_DOCUMENT_METADATA = config.get("NORMALIZE_DOCUMENT_METADATA", True)
+
+def _metadata_func_or_default(metadata_func:Callable[[str,str],dict]|None)->Callable[[str,str],dict]:
+    if metadata_func is None:
+        from MetadataAwareChunker import addExtraDocumentWideMetadataForReason
+        return addExtraDocumentWideMetadataForReason
+    return metadata_func
 
 class DBClient:
-    def getDocsFromFilePath(self,file_list:list[str],metadata_func:Callable[[str,str],dict]=addExtraDocumentWideMetadataForReason,doc_dir:str=config["DOC_DIR"],requested_chunking_type: RequestedChunkingType=RequestedChunkingType.SECTION)->list[Document]:
+    def getDocsFromFilePath(self,file_list:list[str],metadata_func:Callable[[str,str],dict]|None=None,doc_dir:str=config["DOC_DIR"],requested_chunking_type: RequestedChunkingType|list[RequestedChunkingType]=RequestedChunkingType.SECTION)->list[Document]|dict[RequestedChunkingType,list[Document]]:
         """@file_list: list(str) of file names. Not absolute/relative paths
-        @metadata_func: function that will be used to extract the document wide metadata
+        @metadata_func: function that will be used to extract the document wide metadata. Defaults to addExtraDocumentWideMetadataForReason
         @doc_dir: directory where the documents are located
+        @requested_chunking_type: a single chunking type, or a list of them. 
+        If a list is given, each file is parsed once and a dict of chunking type to docs is returned instead of a list.
         """
-        docs = []
         file_list = [os.path.join(doc_dir,file) for file in file_list]
-        match requested_chunking_type:
-            case RequestedChunkingType.FULL_SECTION:
-                docs = getFullSectionChunks(file_list,addExtraDocumentWideMetadata=metadata_func)
-            case RequestedChunkingType.SECTION:
-                docs = getSectionedChunks(file_list,addExtraDocumentWideMetadata=metadata_func)
-            case RequestedChunkingType.CR:
-                docs = getCRChunks(file_list)
-            case _:
-                raise ValueError(f"Unknown requested_chunking_type: {requested_chunking_type}")
+        if isinstance(requested_chunking_type,RequestedChunkingType):
+            return self._get_docs_of_types(file_list,metadata_func,[requested_chunking_type])[requested_chunking_type]
+        return self._get_docs_of_types(file_list,metadata_func,list(requested_chunking_type))
+
+    def _get_docs_of_types(self,file_list:list[str],metadata_func:Callable[[str,str],dict]|None,requested_chunking_types:list[RequestedChunkingType])->dict[RequestedChunkingType,list[Document]]:
+        """@file_list: list of paths to the files to chunk.
+        The section based chunking types share a single parse of each file."""
+        from MetadataAwareChunker import getChunksOfTypes, getCRChunks
+        metadata_func = _metadata_func_or_default(metadata_func)
+        docs = {}
+        section_types = []
+        for requested_chunking_type in requested_chunking_types:
+            match requested_chunking_type:
+                case RequestedChunkingType.FULL_SECTION | RequestedChunkingType.SECTION:
+                    section_types.append(requested_chunking_type)
+                case RequestedChunkingType.CR:
+                    docs[requested_chunking_type] = getCRChunks(file_list)
+                case _:
+                    raise ValueError(f"Unknown requested_chunking_type: {requested_chunking_type}")
+        if section_types:
+            docs.update(getChunksOfTypes(file_list,section_types,addExtraDocumentWideMetadata=metadata_func))
         return docs
 
+    def _chunk_id(self,doc:Document)->str:
+        return deterministic_id(doc.page_content, doc.metadata)
+
+    def _is_storable(self,doc:Document)->bool:
+        return bool(doc.page_content) and bool(doc.metadata) and doc.page_content.strip() != "" and doc.metadata != {}
+
+    def _stored_metadata(self,doc:Document)->dict:
+        """The chroma metadata of @doc. Chunk ids are still computed from the full metadata, so they do not depend on the layout."""
+        if self.document_table is None:
+            return dict(doc.metadata)
+        return self.document_table.normalize(doc.metadata)
+
+    def _loaded_metadata(self,stored:dict|None)->dict|None:
+        if self.document_table is None:
+            return stored
+        return self.document_table.expand(stored)
+
+    def _where(self,filter:dict|None)->dict|None:
+        if self.document_table is None:
+            return filter
+        return self.document_table.rewrite_filter(filter)
+
+    def _get_existing_ids(self,ids:list[str])->set[str]:
+        """Bulk existence check. Returns the subset of @ids that are already in the collection. Nothing is embedded."""
+        existing = set()
+        for i in range(0,len(ids),ID_LOOKUP_BATCH_SIZE):
+            db_resp = self.collection.get(ids=ids[i:i+ID_LOOKUP_BATCH_SIZE],include=[])
+            existing.update(db_resp['ids'])
+        return existing
+
+    def _get_doc_keys(self,ids:list[str])->set[str]:
+        """Document keys the chunks @ids refer to, in a normalized collection"""
+        doc_keys = set()
+        for i in range(0,len(ids),ID_LOOKUP_BATCH_SIZE):
+            db_resp = self.collection.get(ids=ids[i:i+ID_LOOKUP_BATCH_SIZE],include=["metadatas"])
+            doc_keys.update(metadata[DOC_KEY_FIELD] for metadata in db_resp['metadatas'] if metadata and DOC_KEY_FIELD in metadata)
+        return doc_keys
+
+    def _filter_new_docs(self,docs:list[Document])->list[Document]:
+        """Drops empty docs, docs repeated within @docs and docs whose deterministic id is already stored,
+        so only the chunks that are actually missing get embedded."""
+        new_docs = []
+        ids = []
+        seen = set()
+        for doc in docs:
+            if not self._is_storable(doc):
+                print(f"Skipping doc with empty content or metadata: {doc}")
+                self.ingest_stats["skipped_empty"] += 1
+                continue
+            chunk_id = self._chunk_id(doc)
+            if chunk_id in seen:
+                self.ingest_stats["skipped_existing"] += 1
+                continue
+            seen.add(chunk_id)
+            new_docs.append(doc)
+            ids.append(chunk_id)
+        existing = self._get_existing_ids(ids)
+        self.ingest_stats["skipped_existing"] += len(existing)
+        return [doc for doc,chunk_id in zip(new_docs,ids) if chunk_id not in existing]
+
     def _add_doc_list_to_db(self,docs:list[Document]):
-        """Adds the given list of documents to the collection"""
+        """Adds the given list of documents to the collection.
+        Chunks are keyed by their deterministic id, so re-adding a chunk overwrites it instead of duplicating it."""
         if len(docs) ==0:
             print("No documents to add to DB")
             return
         document_texts = []
         uuids = []
         metadatas = []
+        stored_docs = []
         for doc in docs:
-            if not doc.page_content or not doc.metadata or doc.page_content.strip() == "" or doc.metadata =={}:
+            if not self._is_storable(doc):
                 print(f"Skipping doc with empty content or metadata: {doc}")
                 continue
-            uuids.append(deterministic_id(doc.page_content, doc.metadata))
+            stored_docs.append(doc)
+            uuids.append(self._chunk_id(doc))
             document_texts.append(doc.page_content)
-            metadatas.append(doc.metadata)
+            metadatas.append(self._stored_metadata(doc))
 
         if len(document_texts) != len(metadatas)  or len(uuids) != len(metadatas) or len(uuids) != len(document_texts):
             raise ValueError("DBClient: documents and metadatas length mismatch before add")
 
-        try:
-            self.collection.add(documents=document_texts,metadatas=metadatas,ids=uuids)
-        except Exception as e:
-            print(f"Error adding documents to DB: {e}")
-            uuids = [str(uuid.uuid4()) for _ in range(len(document_texts))]
-            self.collection.add(documents=document_texts,metadatas=metadatas,ids=uuids)
+        self.collection.upsert(documents=document_texts,metadatas=metadatas,ids=uuids)
+        self._index_sections(uuids,stored_docs)
+        self.ingest_stats["written"] += len(uuids)
+
+    def _embed_texts(self,texts:list[str])->list:
+        return self.embedding_function(texts)
+
+    def _count_tokens(self,texts:list[str])->list[int]:
+        """Token counts of @texts as the embedding backend counts them"""
+        return self.embedding_backend.count_tokens(texts)
+
+    def _write_embedded_docs(self,docs:list[Document],embeddings:list):
+        """Upserts @docs with precomputed @embeddings, so chroma does not embed them again"""
+        ids = [self._chunk_id(doc) for doc in docs]
+        self.collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            documents=[doc.page_content for doc in docs],
+            metadatas=[self._stored_metadata(doc) for doc in docs],
+        )
+        self._index_sections(ids,docs)
+        self.ingest_stats["written"] += len(docs)
+
+    def _index_sections(self,ids:list[str],docs:list[Document]):
+        if self.section_index is not None:
+            self.section_index.add(ids,[doc.metadata for doc in docs])
 
     def _safe_add_docs(self,docs:list[Document],batch_num:int|str,attempt:int=1,max_attempts:int=3):
+        """@docs: a batch that already fits the embedding request limits, see packEmbeddingBatches"""
         if not docs or len(docs) == 0:
             print(f"Batch {batch_num} is empty — skipping.")
             return
-
-        total_tokens = sum(getTokenCount(d.page_content,model_name=self.embedding_model_name) for d in docs)
-        MAX_TOKENS_ALLOWED = 8191
-
-        if total_tokens > MAX_TOKENS_ALLOWED and len(docs) > 1:
-            print(f"Batch {batch_num} is too large")
-            mid = len(docs) //2
-            self._safe_add_docs(docs[:mid],batch_num=f"{batch_num}a")
-            self._safe_add_docs(docs[mid:],batch_num=f"{batch_num}b")
-            return
-        elif total_tokens > MAX_TOKENS_ALLOWED:
-            print(f"\n\n **Batch {batch_num} has a single document that is too large to add to the DB. Skipping document.")
-            return
         try:
             self._add_doc_list_to_db(docs)
             print(f"just added batch {batch_num}")
@@ -83,68 +186,251 @@ class DBClient:
             else:
                 print(f"Failed batch {batch_num} after {max_attempts} attempts.")
                 raise e
-    
+
+    def _pack_docs_into_batches(self,docs:list[Document])->list[EmbeddingBatch]:
+        """Tokenizes every doc once and packs them into request sized batches. Docs too large to embed are reported and dropped."""
+        token_counts = self._count_tokens([doc.page_content for doc in docs])
+        backend = self.embedding_backend
+        batches, oversized = packEmbeddingBatches(docs,token_counts,max_tokens_per_batch=backend.max_tokens_per_batch,max_items_per_batch=backend.max_items_per_batch,max_tokens_per_item=backend.max_tokens_per_item)
+        for doc in oversized:
+            print(f"\n\n **Document from {doc.metadata.get('source')} section {doc.metadata.get('section')} is too large to add to the DB. Skipping document.")
+        self.ingest_stats["skipped_oversized"] += len(oversized)
+        return batches
+
     def add_docs_to_db(self,docs:list[Document]):
-        batch_size = 1000
-        i=1
-        while (i-1) * batch_size < len(docs):
-            print(f" ****** \n\n number of chunks is {len(docs)} and we are on batch {i}. \n\n")
-            self._safe_add_docs(docs[(i-1)*batch_size:i*batch_size],batch_num=i,max_attempts=3)
-            i+=1
-        print(f"added {len(docs)} documents to the database")
-
-    def _get_embedding_model_function(self,embedding_model_name:str):
-        """Returns the embedding function for the given model name. Currently only supports OpenAI models."""
-        return OpenAIEmbeddingFunction(model_name=embedding_model_name,api_key=config["API_KEY"])
-    
-    def __init__(self,embedding_model_name:str="text-embedding-3-large",collection_name:str=SPEC_COLL_NAME,db_dir_path:str=config["CHROMA_DIR"]):
+        num_docs = len(docs)
+        docs = self._filter_new_docs(docs)
+        print(f"{num_docs - len(docs)} of {num_docs} chunks are empty or already stored, embedding the remaining {len(docs)}")
+        batches = self._pack_docs_into_batches(docs)
+        for i,batch in enumerate(batches,start=1):
+            print(f" ****** \n\n number of chunks is {len(docs)} and we are on batch {i} of {len(batches)} ({batch.num_tokens} tokens). \n\n")
+            self._safe_add_docs(batch.docs,batch_num=i,max_attempts=3)
+        print(f"added {len(docs)} documents to the database. Totals so far: {self.ingest_stats}")
+
+    def __init__(self,embedding_model_name:str|None=None,collection_name:str=SPEC_COLL_NAME,db_dir_path:str=config["CHROMA_DIR"],embedding_backend:str=EMBEDDING_BACKEND,embedding_dimension:int|None=None):
+        """@embedding_backend: name of a registered backend in EmbeddingBackends, e.g. "openai" or "onnx" for local CPU embeddings.
+        @embedding_model_name: model of that backend. None picks the backend's default model.
+        The backend is recorded on collections this client creates, and opening a collection built by a different backend raises EmbeddingBackendMismatchError.
+        New collections are normalized (document level metadata in a DocumentTable) if NORMALIZE_DOCUMENT_METADATA is set, existing ones keep their layout."""
         #construct chroma base db     
         self.chroma_client = chromadb.PersistentClient(path=db_dir_path)
-        self.embedding_model_name = embedding_model_name
-        embeddings = self._get_embedding_model_function(embedding_model_name)
-        self.collection = self.chroma_client.get_or_create_collection(name=collection_name, embedding_function=embeddings)
+        self.db_dir_path = db_dir_path
+        self.collection_name = collection_name
+        # running counts of what add_docs_to_db did with the chunks it was given
+        self.ingest_stats = {"written":0,"skipped_existing":0,"skipped_empty":0,"skipped_oversized":0}
+        self.embedding_backend = get_embedding_backend(embedding_backend,model_name=embedding_model_name,dimension=embedding_dimension)
+        self.embedding_model_name = self.embedding_backend.model_name
+        self.embedding_function = self.embedding_backend.embedding_function
+        if collection_name in self.chroma_client.list_collections():
+            # get_or_create_collection would overwrite the record of an existing collection with ours
+            self.collection = self.chroma_client.get_collection(name=collection_name, embedding_function=self.embedding_function)
+            check_collection_embedding_record(self.collection.metadata,self.embedding_backend)
+        else:
+            self.collection = self.chroma_client.create_collection(name=collection_name, embedding_function=self.embedding_function, metadata=self.embedding_backend.describe())
+            if NORMALIZE_DOCUMENT_METADATA or DocumentTable.is_normalized(db_dir_path,collection_name):
+                # a collection of the same name may have been normalized before it was deleted
+                DocumentTable(db_dir_path,collection_name).set_normalized(NORMALIZE_DOCUMENT_METADATA)
+            # the collection starts empty, so its section index is complete from the start
+            SectionIndex(db_dir_path,collection_name).set_complete()
+        self.document_table = DocumentTable(db_dir_path,collection_name) if DocumentTable.is_normalized(db_dir_path,collection_name) else None
+        # None for collections created before the index existed, until they are backfilled with `python SectionIndex.py`
+        self.section_index = SectionIndex(db_dir_path,collection_name) if SectionIndex.is_complete(db_dir_path,collection_name) else None
 
-    def updateDBFromFileList(self,new_file_list:list[str],metadata_func:Callable[[str,str],dict]=addExtraDocumentWideMetadataForReason,doc_dir:str=config["DOC_DIR"],requested_chunking_type: RequestedChunkingType=RequestedChunkingType.SECTION):
+    def updateDBFromFileList(self,new_file_list:list[str],metadata_func:Callable[[str,str],dict]|None=None,doc_dir:str=config["DOC_DIR"],requested_chunking_type: RequestedChunkingType=RequestedChunkingType.SECTION,incremental:bool=True,dry_run:bool=False)->"IngestionPlan|None":
         """@new_file_list: list(str) list of file names (not abs paths)
         Turn the new files in DOC_DIR into a list of documents and add them
-        to the vector store."""
-        new_docs = self.getDocsFromFilePath(new_file_list,metadata_func=metadata_func,doc_dir=doc_dir,requested_chunking_type=requested_chunking_type)
-        self.add_docs_to_db(new_docs)
+        to the vector store. Files go through the streaming IngestionPipeline, so chunks of the first files
+        are embedded and stored while later files are still being parsed.
+        @incremental: if True, the ingestion manifest of the collection is used to skip files that were already ingested unchanged,
+        and the chunks of changed or removed files are deleted before the new ones are added.
+        @dry_run: only work out and return the IngestionPlan, nothing is chunked, embedded or deleted."""
+        from IngestionManifest import IngestionManifest
+        from IngestionPipeline import IngestionPipeline
+        metadata_func = _metadata_func_or_default(metadata_func)
+        paths = [os.path.abspath(os.path.join(doc_dir,file)) for file in new_file_list]
+        if not incremental:
+            IngestionPipeline(self).run(self._iter_parsed_files(paths,requested_chunking_type,metadata_func))
+            return None
+
+        manifest = IngestionManifest(self.db_dir_path,self.collection_name)
+        plan = manifest.plan(paths,requested_chunking_type.value,doc_dir)
+        print(f"Ingestion plan for {self.collection_name}: {plan}")
+        if dry_run:
+            return plan
+
+        for path in plan.changed + plan.removed:
+            stale_ids = manifest.chunk_ids(path)
+            if stale_ids:
+                self.delFromDB(ids=stale_ids)
+            print(f"removed {len(stale_ids)} stale chunks of {path}")
+        for path in plan.removed:
+            manifest.remove(path)
+        manifest.save()
+
+        files_to_ingest = plan.files_to_ingest()
+        if not files_to_ingest:
+            print("Nothing new to ingest")
+            return plan
+
+        def record_file(path:str,chunk_ids:list[str]):
+            # called from the pipeline's writer thread as soon as all chunks of a file are stored
+            manifest.record(path,requested_chunking_type.value,chunk_ids)
+            manifest.save_if_due()
+        try:
+            IngestionPipeline(self).run(self._iter_parsed_files(files_to_ingest,requested_chunking_type,metadata_func),on_file_done=record_file)
+        finally:
+            # files stored before a failure stay recorded
+            manifest.save()
+        return plan
+
+    def updateDBFromDocxStream(self,named_contents,metadata_func:Callable[[str,str],dict]|None=None,requested_chunking_type:RequestedChunkingType=RequestedChunkingType.SECTION,on_file_done:Callable[[str,list[str]],None]|None=None):
+        """Ingests docx files held in memory, e.g. fetched by AutoFetcher.runIntoDB.
+        @named_contents: iterable of (docx file name, docx bytes). It is consumed lazily, so chunks of the first files are stored
+        while later ones are still being produced. The ingestion manifest is not used since there are no files on disk.
+        @on_file_done: called with (name, chunk_ids) once every chunk of a docx is stored."""
+        from MetadataAwareChunker import iter_chunks_of_docx_contents
+        from IngestionPipeline import IngestionPipeline, MAX_FILES_IN_FLIGHT
+        metadata_func = _metadata_func_or_default(metadata_func)
+        parsed_files = ((name,chunks[requested_chunking_type]) for name,chunks in iter_chunks_of_docx_contents(named_contents,[requested_chunking_type],metadata_func,max_in_flight=MAX_FILES_IN_FLIGHT))
+        return IngestionPipeline(self).run(parsed_files,on_file_done=on_file_done)
+
+    def _iter_parsed_files(self,paths:list[str],requested_chunking_type:RequestedChunkingType,metadata_func:Callable[[str,str],dict]):
+        """(path, chunks) pairs for the pipeline. Parsing runs in worker processes and the metadata LLM calls on a separate
+        thread pool, with at most MAX_FILES_IN_FLIGHT files between the two."""
+        from MetadataAwareChunker import iter_chunks_of_files
+        from IngestionPipeline import MAX_FILES_IN_FLIGHT
+        for path,chunks in iter_chunks_of_files(paths,[requested_chunking_type],metadata_func,max_in_flight=MAX_FILES_IN_FLIGHT):
+            yield path, chunks[requested_chunking_type]
+
+    def delFromDB(self,filter:dict|None=None,ids:list[str]|None=None):
+        """Delete all documents from the DB that match the given filter and/or ids.
+        @filter: metadata filter to apply to the deletion. Follow chroma syntax for filtering at https://docs.trychroma.com/docs/querying-collections/metadata-filtering
+        @ids: chunk ids to delete"""
+        filter = self._where(filter)
+        if ids is None:
+            track_deleted = self.section_index is not None or self.document_table is not None
+            candidate_ids = self.collection.get(where=filter or None,include=[])['ids'] if track_deleted else []
+        else:
+            candidate_ids = ids
+        doc_keys = self._get_doc_keys(candidate_ids) if self.document_table is not None else set()
+        if ids is None:
+            self.collection.delete(where=filter)
+        else:
+            for i in range(0,len(ids),DELETE_BATCH_SIZE):
+                self.collection.delete(ids=ids[i:i+DELETE_BATCH_SIZE],where=filter)
+        if self.section_index is not None and candidate_ids:
+            # a filter may have spared some of the candidates, only the chunks that are gone leave the index
+            remaining = self._get_existing_ids(candidate_ids)
+            self.section_index.remove([chunk_id for chunk_id in candidate_ids if chunk_id not in remaining])
+        if doc_keys:
+            # a document stays in the table as long as any chunk, of this or an earlier ingestion, refers to it
+            self.document_table.remove([doc_key for doc_key in doc_keys if not self.collection.get(where={DOC_KEY_FIELD:doc_key},limit=1,include=[])['ids']])
 
-    def delFromDB(self,filter):
-        """Delete all documents from the DB that match the given filter.
-        @filter: metadata filter to apply to the deletion. Follow chroma syntax for filtering at https://docs.trychroma.com/docs/querying-collections/metadata-filtering"""
-        self.collection.delete(where=filter)
+    def known_documents(self)->dict[str,str]:
+        """docID -> title of the documents in the collection, read from the document table and section index without scanning the chunks.
+        Empty if the collection has neither."""
+        documents = {}
+        if self.section_index is not None:
+            documents.update(dict.fromkeys(self.section_index.doc_ids(),""))
+        if self.document_table is not None:
+            self.document_table.refresh()
+            for fields in self.document_table.fields_by_key.values():
+                if isinstance(fields.get("docID"),str):
+                    documents[fields["docID"]] = fields.get("title") or documents.get(fields["docID"],"")
+        return documents
 
-    def queryDB(self,query_text:str,k:int,filter:dict={})->list[Document]:
+    def embedding_key(self)->tuple:
+        """Identifies the embedding space of the collection. Clients with the same key can share query vectors."""
+        return (self.embedding_backend.name,self.embedding_backend.model_name,self.embedding_backend.dimension)
+
+    def embed_query(self,query_text:str):
+        """Embedding of @query_text in this collection's embedding space, from the process wide query embedding LRU if it is there"""
+        return query_embedding_cache.get_or_embed((*self.embedding_key(),query_text),lambda: self.embedding_function([query_text])[0])
+
+    def queryDB(self,query_text:str,k:int,filter:dict={},query_embedding=None)->list[Document]:
         """k is how many docs to retrieve, query_text is what we query with.
-        @filter: metadata filter to apply to the query. Follow chroma syntax for filtering at https://docs.trychroma.com/docs/querying-collections/metadata-filtering"""
+        @filter: metadata filter to apply to the query. Follow chroma syntax for filtering at https://docs.trychroma.com/docs/querying-collections/metadata-filtering
+        @query_embedding: precomputed embedding of @query_text (see `embed_query`). If None, it is looked up or computed here."""
+        if query_embedding is None:
+            query_embedding = self.embed_query(query_text)
         if filter == {}:
-            db_resp = self.collection.query(query_texts=[query_text],n_results=k)
+            db_resp = self.collection.query(query_embeddings=[query_embedding],n_results=k)
         else:
-            db_resp = self.collection.query(query_texts=[query_text],n_results=k,where=filter)
+            db_resp = self.collection.query(query_embeddings=[query_embedding],n_results=k,where=self._where(filter))
 
         docs = []
         for doc,meta in zip(db_resp['documents'][0],db_resp['metadatas'][0]):
-            docs.append(Document(page_content=doc,metadata=meta))
+            docs.append(Document(page_content=doc,metadata=self._loaded_metadata(meta)))
         return docs
 
-    def queryDBWithScores(self,query_text:str,k:int,filter:dict={}) -> dict:
+    def queryDBWithScores(self,query_text:str,k:int,filter:dict={},query_embedding=None) -> dict:
         """Queries the DB with the given list of query_texts and returns the results along with their scores.
-        @filter: metadata filter to apply to the query. Follow chroma syntax for filtering at https://docs.trychroma.com/docs/querying-collections/metadata-filtering"""
+        @filter: metadata filter to apply to the query. Follow chroma syntax for filtering at https://docs.trychroma.com/docs/querying-collections/metadata-filtering
+        @query_embedding: precomputed embedding of @query_text, see `queryDB`"""
+        if query_embedding is None:
+            query_embedding = self.embed_query(query_text)
         if filter == {}:
-            db_resp = self.collection.query(query_texts=[query_text],n_results=k,include=["documents", "metadatas", "distances"])
+            db_resp = self.collection.query(query_embeddings=[query_embedding],n_results=k,include=["documents", "metadatas", "distances"])
         else:
-            db_resp = self.collection.query(query_texts=[query_text],n_results=k,where=filter,include=["documents", "metadatas", "distances"])
+            db_resp = self.collection.query(query_embeddings=[query_embedding],n_results=k,where=self._where(filter),include=["documents", "metadatas", "distances"])
+        if self.document_table is not None:
+            db_resp['metadatas'] = [[self._loaded_metadata(meta) for meta in metas] for metas in db_resp['metadatas']]
         return db_resp
     
+    def querySections(self,query_text:str,k:int,doc_sections:list[tuple[str,str]],filter:dict|None=None,query_embedding=None)->list[Document]:
+        """The k chunks most similar to @query_text among the chunks of the given sections and the chunks matching @filter.
+        @doc_sections: (docID, section) pairs. With a complete section index their chunks are fetched by id, otherwise they are searched
+        for with a filter like any other.
+        @filter: chroma where filter for what the index cannot resolve, e.g. references to a section of an unknown document.
+        All candidates are ranked together by cosine similarity to @query_embedding (see `queryDB`)."""
+        if query_embedding is None:
+            query_embedding = self.embed_query(query_text)
+        doc_sections = list(dict.fromkeys(doc_sections))
+        candidate_ids = []
+        conditions = [filter] if filter else []
+        if self.section_index is not None:
+            # a pair missing from a complete index has no chunks, a filtered search would not find any either
+            for chunk_ids in self.section_index.lookup(doc_sections).values():
+                candidate_ids.extend(chunk_ids)
+        else:
+            sections_by_doc: dict[str,list[str]] = {}
+            for docID,section in doc_sections:
+                sections_by_doc.setdefault(docID,[]).append(section)
+            conditions.extend({'$and':[{'docID':{"$eq":docID}},{'section':{"$in":sections}}]} for docID,sections in sections_by_doc.items())
+
+        ids, texts, metadatas, embeddings = [], [], [], []
+        for i in range(0,len(candidate_ids),ID_LOOKUP_BATCH_SIZE):
+            db_resp = self.collection.get(ids=candidate_ids[i:i+ID_LOOKUP_BATCH_SIZE],include=["documents","metadatas","embeddings"])
+            ids.extend(db_resp['ids'])
+            texts.extend(db_resp['documents'])
+            metadatas.extend(db_resp['metadatas'])
+            embeddings.extend(db_resp['embeddings'])
+        if conditions:
+            where = conditions[0] if len(conditions) == 1 else {'$or':conditions}
+            db_resp = self.collection.query(query_embeddings=[query_embedding],n_results=k,where=self._where(where),include=["documents","metadatas","embeddings"])
+            seen = set(ids)
+            for chunk_id,text,metadata,embedding in zip(db_resp['ids'][0],db_resp['documents'][0],db_resp['metadatas'][0],db_resp['embeddings'][0]):
+                if chunk_id not in seen:
+                    ids.append(chunk_id)
+                    texts.append(text)
+                    metadatas.append(metadata)
+                    embeddings.append(embedding)
+        if not ids:
+            return []
+
+        candidates = np.asarray(embeddings,dtype=np.float32)
+        query = np.asarray(query_embedding,dtype=np.float32)
+        similarities = candidates @ query / np.maximum(np.linalg.norm(candidates,axis=1) * np.linalg.norm(query),1e-12)
+        top = np.argsort(-similarities,kind="stable")[:k]
+        return [Document(page_content=texts[i],metadata=self._loaded_metadata(metadatas[i])) for i in top]
+
     def getAllDocsFromDB(self)->list[Document]:
         """Returns all documents in the DB as a list of Document objects."""
         db_resp = self.collection.get(include=["documents", "metadatas"])
         docs = []
 
         for doc,meta in zip(db_resp['documents'],db_resp['metadatas']):
-            docs.append(Document(page_content=doc,metadata=meta))
+            docs.append(Document(page_content=doc,metadata=self._loaded_metadata(meta)))
         return docs
 
     
@@ -0,0 +1,225 @@
+import os
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import subprocess
+from settings import config
+
+# .doc -> .docx conversion with a pool of headless LibreOffice workers.
+# Starting LibreOffice is what a conversion costs, not the conversion itself, so each worker keeps one soffice instance
+# alive for the whole run and is fed files from a shared queue. Every worker has its own user profile, since instances
+# sharing a profile hand their work to whichever one started first.
+# If the LibreOffice python bindings (uno) are importable, workers drive their instance over a pipe. Otherwise each file is
+# converted with `soffice --convert-to`, which still runs in parallel and reuses the worker's already initialised profile.
+
+SOFFICE_PATH = config.get("SOFFICE_PATH", "soffice")
+DOC_CONVERSION_WORKERS = config.get("DOC_CONVERSION_WORKERS", min(4, os.cpu_count() or 1))
+# seconds a single file may take before its worker is restarted
+DOC_CONVERSION_TIMEOUT = config.get("DOC_CONVERSION_TIMEOUT", 300)
+SOFFICE_START_TIMEOUT = 60
+DOCX_FILTER_NAME = "MS Word 2007 XML"
+
+class ConversionResult:
+    """@status: "converted", "skipped" (the .docx is already newer than the .doc) or "failed" """
+    def __init__(self,src:str,dest:str,status:str,seconds:float=0.0,error:str|None=None):
+        self.src = src
+        self.dest = dest
+        self.status = status
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self):
+        return f'ConversionResult({os.path.basename(self.src)}, {self.status}, {self.seconds:.2f}s)'
+
+def docx_path_for(src:str,output_dir:str)->str:
+    return os.path.join(output_dir,os.path.splitext(os.path.basename(src))[0] + ".docx")
+
+def is_up_to_date(src:str,dest:str)->bool:
+    return os.path.exists(dest) and os.path.getmtime(dest) >= os.path.getmtime(src)
+
+class CliLibreOfficeWorker:
+    """Converts one file per `soffice --convert-to` call, with a profile of its own"""
+    def __init__(self,profile_dir:str,timeout:float=DOC_CONVERSION_TIMEOUT):
+        self.profile_dir = profile_dir
+        self.timeout = timeout
+
+    def start(self):
+        pass
+
+    def convert(self,src:str,output_dir:str)->str:
+        subprocess.run(
+            [SOFFICE_PATH,f"-env:UserInstallation=file://{self.profile_dir}","--headless","--norestore","--convert-to","docx","--outdir",output_dir,src],
+            check=True,capture_output=True,timeout=self.timeout,
+        )
+        dest = docx_path_for(src,output_dir)
+        if not os.path.exists(dest):
+            raise RuntimeError(f"soffice did not produce {dest}")
+        return dest
+
+    def close(self):
+        pass
+
+class UnoLibreOfficeWorker:
+    """Keeps one soffice instance running and converts files through it over a named pipe"""
+    def __init__(self,profile_dir:str,timeout:float=DOC_CONVERSION_TIMEOUT):
+        self.profile_dir = profile_dir
+        self.timeout = timeout
+        self.pipe_name = f"deepspecs_conv_{os.getpid()}_{os.path.basename(profile_dir)}"
+        self.process = None
+        self.desktop = None
+
+    def start(self):
+        import uno
+        from com.sun.star.connection import NoConnectException
+        self.process = subprocess.Popen(
+            [SOFFICE_PATH,f"-env:UserInstallation=file://{self.profile_dir}","--headless","--invisible","--nologo","--norestore","--nodefault",
+             f"--accept=pipe,name={self.pipe_name};urp;StarOffice.ComponentContext"],
+            stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,
+        )
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver",local_ctx)
+        deadline = time.time() + SOFFICE_START_TIMEOUT
+        while True:
+            try:
+                ctx = resolver.resolve(f"uno:pipe,name={self.pipe_name};urp;StarOffice.ComponentContext")
+                break
+            except NoConnectException:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.close()
+                    raise RuntimeError(f"soffice with profile {self.profile_dir} did not start")
+                time.sleep(0.5)
+        self.desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop",ctx)
+
+    @staticmethod
+    def _props(**kwargs):
+        from com.sun.star.beans import PropertyValue
+        props = []
+        for name,value in kwargs.items():
+            prop = PropertyValue()
+            prop.Name = name
+            prop.Value = value
+            props.append(prop)
+        return tuple(props)
+
+    def convert(self,src:str,output_dir:str)->str:
+        import uno
+        dest = docx_path_for(src,output_dir)
+        # a hung instance is killed, which makes the pending uno call raise
+        watchdog = threading.Timer(self.timeout,self.process.kill)
+        watchdog.start()
+        try:
+            doc = self.desktop.loadComponentFromURL(uno.systemPathToFileUrl(os.path.abspath(src)),"_blank",0,self._props(Hidden=True,ReadOnly=True))
+            if doc is None:
+                raise RuntimeError(f"LibreOffice could not open {src}")
+            try:
+                doc.storeToURL(uno.systemPathToFileUrl(os.path.abspath(dest)),self._props(FilterName=DOCX_FILTER_NAME,Overwrite=True))
+            finally:
+                doc.close(True)
+        finally:
+            watchdog.cancel()
+        return dest
+
+    def close(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+def _uno_available()->bool:
+    try:
+        import uno # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+class DocConversionPool:
+    """Use as a context manager so the soffice instances are shut down:
+        with DocConversionPool(num_workers=4) as pool:
+            results = pool.convert_files(paths,output_dir)"""
+    def __init__(self,num_workers:int=DOC_CONVERSION_WORKERS,timeout:float=DOC_CONVERSION_TIMEOUT,use_uno:bool|None=None):
+        """@use_uno: drive persistent instances over uno. None uses uno whenever it is importable."""
+        if shutil.which(SOFFICE_PATH) is None and not os.path.exists(SOFFICE_PATH):
+            raise FileNotFoundError(f"LibreOffice executable {SOFFICE_PATH} not found, set SOFFICE_PATH in settings.yml")
+        self.num_workers = max(1,num_workers)
+        self.timeout = timeout
+        self.worker_class = UnoLibreOfficeWorker if (_uno_available() if use_uno is None else use_uno) else CliLibreOfficeWorker
+        self._profiles_root = None
+
+    def __enter__(self):
+        self._profiles_root = tempfile.mkdtemp(prefix="deepspecs_soffice_")
+        return self
+
+    def __exit__(self,*exc):
+        if self._profiles_root is not None:
+            shutil.rmtree(self._profiles_root,ignore_errors=True)
+            self._profiles_root = None
+
+    def convert_files(self,paths:list[str],output_dir:str,remove_source:bool=False)->list[ConversionResult]:
+        """Converts every .doc in @paths to a .docx in @output_dir. Files whose .docx is already newer are skipped.
+        @remove_source: delete each .doc once its .docx exists. Sources of failed conversions are kept.
+        Returns: one ConversionResult per path, in the order of @paths"""
+        if self._profiles_root is None:
+            with self:
+                return self.convert_files(paths,output_dir,remove_source=remove_source)
+        os.makedirs(output_dir,exist_ok=True)
+        results: dict[str,ConversionResult] = {}
+        todo = queue.Queue()
+        for src in paths:
+            dest = docx_path_for(src,output_dir)
+            if is_up_to_date(src,dest):
+                results[src] = ConversionResult(src,dest,"skipped")
+            else:
+                todo.put(src)
+
+        num_workers = min(self.num_workers,todo.qsize())
+        threads = [threading.Thread(target=self._run_worker,args=(i,todo,output_dir,results),daemon=True) for i in range(num_workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ordered = [results[src] for src in paths]
+        if remove_source:
+            for result in ordered:
+                if result.status != "failed" and os.path.exists(result.src):
+                    os.remove(result.src)
+        counts = {status: sum(1 for r in ordered if r.status == status) for status in ("converted","skipped","failed")}
+        print(f"converted {len(paths)} files with {num_workers} {self.worker_class.__name__}s in {time.time() - start:.1f}s: {counts}")
+        return ordered
+
+    def _run_worker(self,index:int,todo:queue.Queue,output_dir:str,results:dict[str,ConversionResult]):
+        profile_dir = os.path.join(self._profiles_root,f"profile_{index}")
+        worker = None
+        while True:
+            try:
+                src = todo.get_nowait()
+            except queue.Empty:
+                break
+            start = time.time()
+            try:
+                if worker is None:
+                    worker = self.worker_class(profile_dir,timeout=self.timeout)
+                    worker.start()
+                dest = worker.convert(src,output_dir)
+                results[src] = ConversionResult(src,dest,"converted",time.time() - start)
+                print(f"converted {os.path.basename(src)} in {time.time() - start:.2f}s")
+            except Exception as e:
+                results[src] = ConversionResult(src,docx_path_for(src,output_dir),"failed",time.time() - start,error=str(e))
+                print(f"failed to convert {os.path.basename(src)}: {e}")
+                # the instance may be wedged, start a fresh one for the next file
+                if worker is not None:
+                    worker.close()
+                    worker = None
+        if worker is not None:
+            worker.close()
@@ -0,0 +1,148 @@
+import re
+import time
+import threading
+from collections.abc import Callable, Mapping
+from utils import getDocIDFromText
+from ReferenceExtractor import HANDLED_DOCID_REGX, BARE_DOCID_REGX, docIDOfMatch
+from settings import config
+
+# Deterministic docID extraction for questions, in place of the getDocIDFromText LLM call on every request.
+# Recognizes "TS 38.331", "TR 38.912", "3GPP 38331", "ts 38.300v17", bare "38.331" (the docID regexes of ReferenceExtractor)
+# and spec names such as "RRC spec" or "MAC specification".
+# Aliases come from SPEC_NAME_ALIASES and from acronyms that appear in the title of exactly one document of the collections,
+# e.g. "(SDAP)" in "NR; Service Data Adaptation Protocol (SDAP) specification". A name is only taken as a spec when a word like
+# "spec" or "protocol" follows it, so "RRC spec" names 38.331 but "RRC reestablishment" names nothing.
+# The LLM is only asked when the result is ambiguous: a bare xx.yyy number that is not the docID of any known document.
+# Known documents are read again when a question names an unknown one, so documents ingested after start are picked up.
+
+# a bare number after these words is a clause or table, not a spec
+NOT_A_DOCID_PREFIX_REGX = re.compile(r"(?:clause|subclause|section|table|figure|annex|step)\s*$",re.IGNORECASE)
+SPEC_WORDS = r"(?:spec|specs|specification|specifications|standard|protocol|TS)"
+TITLE_ACRONYM_REGX = re.compile(r"\(([A-Z][A-Za-z0-9\-]{1,9})\)")
+# acronyms that name a radio access technology or a node, not a spec
+NOT_AN_ALIAS = {"nr","e-utra","e-utran","ng-ran","utra","utran","ue","gnb","enb","5gs","5gc","eps","lte"}
+DOCID_LLM_FALLBACK = config.get("DOCID_LLM_FALLBACK", True)
+# least time between two reads of the known documents
+DOCID_KNOWN_DOCUMENTS_REFRESH_SECONDS = config.get("DOCID_KNOWN_DOCUMENTS_REFRESH_SECONDS", 60)
+
+# spec names people use in questions. A bare protocol name means the NR spec, "LTE ..." the E-UTRA one.
+SPEC_NAME_ALIASES: dict[str,str] = {
+    "rrc": "38.331",
+    "nr rrc": "38.331",
+    "lte rrc": "36.331",
+    "mac": "38.321",
+    "nr mac": "38.321",
+    "lte mac": "36.321",
+    "rlc": "38.322",
+    "lte rlc": "36.322",
+    "pdcp": "38.323",
+    "lte pdcp": "36.323",
+    "sdap": "37.324",
+    "nas": "24.501",
+    "5g nas": "24.501",
+    "5gs nas": "24.501",
+    "eps nas": "24.301",
+    "lte nas": "24.301",
+    "ngap": "38.413",
+    "xnap": "38.423",
+    "f1ap": "38.473",
+    "e1ap": "37.483",
+    "s1ap": "36.413",
+    "x2ap": "36.423",
+    "idle mode": "38.304",
+    "physical layer procedures for data": "38.214",
+    "physical layer procedures for control": "38.213",
+    "physical channels and modulation": "38.211",
+    "multiplexing and channel coding": "38.212",
+    "stage 2": "38.300",
+    "radio resource management": "38.133",
+}
+
+class DocIDExtractor:
+    def __init__(self,known_documents:Mapping[str,str]|Callable[[],Mapping[str,str]]|None=None,aliases:Mapping[str,str]=SPEC_NAME_ALIASES,llm_fallback:bool=DOCID_LLM_FALLBACK,refresh_seconds:float=DOCID_KNOWN_DOCUMENTS_REFRESH_SECONDS):
+        """@known_documents: docID -> title of every document in the collections, or a function that reads it (see DBClient.known_documents).
+        A function is called again, at most every @refresh_seconds, when a question names a docID that is not known. If empty,
+        any well formed docID is accepted and aliases are not checked against the collections.
+        @llm_fallback: ask getDocIDFromText when the regex result is ambiguous. Otherwise the ambiguous parts are dropped."""
+        self._load_known_documents = known_documents if callable(known_documents) else None
+        self.listed_aliases = aliases
+        self.refresh_seconds = refresh_seconds
+        self.llm_fallback = llm_fallback
+        self.llm_calls = 0
+        self._refresh_lock = threading.Lock()
+        self._loaded_at = time.monotonic()
+        self._build(self._load_known_documents() if self._load_known_documents is not None else known_documents)
+
+    def _build(self,known_documents:Mapping[str,str]|None):
+        known_documents = dict(known_documents or {})
+        # the listed names win over title acronyms
+        aliases = self._title_aliases(known_documents)
+        aliases.update({name.lower():docID for name,docID in self.listed_aliases.items() if not known_documents or docID in known_documents})
+        names = sorted(aliases,key=len,reverse=True)
+        alias_regx = re.compile(r"\b(" + "|".join(re.escape(name) for name in names) + r")\s+" + SPEC_WORDS + r"\b",re.IGNORECASE) if names else None
+        # swapped in one go, since requests read them concurrently
+        self.known_documents, self.aliases, self.alias_regx = known_documents, aliases, alias_regx
+
+    def refresh(self)->bool:
+        """Reads the known documents again, unless that happened less than refresh_seconds ago. Returns: whether they changed"""
+        if self._load_known_documents is None or time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return False
+        with self._refresh_lock:
+            if time.monotonic() - self._loaded_at < self.refresh_seconds:
+                return False
+            self._loaded_at = time.monotonic()
+            known_documents = dict(self._load_known_documents())
+            if known_documents == self.known_documents:
+                return False
+            self._build(known_documents)
+            return True
+
+    def _is_known(self,docID:str)->bool:
+        return not self.known_documents or docID in self.known_documents
+
+    @staticmethod
+    def _title_aliases(known_documents:Mapping[str,str])->dict[str,str]:
+        """Acronyms in parentheses that occur in the title of a single document"""
+        docIDs_by_acronym: dict[str,set[str]] = {}
+        for docID,title in known_documents.items():
+            for acronym in TITLE_ACRONYM_REGX.findall(title or ""):
+                docIDs_by_acronym.setdefault(acronym.lower(),set()).add(docID)
+        return {acronym:docIDs.pop() for acronym,docIDs in docIDs_by_acronym.items() if len(docIDs) == 1 and acronym not in NOT_AN_ALIAS}
+
+    def extract(self,text:str)->tuple[list[str],bool]:
+        """Returns: (docIDs found in @text without duplicates, whether anything in @text was ambiguous)"""
+        found: dict[str,None] = {}
+        ambiguous = False
+        spans = []
+        for match in HANDLED_DOCID_REGX.finditer(text):
+            found[docIDOfMatch(match)] = None
+            spans.append(match.span())
+        bare_docIDs = []
+        for match in BARE_DOCID_REGX.finditer(text):
+            if any(start <= match.start() < end for start,end in spans) or NOT_A_DOCID_PREFIX_REGX.search(text[max(0,match.start()-20):match.start()]):
+                continue
+            bare_docIDs.append(docIDOfMatch(match))
+        if any(not self._is_known(docID) for docID in bare_docIDs):
+            # may be a document ingested since the known documents were read
+            self.refresh()
+        for docID in bare_docIDs:
+            if self._is_known(docID):
+                found[docID] = None
+            else:
+                ambiguous = True
+        alias_regx, aliases = self.alias_regx, self.aliases
+        if alias_regx is not None:
+            for match in alias_regx.finditer(text):
+                found[aliases[match.group(1).lower()]] = None
+        return list(found), ambiguous
+
+    def getDocIDs(self,text:str)->list[str]:
+        """docIDs named in @text. getDocIDFromText is only called if the regex result is ambiguous."""
+        docIDs, ambiguous = self.extract(text)
+        if ambiguous and self.llm_fallback:
+            self.llm_calls += 1
+            return getDocIDFromText(text)
+        return docIDs
+
+    def __repr__(self):
+        return f'DocIDExtractor(known_documents={len(self.known_documents)}, aliases={len(self.aliases)}, llm_calls={self.llm_calls})'
@@ -0,0 +1,220 @@
+import os
+import json
+import sqlite3
+import threading
+from contextlib import closing
+from collections.abc import Mapping
+from utils import DOCUMENT_LEVEL_METADATA_KEYS, deterministic_id
+
+# Document level metadata (source, docID, version, release, timestamp, author, title, subject) is the same for every chunk of a file.
+# In a normalized collection it is stored once per document in a sqlite table next to chroma.sqlite3, and the chroma metadata of a
+# chunk only holds the key of its document and its chunk level fields (the section). DBClient joins the two back together when it
+# reads chunks, and rewrites where filters on document level fields into a filter on the document key, so callers see no difference.
+# Which collections are normalized is recorded in the same sqlite file (chroma does not allow changing the metadata of some
+# collections after they are created). Collections created before this keep the full metadata on every chunk until they are
+# converted with MigrateToDocumentTable.py.
+
+DOCUMENT_TABLE_FILENAME = "document_table.sqlite3"
+DOC_KEY_FIELD = "doc_key"
+# chroma rejects an empty $in, so a condition no document satisfies becomes $in of this key, which no chunk has
+NO_DOCUMENT_KEY = "none"
+
+def _compare(op:str,value,operand)->bool:
+    try:
+        match op:
+            case "$eq":
+                return value == operand
+            case "$ne":
+                return value != operand
+            case "$gt":
+                return value > operand
+            case "$gte":
+                return value >= operand
+            case "$lt":
+                return value < operand
+            case "$lte":
+                return value <= operand
+            case "$in":
+                return value in operand
+            case "$nin":
+                return value not in operand
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported where operator {op}")
+
+def split_metadata(metadata:Mapping)->tuple[dict,dict]:
+    """Returns: (document level fields, chunk level fields) of a chunk's metadata"""
+    doc_fields, chunk_fields = {}, {}
+    for key,value in metadata.items():
+        (doc_fields if key in DOCUMENT_LEVEL_METADATA_KEYS else chunk_fields)[key] = value
+    return doc_fields, chunk_fields
+
+class DocumentTable:
+    def __init__(self,db_dir_path:str,collection_name:str):
+        self.path = os.path.join(db_dir_path,DOCUMENT_TABLE_FILENAME)
+        self.collection_name = collection_name
+        os.makedirs(db_dir_path,exist_ok=True)
+        self._conn = sqlite3.connect(self.path,check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS documents (collection TEXT NOT NULL, doc_key TEXT NOT NULL, fields TEXT NOT NULL, PRIMARY KEY (collection, doc_key))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS normalized_collections (collection TEXT PRIMARY KEY)")
+            # bumped with every change to the documents of a collection, so other processes know when to reload them
+            self._conn.execute("CREATE TABLE IF NOT EXISTS generations (collection TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+        # there is one row per document, not per chunk, so the whole table of a collection is kept in memory
+        self.fields_by_key: dict[str,dict] = {}
+        # field -> value -> keys of the documents with that value, for $eq and $in filters
+        self._keys_by_value: dict[str,dict] = {}
+        # generation the cache was loaded at, -1 before the first load
+        self._generation = -1
+        self.refresh()
+
+    def _stored_generation(self)->int:
+        row = self._conn.execute("SELECT generation FROM generations WHERE collection = ?",(self.collection_name,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump_generation(self):
+        """Call inside the transaction that changed the documents. Keeps the cache current if no other process wrote in between."""
+        self._conn.execute("INSERT INTO generations (collection, generation) VALUES (?, 1) ON CONFLICT(collection) DO UPDATE SET generation = generation + 1",(self.collection_name,))
+        generation = self._stored_generation()
+        if generation == self._generation + 1:
+            self._generation = generation
+
+    def refresh(self):
+        """Picks up documents registered or removed by other processes, e.g. an ingestion run next to a running server"""
+        with self._lock:
+            generation = self._stored_generation()
+            if generation == self._generation:
+                return
+            stored = dict(self._conn.execute("SELECT doc_key, fields FROM documents WHERE collection = ?",(self.collection_name,)))
+            for doc_key in [doc_key for doc_key in self.fields_by_key if doc_key not in stored]:
+                self._uncache(doc_key)
+            for doc_key,fields in stored.items():
+                if doc_key not in self.fields_by_key:
+                    self._cache(doc_key,json.loads(fields))
+            self._generation = generation
+
+    def _load(self,doc_key:str):
+        """Reads a single document the cache does not have yet"""
+        with self._lock:
+            row = self._conn.execute("SELECT fields FROM documents WHERE collection = ? AND doc_key = ?",(self.collection_name,doc_key)).fetchone()
+            if row is not None and doc_key not in self.fields_by_key:
+                self._cache(doc_key,json.loads(row[0]))
+
+    @staticmethod
+    def is_normalized(db_dir_path:str,collection_name:str)->bool:
+        """Whether the chunks of the collection refer to the document table. Does not create the sqlite file."""
+        path = os.path.join(db_dir_path,DOCUMENT_TABLE_FILENAME)
+        if not os.path.exists(path):
+            return False
+        with closing(sqlite3.connect(path)) as conn:
+            try:
+                row = conn.execute("SELECT 1 FROM normalized_collections WHERE collection = ?",(collection_name,)).fetchone()
+            except sqlite3.OperationalError:
+                return False
+        return row is not None
+
+    def set_normalized(self,normalized:bool=True):
+        with self._lock, self._conn:
+            if normalized:
+                self._conn.execute("INSERT OR IGNORE INTO normalized_collections (collection) VALUES (?)",(self.collection_name,))
+            else:
+                self._conn.execute("DELETE FROM normalized_collections WHERE collection = ?",(self.collection_name,))
+
+    def _cache(self,doc_key:str,fields:dict):
+        self.fields_by_key[doc_key] = fields
+        for field,value in fields.items():
+            try:
+                self._keys_by_value.setdefault(field,{}).setdefault(value,set()).add(doc_key)
+            except TypeError:
+                pass
+
+    def _uncache(self,doc_key:str):
+        for field,value in self.fields_by_key.pop(doc_key,{}).items():
+            try:
+                self._keys_by_value.get(field,{}).get(value,set()).discard(doc_key)
+            except TypeError:
+                pass
+
+    def register(self,doc_fields:dict)->str:
+        """Stores @doc_fields if they are new. Returns: the key of the document"""
+        doc_key = deterministic_id("",doc_fields)
+        if doc_key in self.fields_by_key:
+            return doc_key
+        with self._lock:
+            if doc_key not in self.fields_by_key:
+                with self._conn:
+                    inserted = self._conn.execute("INSERT OR IGNORE INTO documents (collection, doc_key, fields) VALUES (?, ?, ?)",(self.collection_name,doc_key,json.dumps(doc_fields))).rowcount
+                    if inserted:
+                        self._bump_generation()
+                self._cache(doc_key,dict(doc_fields))
+        return doc_key
+
+    def remove(self,doc_keys:list[str]):
+        """Drops documents that no chunk refers to any more"""
+        if not doc_keys:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("DELETE FROM documents WHERE collection = ? AND doc_key = ?",[(self.collection_name,doc_key) for doc_key in doc_keys])
+                self._bump_generation()
+            for doc_key in doc_keys:
+                self._uncache(doc_key)
+
+    def normalize(self,metadata:Mapping)->dict:
+        """What gets stored in chroma for a chunk with @metadata: its document key and its chunk level fields"""
+        doc_fields, chunk_fields = split_metadata(metadata)
+        if not doc_fields:
+            return chunk_fields
+        return {DOC_KEY_FIELD:self.register(doc_fields),**chunk_fields}
+
+    def expand(self,stored:dict|None)->dict|None:
+        """Inverse of `normalize`: the full metadata of a chunk read back from chroma. Chunks without a document key are returned as they are."""
+        if not stored or DOC_KEY_FIELD not in stored:
+            return stored
+        if stored[DOC_KEY_FIELD] not in self.fields_by_key:
+            # registered by another process, maybe after the last refresh
+            self.refresh()
+            if stored[DOC_KEY_FIELD] not in self.fields_by_key:
+                self._load(stored[DOC_KEY_FIELD])
+        doc_fields = self.fields_by_key.get(stored[DOC_KEY_FIELD],{})
+        return {**doc_fields,**{key: value for key,value in stored.items() if key != DOC_KEY_FIELD}}
+
+    def _matching_keys(self,field:str,condition)->list[str]:
+        if not isinstance(condition,dict):
+            condition = {"$eq":condition}
+        matching = None
+        for op,operand in condition.items():
+            values = self._keys_by_value.get(field,{})
+            if op == "$eq":
+                keys = set(values.get(operand,()))
+            elif op == "$in":
+                keys = set().union(*(values.get(value,()) for value in operand))
+            else:
+                keys = {doc_key for doc_key,fields in self.fields_by_key.items() if field in fields and _compare(op,fields[field],operand)}
+            matching = keys if matching is None else matching & keys
+        return sorted(matching or ())
+
+    def rewrite_filter(self,where:dict|None)->dict|None:
+        """Rewrites the conditions on document level fields in a chroma where filter into conditions on the document key"""
+        if not where:
+            return where
+        self.refresh()
+        return self._rewrite(where)
+
+    def _rewrite(self,where:dict)->dict:
+        conditions = []
+        for key,condition in where.items():
+            if key in ("$and","$or"):
+                conditions.append({key:[self._rewrite(sub_filter) for sub_filter in condition]})
+            elif key in DOCUMENT_LEVEL_METADATA_KEYS:
+                conditions.append({DOC_KEY_FIELD:{"$in":self._matching_keys(key,condition) or [NO_DOCUMENT_KEY]}})
+            else:
+                conditions.append({key:condition})
+        return conditions[0] if len(conditions) == 1 else {"$and":conditions}
+
+    def __len__(self)->int:
+        return len(self.fields_by_key)
+
+    def __repr__(self):
+        return f'DocumentTable(collection={self.collection_name}, num_documents={len(self)})'
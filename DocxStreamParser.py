@@ -0,0 +1,383 @@
+import re
+from io import BytesIO
+from zipfile import ZipFile, BadZipFile
+from collections.abc import Iterator
+from lxml import etree
+
+# Streaming reader for .docx files.
+# python-docx builds the object model of the whole document (styles included) before we can read a single paragraph.
+# For the larger specs that is several hundred MB per worker, so here we read word/document.xml with lxml iterparse instead,
+# handle one body element at a time and free it as soon as its text has been pulled out.
+# Text extraction mirrors python-docx (Paragraph.text, _Cell.text, _Row.cells) so chunks (and their ids) stay the same.
+
+BASE_SECTION_NAME = "N/A"
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+
+def _w(tag:str)->str:
+    return f"{{{W_NS}}}{tag}"
+
+W_BODY = _w("body")
+W_P = _w("p")
+W_TBL = _w("tbl")
+W_TR = _w("tr")
+W_TC = _w("tc")
+W_R = _w("r")
+W_HYPERLINK = _w("hyperlink")
+W_VAL = _w("val")
+W_TYPE = _w("type")
+
+DOCUMENT_PART = "word/document.xml"
+STYLES_PART = "word/styles.xml"
+CORE_PROPERTIES_PART = "docProps/core.xml"
+
+# run children that contribute text, see python-docx CT_R.text
+W_T = _w("t")
+W_BR = _w("br")
+W_CR = _w("cr")
+W_NO_BREAK_HYPHEN = _w("noBreakHyphen")
+_RUN_TEXT_TAGS = {W_T, _w("tab"), W_BR, W_CR, W_NO_BREAK_HYPHEN, _w("ptab")}
+
+# python-docx reports these built-in style names in title case (see docx.styles.BabelFish)
+_UI_HEADING_NAMES = {f"heading {level}": f"Heading {level}" for level in range(1, 10)}
+
+class DocxParseError(Exception):
+    pass
+
+def _open_zip(source)->ZipFile:
+    """@source: path to a docx file, or a binary file-like object holding one"""
+    try:
+        return ZipFile(source,'r')
+    except (BadZipFile, OSError) as e:
+        raise DocxParseError(f"for document {source} cannot parse with Docx") from e
+
+def _run_text(run)->str:
+    text = []
+    for child in run:
+        tag = child.tag
+        if tag not in _RUN_TEXT_TAGS:
+            continue
+        if tag == W_T:
+            text.append(child.text or "")
+        elif tag == W_BR:
+            # only line breaks produce text, page and column breaks do not
+            if child.get(W_TYPE,"textWrapping") == "textWrapping":
+                text.append("\n")
+        elif tag == W_NO_BREAK_HYPHEN:
+            text.append("-")
+        elif tag == W_CR:
+            text.append("\n")
+        else:
+            text.append("\t")
+    return "".join(text)
+
+def paragraph_text(p)->str:
+    """Text of a w:p element. Only direct runs and runs inside hyperlinks count, like python-docx"""
+    text = []
+    for child in p:
+        if child.tag == W_R:
+            text.append(_run_text(child))
+        elif child.tag == W_HYPERLINK:
+            for run in child.iterchildren(W_R):
+                text.append(_run_text(run))
+    return "".join(text)
+
+def paragraph_style_id(p)->str|None:
+    pPr = p.find(_w("pPr"))
+    if pPr is None:
+        return None
+    pStyle = pPr.find(_w("pStyle"))
+    if pStyle is None:
+        return None
+    return pStyle.get(W_VAL)
+
+def _cell_text(tc)->str:
+    return "\n".join(paragraph_text(p) for p in tc.iterchildren(W_P))
+
+def _grid_span(tc)->int:
+    tcPr = tc.find(_w("tcPr"))
+    if tcPr is None:
+        return 1
+    gridSpan = tcPr.find(_w("gridSpan"))
+    if gridSpan is None:
+        return 1
+    return int(gridSpan.get(W_VAL,1))
+
+def _is_vmerge_continue(tc)->bool:
+    tcPr = tc.find(_w("tcPr"))
+    if tcPr is None:
+        return False
+    vMerge = tcPr.find(_w("vMerge"))
+    return vMerge is not None and vMerge.get(W_VAL,"continue") == "continue"
+
+def _grid_before(tr)->int:
+    trPr = tr.find(_w("trPr"))
+    if trPr is None:
+        return 0
+    gridBefore = trPr.find(_w("gridBefore"))
+    if gridBefore is None:
+        return 0
+    return int(gridBefore.get(W_VAL,0))
+
+def table_rows(tbl)->Iterator[list[str]]:
+    """Yields the cell texts of every row of a w:tbl element.
+    Horizontally merged cells are repeated once per grid column they span and vertically merged cells repeat the text of the cell
+    that starts the merge, like python-docx's _Row.cells.
+    Cells that hold nested tables are left out, matching what the python-docx based chunker produced."""
+    above:dict[int,tuple[str|None,int]] = {}
+    for tr in tbl.iterchildren(W_TR):
+        current:dict[int,tuple[str|None,int]] = {}
+        row = []
+        grid_offset = _grid_before(tr)
+        for tc in tr.iterchildren(W_TC):
+            if _is_vmerge_continue(tc) and grid_offset in above:
+                text,span = above[grid_offset]
+            else:
+                span = _grid_span(tc)
+                text = None if tc.find(W_TBL) is not None else _cell_text(tc)
+            current[grid_offset] = (text,span)
+            if text is not None:
+                row.extend([text] * span)
+            grid_offset += span
+        above = current
+        yield row
+
+def table_cell_texts(tbl)->Iterator[str]:
+    """Yields the text of every cell of a w:tbl element, row by row. See `table_rows`"""
+    for row in table_rows(tbl):
+        yield from row
+
+class HeadingStyles:
+    """Paragraph style ids of a docx, used to tell heading paragraphs apart without loading python-docx.
+    Resolution follows python-docx: a missing or unknown style id falls back to the default paragraph style."""
+    def __init__(self,heading_levels:dict[str,int],paragraph_ids:set[str],default_style_id:str|None):
+        self.heading_levels = heading_levels
+        self.paragraph_ids = paragraph_ids
+        self.default_style_id = default_style_id
+
+    def _resolve(self,style_id:str|None)->str|None:
+        if style_id is None or style_id not in self.paragraph_ids:
+            return self.default_style_id
+        return style_id
+
+    def is_heading(self,style_id:str|None)->bool:
+        return self._resolve(style_id) in self.heading_levels
+
+    def heading_level(self,style_id:str|None)->int:
+        """Outline level of a heading style, 0 if the style is not a heading"""
+        return self.heading_levels.get(self._resolve(style_id),0)
+
+def read_heading_styles(zf:ZipFile)->HeadingStyles:
+    """Reads the styles part and collects the ids of the paragraph styles python-docx would name 'Heading ...'"""
+    heading_levels, paragraph_ids = {}, set()
+    default_style_id = None
+    if STYLES_PART not in zf.namelist():
+        return HeadingStyles(heading_levels,paragraph_ids,default_style_id)
+    with zf.open(STYLES_PART) as f:
+        styles = etree.parse(f).getroot()
+    for style in styles.iterchildren(_w("style")):
+        if style.get(_w("type")) != "paragraph":
+            continue
+        style_id = style.get(_w("styleId"))
+        paragraph_ids.add(style_id)
+        if style.get(_w("default")) in ("1","true","on"):
+            default_style_id = style_id
+        name_el = style.find(_w("name"))
+        name = name_el.get(W_VAL) if name_el is not None else None
+        if name is None:
+            continue
+        name = _UI_HEADING_NAMES.get(name,name)
+        if name.startswith("Heading"):
+            level = name[len("Heading"):].strip()
+            heading_levels[style_id] = int(level) if level.isdigit() else 1
+    return HeadingStyles(heading_levels,paragraph_ids,default_style_id)
+
+def read_core_properties(source)->dict:
+    """Pulls the author, title and subject core properties out of a docx file without parsing the document body.
+    @source: path or binary file-like object"""
+    with _open_zip(source) as zf:
+        if CORE_PROPERTIES_PART not in zf.namelist():
+            # python-docx fills in a default core properties part when the file has none
+            return {'author':'','title':'Word Document','subject':''}
+        with zf.open(CORE_PROPERTIES_PART) as f:
+            core = etree.parse(f).getroot()
+    def _text(tag):
+        el = core.find(tag)
+        return el.text if el is not None and el.text else ""
+    return {'author':_text(f"{{{DC_NS}}}creator"),'title':_text(f"{{{DC_NS}}}title"),'subject':_text(f"{{{DC_NS}}}subject")}
+
+def iter_body_elements(zf:ZipFile)->Iterator:
+    """Yields the top level w:p and w:tbl elements of the document body in order.
+    Each element is cleared, along with everything before it, once the caller moves on to the next one."""
+    with zf.open(DOCUMENT_PART) as f:
+        yield from _iter_body_elements_of(f)
+
+def _iter_body_elements_of(f)->Iterator:
+    """See `iter_body_elements`. @f: file-like object holding a document.xml"""
+    for _, elem in etree.iterparse(f,events=("end",),tag=(W_P,W_TBL),huge_tree=True):
+        parent = elem.getparent()
+        if parent is None or parent.tag != W_BODY:
+            # paragraphs inside tables are read when their table ends
+            continue
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def _iter_section_parts(body_elements:Iterator,heading_styles:HeadingStyles)->Iterator[tuple[str,list[str]]]:
+    current_section_title = BASE_SECTION_NAME
+    current_section_parts = []
+    for elem in body_elements:
+        if elem.tag == W_TBL:
+            current_section_parts.extend(table_cell_texts(elem))
+            continue
+        if heading_styles.is_heading(paragraph_style_id(elem)):
+            yield current_section_title, current_section_parts
+            current_section_parts = []
+            current_section_title = paragraph_text(elem)
+        else:
+            current_section_parts.append(paragraph_text(elem))
+    yield current_section_title, current_section_parts
+
+def iter_docx_section_parts(source)->Iterator[tuple[str,list[str]]]:
+    """@source: path to a docx file, or a binary file-like object holding one.
+    Yields (section_title, parts) one section at a time, where parts are the paragraph and table cell texts of the section.
+    The first section is always BASE_SECTION_NAME, the text before the first heading, even if it is empty."""
+    with _open_zip(source) as zf:
+        try:
+            heading_styles = read_heading_styles(zf)
+            yield from _iter_section_parts(iter_body_elements(zf),heading_styles)
+        except (KeyError, etree.XMLSyntaxError) as e:
+            raise DocxParseError(f"for document {source} cannot parse with Docx") from e
+
+def iter_docx_sections(source)->Iterator[tuple[str,str]]:
+    """@source: path to a docx file, or a binary file-like object holding one.
+    Yields (section_title, text) one section at a time. Peak memory is bounded by the largest section, not the document."""
+    for section_title, parts in iter_docx_section_parts(source):
+        yield section_title, "".join(parts)
+
+def iter_docx_paragraph_texts(source)->Iterator[str]:
+    """Yields the text of every top level paragraph in the body, skipping tables (python-docx's doc.paragraphs)"""
+    with _open_zip(source) as zf:
+        for elem in iter_body_elements(zf):
+            if elem.tag == W_P:
+                yield paragraph_text(elem)
+
+########################
+## Body ranges        ##
+########################
+# A large document.xml can be cut into byte ranges at body level headings and each range parsed on its own, in parallel.
+# Finding the cut points only needs a scan for the block level tags, not a full parse. Word always writes the main
+# namespace with the "w" prefix; a document that does not is simply never cut.
+_BODY_OPEN_REGX = re.compile(rb"<w:body\b[^>]*>")
+_BODY_CLOSE = b"</w:body>"
+_BODY_SUFFIX = b"</w:body></w:document>"
+# elements that can hold paragraphs of their own, so a w:p inside one of them is not a body level paragraph
+_BLOCK_TAG_REGX = re.compile(rb"<(/?)w:(p|tbl|sdt|customXml)\b[^>]*?(/?)>")
+_PSTYLE_REGX = re.compile(rb'<w:pStyle\s+w:val="([^"]*)"')
+_PPR_CLOSE = b"</w:pPr>"
+_P_CLOSE = b"</w:p>"
+
+class DocumentBody:
+    """document.xml of a docx split into the part before the body content (root and w:body start tags) and the body content"""
+    def __init__(self,document_xml:bytes):
+        body_open = _BODY_OPEN_REGX.search(document_xml)
+        body_close = document_xml.rfind(_BODY_CLOSE)
+        if body_open is None or body_close == -1:
+            raise DocxParseError("document.xml has no w:body")
+        self.document_xml = document_xml
+        self.head = document_xml[:body_open.end()]
+        self.start = body_open.end()
+        self.end = body_close
+
+    def heading_offsets(self,heading_styles:HeadingStyles,level:int=1)->list[int]:
+        """Byte offsets of the body level paragraphs whose style is a heading of @level"""
+        xml = self.document_xml
+        offsets = []
+        depth = 0
+        for match in _BLOCK_TAG_REGX.finditer(xml,self.start,self.end):
+            closing, tag, self_closing = match.groups()
+            if closing:
+                depth -= 1
+                continue
+            if depth == 0 and tag == b"p":
+                style_id = None
+                if not self_closing:
+                    # the style sits in the paragraph properties, which come before any run
+                    ppr_close = xml.find(_PPR_CLOSE,match.end(),self.end)
+                    p_close = xml.find(_P_CLOSE,match.end(),self.end)
+                    if ppr_close != -1 and (p_close == -1 or ppr_close < p_close):
+                        pstyle = _PSTYLE_REGX.search(xml,match.end(),ppr_close)
+                        if pstyle is not None:
+                            style_id = pstyle.group(1).decode("utf-8")
+                if heading_styles.heading_level(style_id) == level:
+                    offsets.append(match.start())
+            if not self_closing:
+                depth += 1
+        return offsets
+
+    def ranges(self,cut_offsets:list[int],min_range_bytes:int)->list[tuple[int,int]]:
+        """(start, end) byte ranges covering the whole body, cut at @cut_offsets. Ranges are merged until they are at least @min_range_bytes."""
+        ranges = []
+        start = self.start
+        for offset in cut_offsets:
+            if offset - start >= min_range_bytes and self.end - offset >= min_range_bytes:
+                ranges.append((start,offset))
+                start = offset
+        ranges.append((start,self.end))
+        return ranges
+
+    def range_xml(self,start:int,end:int)->bytes:
+        """A standalone document.xml holding only the body content in [start, end)"""
+        return self.head + self.document_xml[start:end] + _BODY_SUFFIX
+
+def read_document_body(zf:ZipFile)->DocumentBody:
+    return DocumentBody(zf.read(DOCUMENT_PART))
+
+def iter_body_range_section_parts(range_xml:bytes,heading_styles:HeadingStyles)->Iterator[tuple[str,list[str]]]:
+    """Like `iter_docx_section_parts`, for a document.xml made by `DocumentBody.range_xml`.
+    A range that starts at a heading yields an empty BASE_SECTION_NAME section first."""
+    try:
+        yield from _iter_section_parts(_iter_body_elements_of(BytesIO(range_xml)),heading_styles)
+    except etree.XMLSyntaxError as e:
+        raise DocxParseError("cannot parse body range") from e
+
+def read_docx_header_markdown(source,max_chars:int,max_blocks:int|None=None)->str:
+    """Renders the start of a docx as markdown without converting the whole file.
+    Paragraphs and tables are streamed out of the zip and rendering stops as soon as @max_chars characters
+    (or @max_blocks paragraphs and tables) have been produced. Headings become '#' lines and tables become markdown tables.
+    @source: path to a docx file, or a binary file-like object holding one.
+    Returns: at most @max_chars characters of markdown."""
+    blocks = []
+    num_chars = 0
+    with _open_zip(source) as zf:
+        try:
+            heading_styles = read_heading_styles(zf)
+            for elem in iter_body_elements(zf):
+                if elem.tag == W_TBL:
+                    block = _table_to_markdown(elem)
+                else:
+                    text = paragraph_text(elem).strip()
+                    level = heading_styles.heading_level(paragraph_style_id(elem))
+                    block = f"{'#' * level} {text}" if level and text else text
+                if not block:
+                    continue
+                blocks.append(block)
+                num_chars += len(block) + 2
+                if num_chars >= max_chars or (max_blocks is not None and len(blocks) >= max_blocks):
+                    break
+        except (KeyError, etree.XMLSyntaxError) as e:
+            raise DocxParseError(f"for document {source} cannot parse with Docx") from e
+    return "\n\n".join(blocks)[:max_chars]
+
+def _table_to_markdown(tbl)->str:
+    lines = []
+    for row in table_rows(tbl):
+        if not row:
+            continue
+        cells = [cell.replace("\n"," ").replace("|","\\|").strip() for cell in row]
+        lines.append("| " + " | ".join(cells) + " |")
+        if len(lines) == 1:
+            lines.append("| " + " | ".join("---" for _ in cells) + " |")
+    return "\n".join(lines)
@@ -0,0 +1,200 @@
+import os
+from abc import ABC, abstractmethod
+import numpy as np
+from chromadb import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
+from utils import getTokenCounts
+from EmbeddingBatcher import MAX_TOKENS_PER_ITEM, MAX_TOKENS_PER_BATCH, MAX_ITEMS_PER_BATCH
+from settings import config
+
+# Registry of the embedding backends a DBClient can use.
+# A backend bundles the chroma embedding function with what the ingestion side needs to batch for it (token counting and request limits).
+# The backend, model and dimension that built a collection are recorded in the collection metadata, and a DBClient refuses to open
+# a collection with a different backend, since vectors from two embedding spaces cannot be compared.
+
+EMBEDDING_BACKEND = config.get("EMBEDDING_BACKEND", "openai")
+
+# collection metadata keys
+EMBEDDING_BACKEND_KEY = "embedding_backend"
+EMBEDDING_MODEL_KEY = "embedding_model"
+EMBEDDING_DIMENSION_KEY = "embedding_dimension"
+
+# collections created before backends were recorded were all built with this
+LEGACY_EMBEDDING_RECORD = {EMBEDDING_BACKEND_KEY:"openai",EMBEDDING_MODEL_KEY:"text-embedding-3-large",EMBEDDING_DIMENSION_KEY:3072}
+
+class EmbeddingBackendMismatchError(ValueError):
+    pass
+
+class EmbeddingBackend(ABC):
+    """Base class of the registered backends.
+    @model_name: model of the backend to embed with. None picks the backend's default.
+    @dimension: size of the vectors stored. None keeps the model's native size."""
+    name = None
+    default_model_name = None
+    max_tokens_per_item = MAX_TOKENS_PER_ITEM
+    max_tokens_per_batch = MAX_TOKENS_PER_BATCH
+    max_items_per_batch = MAX_ITEMS_PER_BATCH
+
+    def __init__(self,model_name:str|None=None,dimension:int|None=None):
+        self.model_name = model_name or self.default_model_name
+        self.dimension = dimension
+        self.embedding_function = None
+
+    @abstractmethod
+    def count_tokens(self,texts:list[str])->list[int]:
+        """Tokens of each text as the backend's model counts them, for batching under its request limits"""
+
+    def describe(self)->dict:
+        """What gets recorded in the metadata of the collections this backend builds"""
+        record = {EMBEDDING_BACKEND_KEY:self.name,EMBEDDING_MODEL_KEY:self.model_name}
+        if self.dimension is not None:
+            record[EMBEDDING_DIMENSION_KEY] = self.dimension
+        return record
+
+    def __repr__(self):
+        return f'{type(self).__name__}(model_name={self.model_name}, dimension={self.dimension})'
+
+EMBEDDING_BACKENDS: dict[str,type[EmbeddingBackend]] = {}
+
+def register_embedding_backend(cls:type[EmbeddingBackend])->type[EmbeddingBackend]:
+    EMBEDDING_BACKENDS[cls.name] = cls
+    return cls
+
+def get_embedding_backend(name:str=EMBEDDING_BACKEND,model_name:str|None=None,dimension:int|None=None)->EmbeddingBackend:
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {name}, expected one of {list(EMBEDDING_BACKENDS)}")
+    return EMBEDDING_BACKENDS[name](model_name=model_name,dimension=dimension)
+
+def check_collection_embedding_record(collection_metadata:dict|None,backend:EmbeddingBackend):
+    """Raises EmbeddingBackendMismatchError if the collection was built by a different backend, model or dimension than @backend"""
+    collection_metadata = collection_metadata or {}
+    if EMBEDDING_BACKEND_KEY in collection_metadata:
+        recorded = {key: collection_metadata.get(key) for key in LEGACY_EMBEDDING_RECORD}
+    else:
+        recorded = LEGACY_EMBEDDING_RECORD
+    expected = backend.describe()
+    for key,value in expected.items():
+        if recorded.get(key) is not None and recorded[key] != value:
+            raise EmbeddingBackendMismatchError(f"collection was embedded with {recorded} but the client uses {expected}. Open it with the same embedding backend or re-ingest it into a new collection.")
+
+####################
+## OpenAI         ##
+####################
+# native output size of the OpenAI models, used when no dimension is requested
+OPENAI_MODEL_DIMENSIONS = {"text-embedding-3-large":3072,"text-embedding-3-small":1536,"text-embedding-ada-002":1536}
+
+@register_embedding_backend
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    name = "openai"
+    default_model_name = "text-embedding-3-large"
+
+    def __init__(self,model_name:str|None=None,dimension:int|None=None):
+        super().__init__(model_name=model_name,dimension=dimension)
+        self.embedding_function = OpenAIEmbeddingFunction(model_name=self.model_name,api_key=config["API_KEY"],dimensions=dimension)
+        if self.dimension is None:
+            self.dimension = OPENAI_MODEL_DIMENSIONS.get(self.model_name)
+
+    def count_tokens(self,texts:list[str])->list[int]:
+        return getTokenCounts(texts,model_name=self.model_name)
+
+####################
+## Local (ONNX)   ##
+####################
+# directory holding one folder per local model, each with a model.onnx and the tokenizer.json of the model
+LOCAL_EMBEDDING_MODEL_DIR = config.get("LOCAL_EMBEDDING_MODEL_DIR", "models")
+# 0 lets onnxruntime use every core
+LOCAL_EMBEDDING_THREADS = config.get("LOCAL_EMBEDDING_THREADS", 0)
+LOCAL_EMBEDDING_MAX_LENGTH = config.get("LOCAL_EMBEDDING_MAX_LENGTH", 256)
+# upper bound on batch size * padded sequence length of a single onnx run
+LOCAL_EMBEDDING_MAX_PADDED_TOKENS = config.get("LOCAL_EMBEDDING_MAX_PADDED_TOKENS", 16384)
+
+class LocalONNXEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Mean pooled, L2 normalized sentence embeddings from an ONNX transformer, run on the CPU.
+    Texts are sorted by length and cut into runs of similar length, so a run is padded to its own longest text rather than
+    the longest text of the whole call. Texts longer than @max_length tokens are truncated, like sentence-transformers does.
+    @dimension: keep only the first @dimension components of each vector (before normalizing), for models trained to allow it."""
+    def __init__(self,model_dir:str,num_threads:int=LOCAL_EMBEDDING_THREADS,max_length:int=LOCAL_EMBEDDING_MAX_LENGTH,max_padded_tokens:int=LOCAL_EMBEDDING_MAX_PADDED_TOKENS,dimension:int|None=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+        model_path = os.path.join(model_dir,"model.onnx")
+        tokenizer_path = os.path.join(model_dir,"tokenizer.json")
+        for path in (model_path,tokenizer_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"LocalONNXEmbeddingFunction: {path} not found. Put the model.onnx and tokenizer.json of the model in {model_dir}")
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.max_padded_tokens = max_padded_tokens
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path,sess_options=options,providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        native_dimension = self.session.get_outputs()[0].shape[-1]
+        if dimension is not None and isinstance(native_dimension,int) and dimension > native_dimension:
+            raise ValueError(f"LocalONNXEmbeddingFunction: dimension {dimension} is larger than the model's {native_dimension}")
+        self.dimension = dimension or (native_dimension if isinstance(native_dimension,int) else None)
+
+    def count_tokens(self,texts:list[str])->list[int]:
+        """Token counts after truncation, i.e. what the model actually sees"""
+        return [len(encoding.ids) for encoding in self.tokenizer.encode_batch(texts)]
+
+    def _runs(self,lengths:list[int])->list[list[int]]:
+        """Indices of the texts grouped into runs of at most max_padded_tokens padded tokens"""
+        order = sorted(range(len(lengths)),key=lambda i: lengths[i])
+        runs, current = [], []
+        for i in order:
+            # lengths are ascending, so the text being added sets the padded length of the run
+            if current and (len(current) + 1) * lengths[i] > self.max_padded_tokens:
+                runs.append(current)
+                current = []
+            current.append(i)
+        if current:
+            runs.append(current)
+        return runs
+
+    def _embed_run(self,encodings)->np.ndarray:
+        seq_len = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.zeros((len(encodings),seq_len),dtype=np.int64)
+        attention_mask = np.zeros((len(encodings),seq_len),dtype=np.int64)
+        for row,encoding in enumerate(encodings):
+            input_ids[row,:len(encoding.ids)] = encoding.ids
+            attention_mask[row,:len(encoding.ids)] = 1
+        inputs = {"input_ids":input_ids,"attention_mask":attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        token_embeddings = self.session.run(None,inputs)[0]
+        mask = attention_mask[:,:,None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1),1e-9,None)
+        if self.dimension is not None:
+            pooled = pooled[:,:self.dimension]
+        return pooled / np.clip(np.linalg.norm(pooled,axis=1,keepdims=True),1e-12,None)
+
+    def __call__(self,input:Documents)->Embeddings:
+        encodings = self.tokenizer.encode_batch(list(input))
+        embeddings = [None] * len(encodings)
+        for run in self._runs([len(encoding.ids) for encoding in encodings]):
+            for i,vector in zip(run,self._embed_run([encodings[i] for i in run])):
+                embeddings[i] = vector.astype(np.float32)
+        return embeddings
+
+@register_embedding_backend
+class LocalONNXEmbeddingBackend(EmbeddingBackend):
+    """Embeds on the local CPU, no network calls. Chunks longer than the model's max length are truncated rather than skipped."""
+    name = "onnx"
+    default_model_name = "all-MiniLM-L6-v2"
+    max_tokens_per_item = float("inf")
+    # one request is one __call__, which is split into runs again by padded size
+    max_tokens_per_batch = config.get("LOCAL_EMBEDDING_BATCH_MAX_TOKENS", 65536)
+    max_items_per_batch = config.get("LOCAL_EMBEDDING_BATCH_MAX_ITEMS", 1024)
+
+    def __init__(self,model_name:str|None=None,dimension:int|None=None):
+        super().__init__(model_name=model_name,dimension=dimension)
+        self.embedding_function = LocalONNXEmbeddingFunction(os.path.join(LOCAL_EMBEDDING_MODEL_DIR,self.model_name),dimension=dimension)
+        self.dimension = self.embedding_function.dimension
+
+    def count_tokens(self,texts:list[str])->list[int]:
+        return self.embedding_function.count_tokens(texts)
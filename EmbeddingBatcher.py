@@ -0,0 +1,50 @@
+from utils import Document
+from settings import config
+
+# Embedding requests are limited both in number of inputs and in total tokens, and each input has its own token limit.
+# Chunks are tokenized once up front and packed greedily, in order, into batches that fit under all of these limits,
+# instead of cutting fixed size batches and halving them until they fit.
+
+MAX_TOKENS_PER_ITEM = 8191
+# raise these up to what the embedding provider accepts per request
+MAX_TOKENS_PER_BATCH = config.get("EMBEDDING_BATCH_MAX_TOKENS", 8191)
+MAX_ITEMS_PER_BATCH = config.get("EMBEDDING_BATCH_MAX_ITEMS", 1000)
+
+class EmbeddingBatch:
+    def __init__(self):
+        self.docs: list[Document] = []
+        self.num_tokens = 0
+
+    def fits(self,num_tokens:int,max_tokens:int,max_items:int)->bool:
+        return len(self.docs) < max_items and self.num_tokens + num_tokens <= max_tokens
+
+    def add(self,doc:Document,num_tokens:int):
+        self.docs.append(doc)
+        self.num_tokens += num_tokens
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __repr__(self):
+        return f'EmbeddingBatch(num_docs={len(self.docs)}, num_tokens={self.num_tokens})'
+
+def packEmbeddingBatches(docs:list[Document],token_counts:list[int],max_tokens_per_batch:int=MAX_TOKENS_PER_BATCH,max_items_per_batch:int=MAX_ITEMS_PER_BATCH,max_tokens_per_item:int=MAX_TOKENS_PER_ITEM)->tuple[list[EmbeddingBatch],list[Document]]:
+    """@docs: chunks to embed. @token_counts: token count of each doc's page_content, in the same order.
+    Returns: (batches, oversized) where oversized are the docs that cannot be embedded on their own and were left out."""
+    if len(docs) != len(token_counts):
+        raise ValueError("packEmbeddingBatches: docs and token_counts length mismatch")
+    max_tokens_per_item = min(max_tokens_per_item,max_tokens_per_batch)
+    batches = []
+    oversized = []
+    current = EmbeddingBatch()
+    for doc,num_tokens in zip(docs,token_counts):
+        if num_tokens > max_tokens_per_item:
+            oversized.append(doc)
+            continue
+        if not current.fits(num_tokens,max_tokens_per_batch,max_items_per_batch):
+            batches.append(current)
+            current = EmbeddingBatch()
+        current.add(doc,num_tokens)
+    if len(current) > 0:
+        batches.append(current)
+    return batches, oversized
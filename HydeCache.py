@@ -0,0 +1,141 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+import numpy as np
+from settings import config
+
+# Process wide cache of hypothetical documents (see HypotheticalDocGenerator), since the same questions are asked again and again.
+# Two tiers: an exact tier keyed by the normalized question text, and a semantic tier that reuses the hypothetical document of a
+# stored question whose embedding is within HYDE_CACHE_SIMILARITY (cosine) of the new one. A semantic hit also requires both
+# questions to contain the same numbers, so "TS 38.331" and "TS 38.321" or "Release 17" and "Release 18" never share a document.
+# Entries expire after HYDE_CACHE_TTL_SECONDS and the least recently used are dropped beyond HYDE_CACHE_SIZE.
+
+HYDE_CACHE_SIZE = config.get("HYDE_CACHE_SIZE", 512)
+HYDE_CACHE_TTL_SECONDS = config.get("HYDE_CACHE_TTL_SECONDS", 24 * 60 * 60)
+HYDE_CACHE_SIMILARITY = config.get("HYDE_CACHE_SIMILARITY", 0.95)
+
+NUMBER_REGX = re.compile(r"\d+(?:[.\-]\d+)*")
+
+def normalize_question(question:str)->str:
+    """Lower case, single spaces, no trailing punctuation"""
+    return " ".join(question.lower().split()).rstrip(" ?.!")
+
+class _Entry:
+    __slots__ = ("hyp_doc","embedding","numbers","created_at")
+    def __init__(self,hyp_doc:str,embedding,numbers:frozenset,created_at:float):
+        self.hyp_doc = hyp_doc
+        self.embedding = embedding
+        self.numbers = numbers
+        self.created_at = created_at
+
+class HydeCache:
+    def __init__(self,max_entries:int=HYDE_CACHE_SIZE,ttl_seconds:float=HYDE_CACHE_TTL_SECONDS,similarity_threshold:float=HYDE_CACHE_SIMILARITY):
+        """@max_entries: least recently used documents are dropped beyond this. 0 disables the cache.
+        @similarity_threshold: minimum cosine similarity of question embeddings for a semantic hit. Above 1 disables the semantic tier."""
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._entries: OrderedDict[tuple[str,str],_Entry] = OrderedDict()
+        # normalized question embeddings of the entries with embeddings of the last looked up dimension, rebuilt after the entries change
+        self._matrix = None
+        self._matrix_dim = None
+        self._matrix_keys: list[tuple[str,str]] = []
+        self._lock = threading.Lock()
+
+    def _use_semantic_tier(self,embed:Callable[[str],list]|None)->bool:
+        return embed is not None and self.similarity_threshold <= 1
+
+    def _drop(self,key:tuple[str,str]):
+        del self._entries[key]
+        self._matrix = None
+
+    def _drop_expired(self,now:float):
+        # entries are in least recently used order, not creation order, so all of them are checked
+        for key in [key for key,entry in self._entries.items() if now - entry.created_at > self.ttl_seconds]:
+            self._drop(key)
+            self.expired += 1
+
+    def _semantic_match(self,model_name:str,embedding,numbers:frozenset)->_Entry|None:
+        query = np.asarray(embedding,dtype=np.float32)
+        if self._matrix is None or self._matrix_dim != len(query):
+            self._matrix_keys = [key for key,entry in self._entries.items() if entry.embedding is not None and len(entry.embedding) == len(query)]
+            if not self._matrix_keys:
+                return None
+            matrix = np.asarray([self._entries[key].embedding for key in self._matrix_keys],dtype=np.float32)
+            self._matrix = matrix / np.maximum(np.linalg.norm(matrix,axis=1,keepdims=True),1e-12)
+            self._matrix_dim = len(query)
+        similarities = self._matrix @ (query / max(float(np.linalg.norm(query)),1e-12))
+        for i in np.argsort(-similarities):
+            if similarities[i] < self.similarity_threshold:
+                return None
+            key = self._matrix_keys[i]
+            entry = self._entries[key]
+            if key[0] == model_name and entry.numbers == numbers:
+                self._entries.move_to_end(key)
+                return entry
+        return None
+
+    def get_or_generate(self,model_name:str,question:str,generate:Callable[[str],str|None],embed:Callable[[str],list]|None=None)->str|None:
+        """Returns the cached hypothetical document for @question, or calls @generate and caches its result.
+        @embed: embedding function for the semantic tier, e.g. DBClient.embed_query. Without it only exact matches are reused.
+        @generate runs outside the lock and a None result (the LLM call failed) is not cached."""
+        if self.max_entries <= 0:
+            return generate(question)
+        key = (model_name,normalize_question(question))
+        numbers = frozenset(NUMBER_REGX.findall(question))
+        with self._lock:
+            self._drop_expired(time.time())
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return self._entries[key].hyp_doc
+        embedding = embed(question) if self._use_semantic_tier(embed) else None
+        if embedding is not None:
+            with self._lock:
+                entry = self._semantic_match(model_name,embedding,numbers)
+                if entry is not None:
+                    self.semantic_hits += 1
+                    return entry.hyp_doc
+        with self._lock:
+            self.misses += 1
+
+        hyp_doc = generate(question)
+        if hyp_doc is None:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = _Entry(hyp_doc,embedding,numbers,time.time())
+            self._matrix = None
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return hyp_doc
+
+    def stats(self)->dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries":len(self),"exact_hits":self.exact_hits,"semantic_hits":self.semantic_hits,"misses":self.misses,
+            "expired":self.expired,"evictions":self.evictions,
+            "hit_rate":(self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def __len__(self)->int:
+        return len(self._entries)
+
+    def __repr__(self):
+        return f'HydeCache(entries={len(self)}/{self.max_entries}, exact_hits={self.exact_hits}, semantic_hits={self.semantic_hits}, misses={self.misses})'
+
+hyde_cache = HydeCache()
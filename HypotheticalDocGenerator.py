@@ -1,19 +1,31 @@
 from settings import config
 from openai import OpenAI
+from collections.abc import Callable
+from HydeCache import HydeCache, hyde_cache
 import time
 
 MAX_RETRIES = 3
 DELAY = 2
 
 class HypotheticalDocGenerator:
-    def __init__(self, api_key=config["API_KEY"], model_name=config["HYDE_MODEL_NAME"]):
+    def __init__(self, api_key=config["API_KEY"], model_name=config["HYDE_MODEL_NAME"], cache: HydeCache|None=hyde_cache, embed_query: Callable[[str],list]|None=None):
+        """@cache: reuses the documents of questions asked before. None calls the LLM for every question.
+        @embed_query: embeds questions for the cache's semantic tier, e.g. DBClient.embed_query. Without it only exact repeats are reused."""
         self.client = OpenAI(api_key=api_key)
         self.model_name = model_name
+        self.cache = cache
+        self.embed_query = embed_query
     
     def generate_hypothetical_document(self, query: str) -> str:
         """Generates a hypothetical document based on the input query. 
         Sometimes questions dont contain much detail and so are not useful for retrieval.
-        This function uses an LLM to generate a hypothetical document that contains more detail."""
+        This function uses an LLM to generate a hypothetical document that contains more detail.
+        The same or a near identical question asked before gets its cached document back, see HydeCache."""
+        if self.cache is None:
+            return self._generate(query)
+        return self.cache.get_or_generate(self.model_name, query, self._generate, embed=self.embed_query)
+
+    def _generate(self, query: str) -> str:
 
         system_prompt = {
             "role": "system",
@@ -30,6 +42,7 @@ class HypotheticalDocGenerator:
                     model=self.model_name,
                     messages = [system_prompt, user_prompt],
                 )
+                break
             except Exception as e:
                 print(f"Attempt {attempt} failed with error: {e}")
                 if attempt < MAX_RETRIES:
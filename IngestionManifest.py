@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import hashlib
+from settings import config
+
+# Records what has already been ingested into each collection so that re-running a construct script only
+# chunks and embeds files that are new or have changed since the last run.
+# The manifest is a json file that lives in the chroma directory, next to chroma.sqlite3:
+# {collection_name: {abs_path: {size, mtime, sha256, chunking_type, chunk_ids}}}
+
+MANIFEST_FILENAME = "ingestion_manifest.json"
+HASH_BLOCK_SIZE = 1024 * 1024
+# every save rewrites the whole file, so during a run it is saved every so many recorded files or seconds, see `save_if_due`
+MANIFEST_SAVE_EVERY_FILES = config.get("MANIFEST_SAVE_EVERY_FILES", 50)
+MANIFEST_SAVE_EVERY_SECONDS = config.get("MANIFEST_SAVE_EVERY_SECONDS", 30)
+
+def sha256_of_file(path:str)->str:
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class IngestionPlan:
+    """What an incremental ingestion run is going to do. All lists hold absolute paths.
+    @new: files never ingested into the collection.
+    @changed: files whose contents (or requested chunking type) differ from what was ingested. Their old chunks are deleted first.
+    @unchanged: files that are skipped.
+    @removed: files in the manifest under the same doc dir that no longer exist on disk. Their chunks are deleted."""
+    def __init__(self,new:list[str],changed:list[str],unchanged:list[str],removed:list[str]):
+        self.new = new
+        self.changed = changed
+        self.unchanged = unchanged
+        self.removed = removed
+
+    def files_to_ingest(self)->list[str]:
+        return self.new + self.changed
+
+    def __repr__(self):
+        return f'IngestionPlan(new={len(self.new)}, changed={len(self.changed)}, unchanged={len(self.unchanged)}, removed={len(self.removed)})'
+
+class IngestionManifest:
+    def __init__(self,db_dir_path:str,collection_name:str):
+        self.path = os.path.join(db_dir_path,MANIFEST_FILENAME)
+        self.collection_name = collection_name
+        self._all = self._load()
+        self.entries: dict[str,dict] = self._all.setdefault(collection_name,{})
+        # sha256s computed while planning, reused when the file is recorded
+        self._hashes: dict[str,str] = {}
+        self._unsaved_records = 0
+        self._saved_at = time.monotonic()
+
+    def _load(self)->dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path,'r',encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".",exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path,'w',encoding='utf-8') as f:
+            json.dump(self._all,f)
+        os.replace(tmp_path,self.path)
+        self._unsaved_records = 0
+        self._saved_at = time.monotonic()
+
+    def save_if_due(self):
+        """Saves once MANIFEST_SAVE_EVERY_FILES files were recorded or MANIFEST_SAVE_EVERY_SECONDS passed since the last save.
+        A crash loses at most that much, and those files are only chunked and embedded again. Call `save` at the end of a run."""
+        if self._unsaved_records >= MANIFEST_SAVE_EVERY_FILES or time.monotonic() - self._saved_at >= MANIFEST_SAVE_EVERY_SECONDS:
+            self.save()
+
+    def _sha256(self,path:str)->str:
+        if path not in self._hashes:
+            self._hashes[path] = sha256_of_file(path)
+        return self._hashes[path]
+
+    def is_unchanged(self,path:str,chunking_type:str)->bool:
+        entry = self.entries.get(path)
+        if entry is None or entry["chunking_type"] != chunking_type:
+            return False
+        stat = os.stat(path)
+        if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+            return True
+        if stat.st_size != entry["size"]:
+            return False
+        # same size but touched, only the contents can tell
+        if self._sha256(path) == entry["sha256"]:
+            entry["mtime"] = stat.st_mtime
+            return True
+        return False
+
+    def plan(self,paths:list[str],chunking_type:str,doc_dir:str)->IngestionPlan:
+        """@paths: absolute paths of the files we were asked to ingest.
+        @doc_dir: only manifest entries under this directory are considered for removal."""
+        new, changed, unchanged = [], [], []
+        for path in paths:
+            if path not in self.entries:
+                new.append(path)
+            elif self.is_unchanged(path,chunking_type):
+                unchanged.append(path)
+            else:
+                changed.append(path)
+        doc_dir = os.path.abspath(doc_dir)
+        removed = [path for path in self.entries if os.path.dirname(path) == doc_dir and not os.path.exists(path)]
+        return IngestionPlan(new=new,changed=changed,unchanged=unchanged,removed=removed)
+
+    def chunk_ids(self,path:str)->list[str]:
+        return self.entries.get(path,{}).get("chunk_ids",[])
+
+    def record(self,path:str,chunking_type:str,chunk_ids:list[str]):
+        stat = os.stat(path)
+        self.entries[path] = {
+            "size":stat.st_size,
+            "mtime":stat.st_mtime,
+            "sha256":self._sha256(path),
+            "chunking_type":chunking_type,
+            "chunk_ids":chunk_ids,
+        }
+        self._unsaved_records += 1
+
+    def remove(self,path:str):
+        self.entries.pop(path,None)
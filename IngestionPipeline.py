@@ -0,0 +1,234 @@
+import os
+import time
+import queue
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from utils import Document
+from EmbeddingBatcher import EmbeddingBatch
+from settings import config
+
+# Staged ingestion: parse/chunk (MetadataAwareChunker.iter_chunks_of_files) -> embed (bounded thread pool) -> write to chroma (single writer),
+# joined by bounded queues. Chunks reach the DB while later files are still being parsed, and because every queue
+# is bounded a slow stage holds back the ones before it instead of letting chunks pile up in memory.
+#
+#   files --> [parse workers] --chunk_queue--> [batcher] --embed workers--> --write_queue--> [writer] --> chroma
+
+# files parsed (or being parsed) but not yet picked up by the batcher
+MAX_FILES_IN_FLIGHT = config.get("INGEST_MAX_FILES_IN_FLIGHT", 8)
+EMBED_CONCURRENCY = config.get("INGEST_EMBED_CONCURRENCY", 4)
+WRITE_QUEUE_SIZE = config.get("INGEST_WRITE_QUEUE_SIZE", 8)
+# a partly filled batch is sent off if no new chunks arrive for this long
+BATCH_FLUSH_SECONDS = 5
+EMBED_MAX_ATTEMPTS = 3
+
+_DONE = object()
+
+class StageCounters:
+    """Throughput counters of one pipeline stage. `busy_seconds` is the time spent doing work, summed over the stage's workers."""
+    def __init__(self,name:str):
+        self.name = name
+        self.items = 0
+        self.chunks = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self,items:int,chunks:int,seconds:float):
+        with self._lock:
+            self.items += items
+            self.chunks += chunks
+            self.busy_seconds += seconds
+
+    def __repr__(self):
+        rate = self.chunks / self.busy_seconds if self.busy_seconds > 0 else 0.0
+        return f'{self.name}(items={self.items}, chunks={self.chunks}, busy={self.busy_seconds:.1f}s, {rate:.1f} chunks/s)'
+
+class _FileProgress:
+    def __init__(self,chunk_ids:list[str],num_to_write:int):
+        self.chunk_ids = chunk_ids
+        self.num_to_write = num_to_write
+
+class IngestionPipeline:
+    def __init__(self,db,max_files_in_flight:int=MAX_FILES_IN_FLIGHT,embed_concurrency:int=EMBED_CONCURRENCY,write_queue_size:int=WRITE_QUEUE_SIZE):
+        """@db: the DBClient whose collection the chunks are written to.
+        @max_files_in_flight: bound on parsed files whose chunks have not been batched yet.
+        @embed_concurrency: number of embedding requests in flight at once.
+        @write_queue_size: number of embedded batches waiting for the writer."""
+        self.db = db
+        self.max_files_in_flight = max_files_in_flight
+        self.embed_concurrency = embed_concurrency
+        self.chunk_queue: queue.Queue = queue.Queue(maxsize=max_files_in_flight)
+        self.write_queue: queue.Queue = queue.Queue(maxsize=write_queue_size)
+        self.counters = {name: StageCounters(name) for name in ("parse","embed","write")}
+        self._progress: dict[str,_FileProgress] = {}
+        self._progress_lock = threading.Lock()
+        self._error: BaseException|None = None
+        self._on_file_done = None
+
+    def run(self,parsed_files:Iterable[tuple[str,list[Document]]],on_file_done:Callable[[str,list[str]],None]|None=None):
+        """Runs the embed and write stages over (path, chunks) pairs produced by @parsed_files, e.g. `iter_chunks_of_files`.
+        The iterator is consumed on a producer thread, so it may block (on parse workers, LLM calls or downloads) without stalling the later stages.
+        @on_file_done: called with (path, chunk_ids) once every chunk of a file is stored."""
+        self._on_file_done = on_file_done
+        start = time.time()
+        producer = threading.Thread(target=self._produce,args=(parsed_files,),daemon=True)
+        batcher = threading.Thread(target=self._batch_and_embed,daemon=True)
+        writer = threading.Thread(target=self._write,daemon=True)
+        for thread in (producer,batcher,writer):
+            thread.start()
+        for thread in (producer,batcher,writer):
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        print(f"ingestion pipeline finished in {time.time() - start:.1f}s: {list(self.counters.values())}")
+        return self.counters
+
+    def _fail(self,e:BaseException):
+        if self._error is None:
+            self._error = e
+
+    def _put(self,q:queue.Queue,item):
+        """Blocking put that gives up once another stage has failed"""
+        while self._error is None:
+            try:
+                q.put(item,timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    ####################
+    ## Parse stage    ##
+    ####################
+    def _produce(self,parsed_files:Iterable[tuple[str,list[Document]]]):
+        """Feeds (path, chunks) pairs into the chunk queue. Time spent waiting on @parsed_files counts as the parse stage."""
+        parsed_iter = iter(parsed_files)
+        try:
+            while self._error is None:
+                start = time.time()
+                try:
+                    path, docs = next(parsed_iter)
+                except StopIteration:
+                    break
+                self.counters["parse"].add(1,len(docs),time.time() - start)
+                if not self._put(self.chunk_queue,(path,docs)):
+                    return
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            # lets a generator shut down its worker pools if we stopped early
+            if hasattr(parsed_iter,"close"):
+                parsed_iter.close()
+            self._put(self.chunk_queue,_DONE)
+
+    ####################
+    ## Embed stage    ##
+    ####################
+    def _register_file(self,path:str,docs:list[Document])->list[Document]:
+        """Works out which chunks of the file still need to be written. Files with nothing to write are done right away."""
+        chunk_ids = [self.db._chunk_id(doc) for doc in docs if self.db._is_storable(doc)]
+        new_docs = self.db._filter_new_docs(docs)
+        with self._progress_lock:
+            self._progress[path] = _FileProgress(chunk_ids,len(new_docs))
+        if not new_docs:
+            self._mark_written(path,0)
+        return new_docs
+
+    def _mark_written(self,path:str,num_written:int):
+        with self._progress_lock:
+            progress = self._progress[path]
+            progress.num_to_write -= num_written
+            if progress.num_to_write > 0:
+                return
+            del self._progress[path]
+        print(f"ingested {os.path.basename(path)} ({len(progress.chunk_ids)} chunks)")
+        if self._on_file_done is not None:
+            self._on_file_done(path,progress.chunk_ids)
+
+    def _batch_and_embed(self):
+        slots = threading.BoundedSemaphore(self.embed_concurrency)
+        current, current_paths = EmbeddingBatch(), []
+        backend = self.db.embedding_backend
+        max_tokens_per_item = min(backend.max_tokens_per_item,backend.max_tokens_per_batch)
+
+        with ThreadPoolExecutor(max_workers=self.embed_concurrency) as executor:
+            def flush():
+                nonlocal current, current_paths
+                if len(current) == 0:
+                    return
+                slots.acquire()
+                executor.submit(self._embed_batch,current,current_paths,slots)
+                current, current_paths = EmbeddingBatch(), []
+
+            try:
+                while self._error is None:
+                    try:
+                        item = self.chunk_queue.get(timeout=BATCH_FLUSH_SECONDS)
+                    except queue.Empty:
+                        flush()
+                        continue
+                    if item is _DONE:
+                        break
+                    path, docs = item
+                    new_docs = self._register_file(path,docs)
+                    token_counts = self.db._count_tokens([doc.page_content for doc in new_docs])
+                    for doc,num_tokens in zip(new_docs,token_counts):
+                        if num_tokens > max_tokens_per_item:
+                            print(f"\n\n **Document from {doc.metadata.get('source')} section {doc.metadata.get('section')} is too large to add to the DB. Skipping document.")
+                            self.db.ingest_stats["skipped_oversized"] += 1
+                            self._mark_written(path,1)
+                            continue
+                        if not current.fits(num_tokens,backend.max_tokens_per_batch,backend.max_items_per_batch):
+                            flush()
+                        current.add(doc,num_tokens)
+                        current_paths.append(path)
+                flush()
+            except BaseException as e:
+                self._fail(e)
+        # every embed worker has finished once the executor has shut down
+        self._put(self.write_queue,_DONE)
+
+    def _embed_batch(self,batch:EmbeddingBatch,paths:list[str],slots:threading.BoundedSemaphore):
+        try:
+            start = time.time()
+            texts = [doc.page_content for doc in batch.docs]
+            for attempt in range(1,EMBED_MAX_ATTEMPTS+1):
+                try:
+                    embeddings = self.db._embed_texts(texts)
+                    break
+                except Exception as e:
+                    if attempt == EMBED_MAX_ATTEMPTS:
+                        raise e
+                    wait_seconds = attempt * 30
+                    print(f"Error embedding batch of {len(texts)} chunks, attempt {attempt} {e}. Retrying in {wait_seconds}s...")
+                    time.sleep(wait_seconds)
+            self.counters["embed"].add(1,len(texts),time.time() - start)
+            self._put(self.write_queue,(batch,paths,embeddings))
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            slots.release()
+
+    ####################
+    ## Write stage    ##
+    ####################
+    def _write(self):
+        try:
+            while self._error is None:
+                try:
+                    item = self.write_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    return
+                batch, paths, embeddings = item
+                start = time.time()
+                self.db._write_embedded_docs(batch.docs,embeddings)
+                self.counters["write"].add(1,len(batch.docs),time.time() - start)
+                written_per_path = {}
+                for path in paths:
+                    written_per_path[path] = written_per_path.get(path,0) + 1
+                for path,num_written in written_per_path.items():
+                    self._mark_written(path,num_written)
+        except BaseException as e:
+            self._fail(e)
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import hashlib
+import functools
+from settings import config
+
+# On-disk cache for the ingestion time LLM extraction calls (metadata, CR content, docIDs).
+# Re-running a construct script sends the model the exact same inputs again, so the answers are keyed by a hash of
+# model name, output schema and input text and reused across runs.
+# Each process opens its own sqlite connection, so the ProcessPoolExecutor workers in MetadataAwareChunker can share one cache file.
+
+LLM_CACHE_PATH = config.get("LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_MAX_ENTRIES = config.get("LLM_CACHE_MAX_ENTRIES", 200000)
+LLM_CACHE_MAX_BYTES = config.get("LLM_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+# set LLM_CACHE_BYPASS in settings.yml or the environment to always call the model
+LLM_CACHE_BYPASS = bool(config.get("LLM_CACHE_BYPASS", False)) or os.getenv("LLM_CACHE_BYPASS", "False").lower() in ["true","1"]
+
+EVICTION_CHECK_INTERVAL = 100
+
+class LLMCache:
+    def __init__(self,path:str=LLM_CACHE_PATH,max_entries:int=LLM_CACHE_MAX_ENTRIES,max_bytes:int=LLM_CACHE_MAX_BYTES,bypass:bool=LLM_CACHE_BYPASS):
+        """@path: sqlite file the cache lives in.
+        @max_entries, @max_bytes: once either is exceeded the least recently used entries are evicted.
+        @bypass: if True, nothing is read from or written to the cache."""
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        # sqlite connections may not be used from another thread or across a fork, so each thread of each process opens its own
+        self._local = threading.local()
+        self._writes_since_eviction = 0
+
+    def _get_conn(self)->sqlite3.Connection:
+        # the pid check catches connections inherited by a forked worker process
+        if getattr(self._local,"conn",None) is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path,timeout=60,isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @staticmethod
+    def make_key(model_name:str,schema:str,text:str)->str:
+        h = hashlib.sha256()
+        for part in (model_name,schema,text):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def get(self,key:str):
+        """Returns the cached value for @key, or None on a miss"""
+        row = self._get_conn().execute("SELECT value FROM llm_cache WHERE key = ?",(key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._get_conn().execute("UPDATE llm_cache SET last_access = ? WHERE key = ?",(time.time(),key))
+        return json.loads(row[0])
+
+    def set(self,key:str,value):
+        serialized = json.dumps(value,ensure_ascii=False)
+        now = time.time()
+        self._get_conn().execute("INSERT OR REPLACE INTO llm_cache (key,value,size,created_at,last_access) VALUES (?,?,?,?,?)",(key,serialized,len(serialized),now,now))
+        self._writes_since_eviction += 1
+        if self._writes_since_eviction >= EVICTION_CHECK_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """Drops least recently used entries until the cache is back under both limits"""
+        self._writes_since_eviction = 0
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            num_entries,num_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size),0) FROM llm_cache").fetchone()
+            while num_entries > self.max_entries or num_bytes > self.max_bytes:
+                # evict in slices of 10% so we are not back here on the next write
+                to_evict = max(num_entries - self.max_entries, num_entries // 10, 1)
+                conn.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",(to_evict,))
+                num_entries,num_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size),0) FROM llm_cache").fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        self._get_conn().execute("DELETE FROM llm_cache")
+
+    def cached(self,schema):
+        """Decorator for functions of the form f(text_chunk:str) that call the LLM with a structured output @schema.
+        The model name is read from config on every call so switching models never returns another model's answer.
+        The wrapped function takes an extra `use_cache` keyword to bypass the cache for a single call."""
+        schema_str = json.dumps(schema.model_json_schema(),sort_keys=True)
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(text_chunk:str,use_cache:bool=True):
+                if self.bypass or not use_cache:
+                    return func(text_chunk)
+                key = self.make_key(config["MODEL_NAME"],f"{func.__name__}:{schema_str}",text_chunk)
+                try:
+                    value = self.get(key)
+                except sqlite3.Error as e:
+                    print(f"LLMCache: could not read from {self.path}: {e}")
+                    return func(text_chunk)
+                if value is not None:
+                    return value
+                value = func(text_chunk)
+                try:
+                    self.set(key,value)
+                except sqlite3.Error as e:
+                    print(f"LLMCache: could not write to {self.path}: {e}")
+                return value
+            return wrapper
+        return decorator
+
+llm_cache = LLMCache()
@@ -1,24 +1,27 @@
-from docx import Document as DocParser
-import docx
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import re
+import inspect
 from collections.abc import Callable
-from utils import getFirstPageOfDocxInMarkdown, getFirstTwoPagesOfDocxInMarkdown, getMetadataFromLLM, getCRContentFromLLM,Document
-from concurrent.futures import ProcessPoolExecutor, as_completed
-
-BASE_SECTION_NAME = "N/A"
-
-def parse_table(table):
-    """@input: docx table. Consists of rows and cells and the cells may have other tables.
-    This is a helper function to help parse tables from docx. 
-    It is needed as tables may contain nested tables."""
-    for row_idx,row in enumerate(table.rows):
-        for col_idx,col in enumerate(row.cells):
-            if col.tables:
-                for nested_table in col.tables:
-                    parse_table(nested_table)
-            else:
-                yield col.text
+from utils import FIRST_PAGE_NUM_CHARS, getFirstPageOfDocxInMarkdown, getFirstTwoPagesOfDocxInMarkdown, getMetadataFromLLM, getCRContentFromLLM,Document, RequestedChunkingType
+from DocxStreamParser import BASE_SECTION_NAME, HeadingStyles, iter_docx_section_parts, iter_docx_paragraph_texts, read_core_properties, read_heading_styles, read_document_body, iter_body_range_section_parts, read_docx_header_markdown
+from collections.abc import Iterator, Iterable
+import io
+import os
+from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+import functools
+from settings import config
+
+# Parsing streams the docx so memory per worker stays roughly flat; raise this to run more workers than cores allow by default
+CHUNKING_MAX_WORKERS = config.get("CHUNKING_MAX_WORKERS", None)
+# LLM metadata calls run on threads next to the parse workers, this caps how many are in flight at once
+LLM_MAX_CONCURRENCY = config.get("LLM_MAX_CONCURRENCY", 8)
+# docx files at least this large on disk are cut at their top level headings and the pieces parsed by several workers
+LARGE_DOCX_BYTES = config.get("CHUNKING_LARGE_DOCX_BYTES", 4 * 1024 * 1024)
+# smallest piece of document.xml (uncompressed) handed to one worker
+MIN_RANGE_BYTES = config.get("CHUNKING_MIN_RANGE_BYTES", 4 * 1024 * 1024)
+# bump whenever a change here gives an unchanged docx different chunks, so stored snapshots of chunks (ChunkCorpus) are rebuilt
+CHUNKER_VERSION = 1
 
 def clean_file_name(name:str):
     """@name: the full name of the file with the path.
@@ -32,25 +35,32 @@ def process_section_name(section_name:str)->str:
     """
     return section_name.split("\t")[0]
 
-def extract_core_properties(file)->dict:
-    """This is a helper to pull out the core properties of a docx file"""
-    core_obj = file.core_properties
-    return {'author':core_obj.author,'title':core_obj.title,'subject':core_obj.subject}
+DOCUMENT_WIDE_METADATA_FIELDS = ['version','docID','timestamp','release']
+
+# cover page of a 3gpp spec, e.g. "3GPP TS 38.211 V18.6.0 (2025-03) ... (Release 18)"
+EXTRACT_VERSION_AND_DOCID_REGX = re.compile(r"(3GPP T[SR] (\d+.\d+|\-\d)+ V\d+.\d+.\d+)",re.IGNORECASE)
+EXTRACT_VERSION_REGX = re.compile(r"(V\d+.\d+.\d+)")
+EXTRACT_DOCUMENT_REGX = re.compile(r"(T[SR] (\d+.\d+|\-\d)+)")
+EXTRACT_TIMESTAMP_REGX = re.compile(r"\((\d{4}-\d{2})\)")
+EXTRACT_RELEASE_REGX = re.compile(r"\bRelease\s+(\d+)\b",re.IGNORECASE)
+# 3gpp archive names: 5 digit spec number, optional part number, then one base 36 character each for major, minor and patch version
+# e.g. 38211-i60 is TS 38.211 V18.6.0 and 38101-1-hc0 is TS 38.101-1 V17.12.0
+SPEC_FILENAME_REGX = re.compile(r"^(\d{2})(\d{3})((?:-\d+)?)-([0-9a-z])([0-9a-z])([0-9a-z])(?![0-9a-z])",re.IGNORECASE)
+# the original cover page patterns (TS only, single digit patch version) stay in use by addExtraDocumentWideMetadataForContext:
+# its docID and version are part of the metadata and deterministic id of every chunk already stored in the spec collections
+CONTEXT_VERSION_AND_DOCID_REGX = re.compile(r"(3GPP TS (\d+.\d+|\-\d)+ V\d+.\d+.\d)",re.IGNORECASE)
+CONTEXT_VERSION_REGX = re.compile(r"(V\d+.\d+.\d)")
+CONTEXT_DOCUMENT_REGX = re.compile(r"(TS (\d+.\d+|\-\d)+)")
 
 def addExtraDocumentWideMetadataForContext(text_chunk:str,filepath:str):
     """Use this for 3gpp specs"""
-    extractVersionAndDocIDRegx = re.compile(r"(3GPP TS (\d+.\d+|\-\d)+ V\d+.\d+.\d)",re.IGNORECASE)
-    extractVersion = re.compile(r"(V\d+.\d+.\d)")
-    extractDocument = re.compile(r"(TS (\d+.\d+|\-\d)+)")
-    extractTimestamp = re.compile(r"\((\d{4}-\d{2})\)")
-
-    searchRes = extractVersionAndDocIDRegx.search(text_chunk)
-    timestamp = extractTimestamp.search(text_chunk)
+    searchRes = CONTEXT_VERSION_AND_DOCID_REGX.search(text_chunk)
+    timestamp = EXTRACT_TIMESTAMP_REGX.search(text_chunk)
 
     if searchRes and timestamp:
         res = searchRes.group()
-        version = extractVersion.search(res).group()[1:]
-        docID = extractDocument.search(res).group()[3:]
+        version = CONTEXT_VERSION_REGX.search(res).group()[1:]
+        docID = CONTEXT_DOCUMENT_REGX.search(res).group()[3:]
         timestamp = timestamp.group().replace("(","").replace(")","")
     else:
         return {}
@@ -58,149 +68,405 @@ def addExtraDocumentWideMetadataForContext(text_chunk:str,filepath:str):
     metadata = {'version':version,'docID':docID,'timestamp':timestamp}
     return metadata
 
-def addExtraDocumentWideMetadataForReason(text_chunk:str,filepath:str):
-    """Use this for TDocs"""
-    mdData = getFirstPageOfDocxInMarkdown(filepath)
-    metadata =getMetadataFromLLM(mdData)
-    print(metadata)
+def decodeMetadataFromFilename(filepath:str)->dict:
+    """Decodes docID, version and release from a 3gpp file name such as 38211-i60.docx.
+    Returns: dict with the fields that could be decoded, empty if the name does not follow the 3gpp scheme"""
+    match = SPEC_FILENAME_REGX.match(clean_file_name(filepath))
+    if not match:
+        return {}
+    major, minor, patch = (int(char,36) for char in match.group(4,5,6))
+    return {'docID':f"{match.group(1)}.{match.group(2)}{match.group(3)}",'version':f"{major}.{minor}.{patch}",'release':str(major)}
+
+def extractMetadataFromCoverPage(text_chunk:str)->dict:
+    """Runs the cover page regexes over @text_chunk.
+    Returns: dict with whichever of version, docID, timestamp and release were found"""
+    metadata = {}
+    searchRes = EXTRACT_VERSION_AND_DOCID_REGX.search(text_chunk)
+    if searchRes:
+        res = searchRes.group()
+        metadata['version'] = EXTRACT_VERSION_REGX.search(res).group()[1:]
+        metadata['docID'] = EXTRACT_DOCUMENT_REGX.search(res).group()[3:]
+    timestamp = EXTRACT_TIMESTAMP_REGX.search(text_chunk)
+    if timestamp:
+        metadata['timestamp'] = timestamp.group(1)
+    release = EXTRACT_RELEASE_REGX.search(text_chunk)
+    if release:
+        metadata['release'] = release.group(1)
     return metadata
 
-def section_chunks_of_file(file:str, addExtraDocumentWideMetadata:Callable[[str,str],dict]):
-    f = open(file,'rb')
+def extractLayeredDocumentWideMetadata(text_chunk:str,filepath:str,cover_page:str|None=None)->tuple[dict,dict]:
+    """Fills version, docID, timestamp and release from the cheapest source that has them:
+    the 3gpp file name first, then the cover page regexes, and the LLM only for the fields that are still empty.
+    @text_chunk: text before the first heading. If empty, the first page of the docx is used as the cover page.
+    @cover_page: first page of the docx as markdown, for docx files that are not on disk at @filepath (see `cover_page_of_docx_content`).
+    Returns: (metadata, sources) where sources maps each filled field to the layer that supplied it"""
+    metadata = {field:"" for field in DOCUMENT_WIDE_METADATA_FIELDS}
+    sources = {}
+
+    def _fill(layer:str,found:dict):
+        for field in DOCUMENT_WIDE_METADATA_FIELDS:
+            if not metadata[field] and found.get(field):
+                metadata[field] = found[field]
+                sources[field] = layer
+
+    def _missing()->bool:
+        return any(not metadata[field] for field in DOCUMENT_WIDE_METADATA_FIELDS)
+
+    def _first_page()->str:
+        return cover_page if cover_page is not None else getFirstPageOfDocxInMarkdown(filepath)
+
+    _fill("filename",decodeMetadataFromFilename(filepath))
+    mdData = None
+    if _missing():
+        if not text_chunk.strip():
+            mdData = _first_page()
+        _fill("cover_page",extractMetadataFromCoverPage(text_chunk if text_chunk.strip() else mdData))
+    if _missing():
+        if mdData is None:
+            mdData = _first_page()
+        if mdData.strip():
+            _fill("llm",getMetadataFromLLM(mdData))
+    return metadata, sources
+
+def addExtraDocumentWideMetadataForReason(text_chunk:str,filepath:str,cover_page:str|None=None):
+    """Use this for TDocs and specs. The LLM is only called for fields the file name and cover page do not give us"""
+    metadata, sources = extractLayeredDocumentWideMetadata(text_chunk,filepath,cover_page=cover_page)
+    print(f"{metadata} from {sources}")
+    return metadata
+
+class ParsedSection:
+    """One heading-delimited section of a docx.
+    @parts: the paragraph and table cell texts of the section in document order.
+    @offsets: start offset of each part inside `text`, so a chunk can be traced back to the part it came from."""
+    def __init__(self,title:str,parts:list[str]):
+        self.title = title
+        self.parts = parts
+        self.offsets = []
+        offset = 0
+        for part in parts:
+            self.offsets.append(offset)
+            offset += len(part)
+        self.text = "".join(parts)
+
+    def __repr__(self):
+        return f'ParsedSection(title="{self.title}", num_parts={len(self.parts)}, length={len(self.text)})'
+
+class ParsedDocx:
+    """In-memory section model of a docx file. Built once per file by `parse_docx_sections`
+    and shared by every chunking type, so the file is only walked a single time."""
+    def __init__(self,filepath:str,core_properties:dict,sections:list[ParsedSection]):
+        self.filepath = filepath
+        self.core_properties = core_properties
+        self.sections = sections
+
+    def base_section_text(self)->str:
+        """Text that precedes the first heading (cover page, foreword etc.)"""
+        for section in self.sections:
+            if section.title == BASE_SECTION_NAME:
+                return section.text
+        return ""
+
+def parse_docx_sections(file:str,content:bytes|None=None)->ParsedDocx:
+    """@file: path to the docx file.
+    @content: the bytes of the docx, if it is held in memory rather than on disk. @file is then only used as its name.
+    Streams the document body once and groups headings, paragraphs and table cells into sections.
+    The first section is always the BASE_SECTION_NAME section, even if it is empty."""
+    def _source():
+        return io.BytesIO(content) if content is not None else file
+    try:
+        sections = [ParsedSection(title,parts) for title,parts in iter_docx_section_parts(_source())]
+        core_properties = read_core_properties(_source())
+    except Exception as e:
+        raise Exception(f"for document {file} cannot parse with Docx") from e
+    return ParsedDocx(file,core_properties,sections)
+
+def cover_page_of_docx_content(content:bytes|None)->str|None:
+    """First page of an in-memory docx as markdown, for metadata functions that would otherwise read it from the (nonexistent) file.
+    None for docx files on disk, which are read from their path as usual."""
+    if content is None:
+        return None
     try:
-        doc = DocParser(f)
-    except:
-        raise Exception(f"for document {file} cannot parse with Docx")
+        return read_docx_header_markdown(io.BytesIO(content),max_chars=FIRST_PAGE_NUM_CHARS)
+    except Exception as e:
+        print(f"cannot read the first page of an in-memory docx: {e}")
+        return ""
 
-    file_metadata = extract_core_properties(doc)
+def _accepts_cover_page(func:Callable)->bool:
+    try:
+        return "cover_page" in inspect.signature(func).parameters
+    except (TypeError,ValueError):
+        return False
+
+def get_document_wide_metadata(base_section_text:str,filepath:str,addExtraDocumentWideMetadata:Callable[[str,str],dict],cover_page:str|None=None)->dict:
+    """Runs the document wide metadata function once per file on the base section text.
+    @cover_page: see `extractLayeredDocumentWideMetadata`. Only passed to metadata functions that take a cover_page argument."""
+    if cover_page is not None and _accepts_cover_page(addExtraDocumentWideMetadata):
+        addMetadata = addExtraDocumentWideMetadata(base_section_text,filepath,cover_page=cover_page)
+    else:
+        addMetadata = addExtraDocumentWideMetadata(base_section_text,filepath)
+    print(f"metadata is {addMetadata}")
+    return addMetadata
 
+def split_section_chunks(parsed:ParsedDocx)->list[tuple[str,str]]:
+    """Splits every section of @parsed into overlapping chunks of at most 1000 characters.
+    Returns: list of (chunk text, section name)"""
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000,chunk_overlap=200,add_start_index=True)
+    chunks = []
+    for section in parsed.sections:
+        section_name = process_section_name(section.title)
+        for chunk in text_splitter.split_text(section.text):
+            chunks.append((chunk,section_name))
+    return chunks
 
-    current_section_title = BASE_SECTION_NAME
-    current_section_text = ""
-    sections = []
-    #TODO: Switch to collecting a "current section" list of text chunks
-    # currently there's no overlap between paragraphs in the same section which is bad for retrieval
-    # We want to collect (section_text,current_section) where section_text is a combination of paragraphs
-    # Then, we use the text_splitter to split it into split chunks
-    for part in doc.iter_inner_content():
-        #print(f"part is {part}")
-        if isinstance(part,docx.text.paragraph.Paragraph) and part.style and part.style.name.startswith('Heading'):
-            # update current section
-            sections.append((current_section_text,current_section_title))
-            current_section_text = ""
-            current_section_title = part.text
-        elif isinstance(part,docx.table.Table):
-            for table_datum in parse_table(part):
-                current_section_text += table_datum
-        else:
-            # append text to current section
-            current_section_text += part.text
-    
-    #Add last section to sections
-    sections.append((current_section_text,current_section_title))
+def split_full_section_chunks(parsed:ParsedDocx)->list[tuple[str,str]]:
+    """Creates one chunk per non-empty section of @parsed.
+    Returns: list of (chunk text, section name)"""
+    chunks = []
+    for section in parsed.sections:
+        if section.text.strip() == '': # avoid adding empty sections
+            continue
+        section_name = section.title
+        if section_name.strip() != '' and section_name.strip() != '–' and section_name.strip() != '-':
+            chunks.append((section.text,process_section_name(section_name)))
+    return chunks
 
-    chunks_with_metadata = []
-    addMetadata = {}
+CHUNK_SPLITTERS = {
+    RequestedChunkingType.SECTION: split_section_chunks,
+    RequestedChunkingType.FULL_SECTION: split_full_section_chunks,
+}
+
+class UnenrichedChunks:
+    """CPU side result for one docx: the chunk texts and section names of every requested chunking type, without the document wide metadata.
+    Parse workers send this back so the (often LLM backed) metadata call can happen outside the process pool, see `enrich_chunks`.
+    @cover_page: first page markdown of a docx that is not on disk, see `cover_page_of_docx_content`"""
+    def __init__(self,filepath:str,core_properties:dict,base_section_text:str,chunks_by_type:dict[RequestedChunkingType,list[tuple[str,str]]],cover_page:str|None=None):
+        self.filepath = filepath
+        self.core_properties = core_properties
+        self.base_section_text = base_section_text
+        self.chunks_by_type = chunks_by_type
+        self.cover_page = cover_page
+
+
+def split_docx_into_chunks(file:str,chunking_types:list[RequestedChunkingType],content:bytes|None=None)->UnenrichedChunks:
+    """Parses @file once and splits it into every requested chunking type. Pure CPU work, run this in the parse workers.
+    @content: bytes of the docx if it is not on disk, see `parse_docx_sections`"""
+    for chunking_type in chunking_types:
+        if chunking_type not in CHUNK_SPLITTERS:
+            raise ValueError(f"Chunking type {chunking_type} cannot be built from docx sections")
+    parsed = parse_docx_sections(file,content=content)
+    chunks_by_type = {chunking_type: CHUNK_SPLITTERS[chunking_type](parsed) for chunking_type in chunking_types}
+    return UnenrichedChunks(file,parsed.core_properties,parsed.base_section_text(),chunks_by_type,cover_page=cover_page_of_docx_content(content))
+
+def enrich_chunks(unenriched:UnenrichedChunks,addMetadata:dict)->dict[RequestedChunkingType,list[Document]]:
+    """Joins the document wide metadata of a file back onto its chunks"""
+    source = clean_file_name(unenriched.filepath)
+    return {
+        chunking_type: [Document(
+            page_content=text,
+            metadata={'source':source,'section':section_name,**addMetadata,**unenriched.core_properties}
+        ) for text,section_name in chunks]
+        for chunking_type,chunks in unenriched.chunks_by_type.items()
+    }
+
+def enrich_docx_chunks(file:str,unenriched:UnenrichedChunks,addExtraDocumentWideMetadata:Callable[[str,str],dict])->dict[RequestedChunkingType,list[Document]]:
+    """I/O side for one docx: fetches the document wide metadata (possibly from the LLM) and attaches it to the chunks"""
+    addMetadata = get_document_wide_metadata(unenriched.base_section_text,file,addExtraDocumentWideMetadata,cover_page=unenriched.cover_page)
+    return enrich_chunks(unenriched,addMetadata)
+
+def chunks_of_file(file:str, addExtraDocumentWideMetadata:Callable[[str,str],dict], chunking_types:list[RequestedChunkingType])->dict[RequestedChunkingType,list[Document]]:
+    """Parses @file once and builds every requested chunking type from the same section model.
+    Returns: dict of chunking type to the chunks of that type"""
+    return enrich_docx_chunks(file,split_docx_into_chunks(file,chunking_types),addExtraDocumentWideMetadata)
 
-    for text,section_name in sections:
-        split_chunks = text_splitter.split_text(text)
-        
-        if section_name == BASE_SECTION_NAME and not addMetadata:
-            addMetadata = addExtraDocumentWideMetadata(text,file)
-            print(f"metadata is {addMetadata}")
+def section_chunks_of_file(file:str, addExtraDocumentWideMetadata:Callable[[str,str],dict]):
+    return chunks_of_file(file,addExtraDocumentWideMetadata,[RequestedChunkingType.SECTION])[RequestedChunkingType.SECTION]
 
-        for chunk in split_chunks:
-            chunks_with_metadata.append(Document(
-                page_content=chunk,
-                metadata={'source':clean_file_name(file),'section':process_section_name(section_name),**addMetadata,**file_metadata}
-            ))
-    return chunks_with_metadata
+def section_entire_chunks_of_file(file:str, addExtraDocumentWideMetadata:Callable[[str,str],dict]):
+    return chunks_of_file(file,addExtraDocumentWideMetadata,[RequestedChunkingType.FULL_SECTION])[RequestedChunkingType.FULL_SECTION]
+
+def chunk_file(file:str,chunking_type:RequestedChunkingType,addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext)->list[Document]:
+    """Chunks a single file with the requested chunking type, parsing and metadata calls inline."""
+    if chunking_type == RequestedChunkingType.CR:
+        return process_cr_file(file)
+    return chunks_of_file(file,addExtraDocumentWideMetadata,[chunking_type])[chunking_type]
+
+def iter_parse_then_enrich(file_list:Iterable,parse_func:Callable[[str],object],enrich_func:Callable[[str,object],object],max_workers:int|None=CHUNKING_MAX_WORKERS,llm_concurrency:int=LLM_MAX_CONCURRENCY,max_in_flight:int|None=None,split_func:Callable[[str],tuple[list[Callable[[],object]],Callable[[list],object]]|None]|None=None)->Iterator[tuple[str,object]]:
+    """Runs @parse_func (CPU bound, picklable) for every file in a process pool and hands each result to @enrich_func (I/O bound, e.g. LLM calls)
+    on a thread pool with at most @llm_concurrency calls at once. Parse workers never wait on the network, so they keep every core busy.
+    @file_list: list of files, or any iterable of items @parse_func accepts. It is consumed lazily, so it may be a generator that is still producing.
+    @max_in_flight: bound on files being parsed or enriched at once. None submits every file straight away.
+    @split_func: optional. For a large file, returns (tasks, stitch): picklable no-argument callables that each parse a part of the file
+    in their own worker, and a function that turns their results (in order) into what @parse_func would have returned.
+    Returns None for files that are parsed in one piece.
+    Yields: (file, enrich_func(file, parsed)) in completion order"""
+    # a single file that is not split is parsed inline, without starting any pool
+    presplit = {}
+    if isinstance(file_list,list) and len(file_list) == 1:
+        file = file_list[0]
+        presplit[0] = split_func(file) if split_func is not None else None
+        if presplit[0] is None:
+            yield file, enrich_func(file,parse_func(file))
+            return
+    with ProcessPoolExecutor(max_workers=max_workers) as parse_executor, ThreadPoolExecutor(max_workers=llm_concurrency) as enrich_executor:
+        # parsing maps each parse future to (file key, part index); a file parsed in one piece has a single part
+        parsing, enriching = {}, {}
+        files, stitches, parts, parts_left = {}, {}, {}, {}
+        file_iter = enumerate(file_list)
+        exhausted = False
+        while True:
+            while not exhausted and (max_in_flight is None or len(files) < max_in_flight):
+                try:
+                    key, file = next(file_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if key in presplit:
+                    split = presplit.pop(key)
+                else:
+                    split = split_func(file) if split_func is not None else None
+                tasks, stitches[key] = split if split is not None else ([functools.partial(parse_func,file)], None)
+                files[key] = file
+                parts[key] = [None] * len(tasks)
+                parts_left[key] = len(tasks)
+                for index,task in enumerate(tasks):
+                    parsing[parse_executor.submit(task)] = (key,index)
+            if not parsing and not enriching:
+                return
+            done, _ = wait([*parsing,*enriching],return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in parsing:
+                    key, index = parsing.pop(future)
+                    parts[key][index] = future.result()
+                    parts_left[key] -= 1
+                    if parts_left[key] > 0:
+                        continue
+                    file_parts, stitch = parts.pop(key), stitches.pop(key)
+                    del parts_left[key]
+                    parsed = stitch(file_parts) if stitch is not None else file_parts[0]
+                    enriching[enrich_executor.submit(enrich_func,files[key],parsed)] = key
+                else:
+                    key = enriching.pop(future)
+                    yield files.pop(key), future.result()
+
+def split_docx_range_into_chunks(file:str,range_xml:bytes,heading_styles:HeadingStyles,chunking_types:list[RequestedChunkingType],is_first_range:bool)->UnenrichedChunks:
+    """Parse worker side of `plan_docx_ranges`: chunks one range of a document body.
+    Every range but the first starts at a heading, so the empty base section the parser reports in front of it is dropped."""
+    try:
+        sections = [ParsedSection(title,parts) for title,parts in iter_body_range_section_parts(range_xml,heading_styles)]
+    except Exception as e:
+        raise Exception(f"for document {file} cannot parse with Docx") from e
+    if not is_first_range:
+        sections = sections[1:]
+    parsed = ParsedDocx(file,{},sections)
+    chunks_by_type = {chunking_type: CHUNK_SPLITTERS[chunking_type](parsed) for chunking_type in chunking_types}
+    return UnenrichedChunks(file,{},parsed.base_section_text() if is_first_range else "",chunks_by_type)
+
+def plan_docx_ranges(file:str,chunking_types:list[RequestedChunkingType],content:bytes|None=None)->tuple[list[Callable[[],UnenrichedChunks]],Callable[[list[UnenrichedChunks]],UnenrichedChunks]]|None:
+    """`split_func` for docx files, see `iter_parse_then_enrich`. A docx of at least LARGE_DOCX_BYTES is cut at its top level headings into
+    ranges of at least MIN_RANGE_BYTES of document.xml, so one giant spec is parsed by several workers. Sections never straddle two ranges,
+    so stitching the ranges back together gives the same chunks, in the same order, as parsing the file in one piece.
+    Returns None if the file is small, cannot be cut or cannot be read (the single piece parse then reports the error)."""
+    size = len(content) if content is not None else os.path.getsize(file)
+    if size < LARGE_DOCX_BYTES:
+        return None
+    def _source():
+        return io.BytesIO(content) if content is not None else file
+    try:
+        with ZipFile(_source(),'r') as zf:
+            heading_styles = read_heading_styles(zf)
+            body = read_document_body(zf)
+        core_properties = read_core_properties(_source())
+    except Exception:
+        return None
+    ranges = body.ranges(body.heading_offsets(heading_styles),MIN_RANGE_BYTES)
+    if len(ranges) == 1:
+        return None
+    print(f"parsing {clean_file_name(file)} in {len(ranges)} ranges")
+    tasks = [
+        functools.partial(split_docx_range_into_chunks,file,body.range_xml(start,end),heading_styles,chunking_types,i == 0)
+        for i,(start,end) in enumerate(ranges)
+    ]
+    def stitch(range_chunks:list[UnenrichedChunks])->UnenrichedChunks:
+        chunks_by_type = {chunking_type: [] for chunking_type in chunking_types}
+        for unenriched in range_chunks:
+            for chunking_type,chunks in unenriched.chunks_by_type.items():
+                chunks_by_type[chunking_type].extend(chunks)
+        return UnenrichedChunks(file,core_properties,range_chunks[0].base_section_text,chunks_by_type,cover_page=cover_page_of_docx_content(content))
+    return tasks, stitch
+
+def largest_first(file_list:list[str])->list[str]:
+    """Orders files by size on disk, largest first, so the longest parses start before the pool fills up with small ones"""
+    def _size(file:str)->int:
+        try:
+            return os.path.getsize(file)
+        except OSError:
+            return 0
+    return sorted(file_list,key=_size,reverse=True)
+
+def iter_chunks_of_files(file_list:list[str],chunking_types:list[RequestedChunkingType],addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext,max_workers:int|None=CHUNKING_MAX_WORKERS,max_in_flight:int|None=None)->Iterator[tuple[str,dict[RequestedChunkingType,list[Document]]]]:
+    """Yields (file, dict of chunking type to chunks) as each file finishes. See `iter_parse_then_enrich`.
+    Files are parsed largest first, and large docx files are split into ranges parsed in parallel (see `plan_docx_ranges`).
+    CR chunking needs a different parse and cannot be combined with the section based types in one call."""
+    file_list = largest_first(file_list)
+    if RequestedChunkingType.CR in chunking_types:
+        if len(chunking_types) != 1:
+            raise ValueError("CR chunking cannot be requested together with other chunking types")
+        for file,chunks in iter_parse_then_enrich(file_list,parse_cr_file,enrich_cr_file,max_workers=max_workers,max_in_flight=max_in_flight):
+            yield file, {RequestedChunkingType.CR: chunks}
+        return
+    parse_func = functools.partial(split_docx_into_chunks,chunking_types=chunking_types)
+    enrich_func = functools.partial(enrich_docx_chunks,addExtraDocumentWideMetadata=addExtraDocumentWideMetadata)
+    split_func = functools.partial(plan_docx_ranges,chunking_types=chunking_types)
+    yield from iter_parse_then_enrich(file_list,parse_func,enrich_func,max_workers=max_workers,max_in_flight=max_in_flight,split_func=split_func)
+
+def _split_docx_content(named_content:tuple[str,bytes],chunking_types:list[RequestedChunkingType])->UnenrichedChunks:
+    name, content = named_content
+    return split_docx_into_chunks(name,chunking_types,content=content)
+
+def iter_chunks_of_docx_contents(named_contents:Iterable[tuple[str,bytes]],chunking_types:list[RequestedChunkingType],addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext,max_workers:int|None=CHUNKING_MAX_WORKERS,max_in_flight:int|None=None)->Iterator[tuple[str,dict[RequestedChunkingType,list[Document]]]]:
+    """Like `iter_chunks_of_files`, for docx files held in memory (e.g. straight out of a downloaded zip).
+    @named_contents: (name, docx bytes) pairs. The name stands in for the file path, so use the docx file name to get the same chunks as from disk.
+    Yields: (name, dict of chunking type to chunks) as each docx finishes"""
+    if RequestedChunkingType.CR in chunking_types:
+        raise ValueError("CR chunking needs the file on disk")
+    parse_func = functools.partial(_split_docx_content,chunking_types=chunking_types)
+    def enrich_func(named_content:tuple[str,bytes],unenriched:UnenrichedChunks):
+        return enrich_docx_chunks(named_content[0],unenriched,addExtraDocumentWideMetadata)
+    def split_func(named_content:tuple[str,bytes]):
+        return plan_docx_ranges(named_content[0],chunking_types,content=named_content[1])
+    for (name,_),chunks in iter_parse_then_enrich(named_contents,parse_func,enrich_func,max_workers=max_workers,max_in_flight=max_in_flight,split_func=split_func):
+        yield name, chunks
+
+def getChunksOfTypes(file_list,chunking_types:list[RequestedChunkingType],addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext,max_workers:int|None=CHUNKING_MAX_WORKERS)->dict[RequestedChunkingType,list[Document]]:
+    """@input: file_list. List of files in relative path that will be chunked.
+    @chunking_types: the SECTION/FULL_SECTION chunk types to produce. Each file is parsed once no matter how many types are requested.
+    @addExtraDocumentWideMetadata: func that returns a dictionary with extra metadata that will be added to all chunks.
+    @max_workers: number of parse worker processes. None lets ProcessPoolExecutor pick the core count.
+    Returns: dict of chunking type to the master list of chunks of that type across all the files."""
+    chunks_by_type = {chunking_type: [] for chunking_type in chunking_types}
+    for _,file_chunks in iter_chunks_of_files(file_list,chunking_types,addExtraDocumentWideMetadata,max_workers=max_workers):
+        for chunking_type,chunks in file_chunks.items():
+            chunks_by_type[chunking_type].extend(chunks)
+    return chunks_by_type
 
 def getSectionedChunks(file_list,addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext):
     """@input: file_list. List of files in relative path that will be chunked.
     @addExtraDocumentWideMetadata: func that returns a dictionary with extra metadata that will be added to all chunks.
     Returns: master list chunks_with_metadata that has chunks of all the files stored as Documents.
     These Documents have section metadata"""
-    if len(file_list) == 1:
-        return section_chunks_of_file(file_list[0], addExtraDocumentWideMetadata)
-    else:
-        chunks_with_metadata= []
-        with ProcessPoolExecutor() as executor:
-            futures = {executor.submit(section_chunks_of_file,file,addExtraDocumentWideMetadata): file for file in file_list}
-            for future in as_completed(futures):
-                chunks_with_metadata.extend(future.result())
-    return chunks_with_metadata
-
-def section_entire_chunks_of_file(file:str, addExtraDocumentWideMetadata:Callable[[str,str],dict]):
-    f = open(file,'rb')
-    try:
-        doc = DocParser(f)
-    except:
-        raise Exception(f"for document {file} cannot parse with Docx")
-
-    file_metadata = extract_core_properties(doc)
-
-    current_section_title = BASE_SECTION_NAME
-    current_section_text = ""
-    sections = []
-
-    for part in doc.iter_inner_content():
-        if isinstance(part,docx.text.paragraph.Paragraph) and part.style and part.style.name.startswith('Heading'):
-            # update current section
-            if current_section_text.strip() != '':
-                sections.append((current_section_text,current_section_title))
-            current_section_text = ""
-            current_section_title = part.text
-        elif isinstance(part,docx.table.Table):
-            for table_datum in parse_table(part):
-                current_section_text += table_datum
-        else:
-            # append text to current section
-            current_section_text += part.text
-        
-        #Add last section to sections
-    if current_section_text.strip() != '': # avoid adding empty sections
-        sections.append((current_section_text,current_section_title))
-
-    chunks_with_metadata = []
-    addMetadata = {}
-    for text,section_name in sections:
-        if section_name == BASE_SECTION_NAME and not addMetadata:
-            addMetadata = addExtraDocumentWideMetadata(text,file)
-            print(f"metadata is {addMetadata}")
-        if section_name.strip() != '' and section_name.strip() != '–' and section_name.strip() != '-':
-            chunks_with_metadata.append(Document(
-                page_content=text,
-                metadata = {'source':clean_file_name(file),'section':process_section_name(section_name),**addMetadata,**file_metadata}
-            ))
-    return chunks_with_metadata
+    return getChunksOfTypes(file_list,[RequestedChunkingType.SECTION],addExtraDocumentWideMetadata)[RequestedChunkingType.SECTION]
 
 def getFullSectionChunks(file_list,addExtraDocumentWideMetadata:Callable[[str,str],dict]=addExtraDocumentWideMetadataForContext):
     """@input: file_list. List of files in relative path that will be chunked.
     @addExtraDocumentWideMetadata: func that returns a dictionary with extra metadata that will be added to all chunks.
     this function creates chunks which are the size of an entire section rather than breaking the section up."""
-    if len(file_list) == 1:
-        return section_entire_chunks_of_file(file_list[0], addExtraDocumentWideMetadata)
-    else:
-        chunks_with_metadata= []
-        with ProcessPoolExecutor() as executor:
-            futures = {executor.submit(section_entire_chunks_of_file,file,addExtraDocumentWideMetadata): file for file in file_list}
-            for future in as_completed(futures):
-                chunks_with_metadata.extend(future.result())
-    return chunks_with_metadata
+    return getChunksOfTypes(file_list,[RequestedChunkingType.FULL_SECTION],addExtraDocumentWideMetadata)[RequestedChunkingType.FULL_SECTION]
 
 def getFullFileChunks(file_list):
     chunks = []
     for file in file_list:
-
-        f = open(file,'rb')
-        doc = DocParser(f)
-
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000,chunk_overlap=200,add_start_index=True)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text
+        text = "".join(iter_docx_paragraph_texts(file))
         split_chunks = text_splitter.split_text(text)
         for chunk in split_chunks:
             chunks.append(Document(
@@ -213,15 +479,17 @@ def getFullFileChunks(file_list):
 #####################
 #### CR chunking ####
 #####################
-def process_cr_file(file:str):
-    f = open(file,'rb')
+def parse_cr_file(file:str)->tuple[dict,str]:
+    """CPU side of CR chunking: core properties and the first two pages of the CR as markdown"""
     try:
-        doc = DocParser(f)
-    except:
-        raise Exception(f"for document {file} cannot parse with Docx")
-
-    file_metadata = extract_core_properties(doc)
-    mdContent = getFirstTwoPagesOfDocxInMarkdown(file)
+        file_metadata = read_core_properties(file)
+    except Exception as e:
+        raise Exception(f"for document {file} cannot parse with Docx") from e
+    return file_metadata, getFirstTwoPagesOfDocxInMarkdown(file)
+
+def enrich_cr_file(file:str,parsed:tuple[dict,str])->list[Document]:
+    """LLM side of CR chunking: extracts the metadata and the change chunks from the markdown of the CR"""
+    file_metadata, mdContent = parsed
     metadata_from_llm = getMetadataFromLLM(mdContent)
     all_metadata = {**file_metadata,**metadata_from_llm}
     print(f"metadata is {all_metadata}")
@@ -236,16 +504,14 @@ def process_cr_file(file:str):
         ))
     return chunks_with_metadata
 
+def process_cr_file(file:str):
+    return enrich_cr_file(file,parse_cr_file(file))
+
 def getCRChunks(file_list:list[str])->list[Document]:
-    if len(file_list) == 1:
-        return process_cr_file(file_list[0])
-    else:
-        chunks = []
-        with ProcessPoolExecutor() as executor:
-            futures = {executor.submit(process_cr_file,file): file for file in file_list}
-            for future in as_completed(futures):
-                chunks.extend(future.result())
-        return chunks
+    chunks = []
+    for _,file_chunks in iter_chunks_of_files(file_list,[RequestedChunkingType.CR]):
+        chunks.extend(file_chunks[RequestedChunkingType.CR])
+    return chunks
 
 if __name__ =="__main__":
     """file_list = ["./data/38214-hc0.docx","./data/v16diffver.docx"]
@@ -0,0 +1,88 @@
+import argparse
+import chromadb
+from DocumentTable import DocumentTable, DOCUMENT_TABLE_FILENAME, DOC_KEY_FIELD, split_metadata
+from utils import deterministic_id
+from CollectionNames import SPECS_AND_DISCUSSIONS, REASONING_DOCS, DIFFS
+from settings import config
+
+# Converts existing collections to the normalized layout (see DocumentTable): the document level metadata of every chunk is moved
+# into the document table, and the chunk keeps only its document key and chunk level fields. Chunk ids and embeddings are untouched.
+# A collection is only marked normalized once all its chunks are converted. An interrupted run can be re-run, converted chunks are skipped.
+# Re-running it on a normalized collection prunes the documents no chunk refers to any more, e.g. left behind by deletes made before
+# DBClient.delFromDB removed them.
+# Run from the repo root: python MigrateToDocumentTable.py [--db-dir ...] [--collection ...] [--dry-run]
+
+MIGRATION_BATCH_SIZE = 5000
+
+def prune_documents(chroma_client,db_dir_path:str,collection_name:str,dry_run:bool=False)->int:
+    """Removes the documents of a normalized collection that no chunk refers to. Returns: how many there were"""
+    collection = chroma_client.get_collection(name=collection_name)
+    table = DocumentTable(db_dir_path,collection_name)
+    total = collection.count()
+    used_keys = set()
+    offset = 0
+    while offset < total:
+        db_resp = collection.get(include=["metadatas"],limit=MIGRATION_BATCH_SIZE,offset=offset)
+        if not db_resp['ids']:
+            break
+        offset += len(db_resp['ids'])
+        used_keys.update(metadata[DOC_KEY_FIELD] for metadata in db_resp['metadatas'] if metadata and DOC_KEY_FIELD in metadata)
+    stale_keys = [doc_key for doc_key in table.fields_by_key if doc_key not in used_keys]
+    print(f"{collection_name}: {'would prune' if dry_run else 'pruning'} {len(stale_keys)} of {len(table)} documents no chunk refers to")
+    if not dry_run:
+        table.remove(stale_keys)
+    return len(stale_keys)
+
+def migrate_collection(chroma_client,db_dir_path:str,collection_name:str,dry_run:bool=False)->dict:
+    """Returns: counts of the chunks converted, the documents found and the stale documents pruned"""
+    if DocumentTable.is_normalized(db_dir_path,collection_name):
+        print(f"{collection_name} is already normalized")
+        return {"chunks":0,"documents":0,"pruned":prune_documents(chroma_client,db_dir_path,collection_name,dry_run=dry_run)}
+    collection = chroma_client.get_collection(name=collection_name)
+    table = None if dry_run else DocumentTable(db_dir_path,collection_name)
+    total = collection.count()
+    doc_keys = set()
+    num_converted = 0
+    offset = 0
+    while offset < total:
+        db_resp = collection.get(include=["metadatas"],limit=MIGRATION_BATCH_SIZE,offset=offset)
+        if not db_resp['ids']:
+            break
+        offset += len(db_resp['ids'])
+        ids, metadatas = [], []
+        for chunk_id,metadata in zip(db_resp['ids'],db_resp['metadatas']):
+            doc_fields, _ = split_metadata(metadata or {})
+            if not doc_fields:
+                continue
+            if dry_run:
+                doc_keys.add(deterministic_id("",doc_fields))
+            else:
+                stored = table.normalize(metadata)
+                doc_keys.add(stored[DOC_KEY_FIELD])
+                # chroma merges the metadata of an update into what is stored, keys are only removed by setting them to None
+                metadatas.append({**stored,**{field: None for field in doc_fields}})
+                ids.append(chunk_id)
+            num_converted += 1
+        if ids:
+            collection.update(ids=ids,metadatas=metadatas)
+        print(f"{collection_name}: {offset}/{total} chunks read, {num_converted} converted")
+
+    if not dry_run:
+        table.set_normalized()
+    print(f"{collection_name}: {'would convert' if dry_run else 'converted'} {num_converted} chunks of {len(doc_keys)} documents")
+    return {"chunks":num_converted,"documents":len(doc_keys),"pruned":0}
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description=f"Moves document level chunk metadata of existing collections into {DOCUMENT_TABLE_FILENAME}")
+    argparser.add_argument('--db-dir', type=str, default=config["CHROMA_DIR"])
+    argparser.add_argument('--collection', '-c', type=str, action='append', default=None, help="collection to convert, may be repeated. Defaults to the three standard collections")
+    argparser.add_argument('--dry-run', action='store_true', help="only count what would be converted")
+    args = argparser.parse_args()
+
+    chroma_client = chromadb.PersistentClient(path=args.db_dir)
+    existing = chroma_client.list_collections()
+    for collection_name in args.collection or [SPECS_AND_DISCUSSIONS, REASONING_DOCS, DIFFS]:
+        if collection_name not in existing:
+            print(f"{collection_name} does not exist in {args.db_dir}, skipping")
+            continue
+        migrate_collection(chroma_client,args.db_dir,collection_name,dry_run=args.dry_run)
@@ -1,31 +1,77 @@
-from utils import RefObj,RetrieverResult, get_inclusive_tstmp_range, getDocIDFromText
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import RefObj,RetrieverResult, get_inclusive_tstmp_range
 from ReferenceExtractor import ReferenceExtractor
 from HypotheticalDocGenerator import HypotheticalDocGenerator
 from DBClient import DBClient
+from RetrievalGraph import RetrievalGraph
+from DocIDExtractor import DocIDExtractor
 from settings import config
 from CollectionNames import SPECS_AND_DISCUSSIONS as SPEC_COLL_NAME, REASONING_DOCS as TDOC_COLL_NAME, DIFFS as DIFF_COLL_NAME
 
 RExt = ReferenceExtractor()
 NUM_EXTRA_DOCS = config["NUM_EXTRA_DOCS"]
 FILTER_START_TSTMP = '2000-01'
+# threads shared by the retrieval graphs of all requests, see invoke
+RETRIEVAL_CONCURRENCY = config.get("RETRIEVAL_CONCURRENCY", 8)
+
+class QueryEmbeddings:
+    """Query vectors of one request. Each distinct text is embedded at most once per request and embedding space,
+    and DBClient.embed_query skips embedding altogether for texts still in the process wide LRU.
+    Stages of the request running concurrently wait for a vector another stage is already computing."""
+    def __init__(self,collections:dict[str,DBClient]):
+        self.collections = collections
+        self.vectors = {}
+        self._locks: dict[tuple,threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def get(self,collection_name:str,text:str):
+        client = self.collections[collection_name]
+        key = (client.embedding_key(),text)
+        if key in self.vectors:
+            return self.vectors[key]
+        with self._locks_lock:
+            lock = self._locks.setdefault(key,threading.Lock())
+        with lock:
+            if key not in self.vectors:
+                self.vectors[key] = client.embed_query(text)
+        return self.vectors[key]
 
 class MultiStageRetriever:
     def __init__(self,pathToDB="../baseline/db",specCollectionName=SPEC_COLL_NAME,reasonCollectionName=TDOC_COLL_NAME,diffCollectionName=DIFF_COLL_NAME):
         self.selected_docs = None
 
-        self.hdg: HypotheticalDocGenerator = HypotheticalDocGenerator()
-
         self.collections: dict[str, DBClient] = {}
         self.collections["spec"] = DBClient(collection_name=specCollectionName,db_dir_path=pathToDB)
         self.collections["reasoning"] = DBClient(collection_name=reasonCollectionName,db_dir_path=pathToDB)
         self.collections["diff"] = DBClient(collection_name=diffCollectionName,db_dir_path=pathToDB)
+        # questions are embedded in the diff collection's space, the one the diff query embeds them in. The HyDE cache lookup and
+        # the diff query run at the same time and share one embedding call (see QueryEmbeddingCache), so the lookup costs no
+        # extra embedding unless the diff query is skipped because the question names its docIDs
+        self.hdg: HypotheticalDocGenerator = HypotheticalDocGenerator(embed_query=self.collections["diff"].embed_query)
+        self.executor = ThreadPoolExecutor(max_workers=RETRIEVAL_CONCURRENCY)
+        # read again when a question names a document ingested since, see DocIDExtractor.refresh
+        self.docid_extractor = DocIDExtractor(self.knownDocuments)
+
+    def knownDocuments(self)->dict[str,str]:
+        """docID -> title of the documents in any of the collections"""
+        known_documents = {}
+        for client in self.collections.values():
+            for docID,title in client.known_documents().items():
+                known_documents[docID] = title or known_documents.get(docID,"")
+        return known_documents
         
-    def buildDocIdandSectionFilter(self,ref:RefObj,org_docid:str)->dict:
+    def getRefTarget(self,ref:RefObj,org_docid:str)->tuple[str|None,list[str]]:
+        """Returns: (docID the reference points into, or None if unknown, clause numbers it names)"""
         section_names = RExt.extractClauseNumbersFromString(ref.reference)
         if ref.src == RExt.getSRCDOC():
             docId = org_docid
         else:
             docId = ref.src
+        return docId, section_names
+
+    def buildDocIdandSectionFilter(self,ref:RefObj,org_docid:str)->dict:
+        docId, section_names = self.getRefTarget(ref,org_docid)
         if section_names == []:
             return {}
         if docId == None:
@@ -53,29 +99,59 @@ class MultiStageRetriever:
         metadata_filter = {'$or':filters}
         return metadata_filter
 
-    def getAdditionalContext(self,org_docs,hyp_doc,num_docs_to_retrieve):
+    def buildSectionRefsFromDocs(self,docs)->tuple[list[tuple[str,str]],dict]:
+        """Same references as buildFiltersFromRefs, split into the exact (docID, section) pairs they name, which the spec collection
+        resolves through its section index, and a filter for the references to a section of an unknown document.
+        returns: (pairs, filter)"""
+        doc_sections = []
+        filters = []
+        for doc in docs:
+            org_docid:str = doc.metadata.get("docID",None)
+            for ref in RExt.runREWithDocList(docs=[doc]):
+                docId, section_names = self.getRefTarget(ref,org_docid)
+                if section_names == []:
+                    continue
+                if docId == None:
+                    new_filter = {'section':{"$in":section_names}}
+                    if new_filter not in filters:
+                        filters.append(new_filter)
+                    continue
+                doc_sections.extend((docId,section) for section in section_names)
+        doc_sections = list(dict.fromkeys(doc_sections))
+        if filters == []:
+            return doc_sections, {}
+        if len(filters) == 1:
+            return doc_sections, filters[0]
+        return doc_sections, {'$or':filters}
+
+    def getAdditionalContext(self,org_docs,hyp_doc,num_docs_to_retrieve,embeddings:QueryEmbeddings|None=None):
         """@org_docs: list of initially retrieved document chunks from vector db.
         In this method, we parse the org_docs for external references and perform additional retrievals.
+        The referenced sections are looked up in the spec collection's section index and ranked against the hyp_doc vector,
+        only references the index cannot resolve go through a filtered vector search (see DBClient.querySections).
+        @embeddings: query vectors of the current request, so hyp_doc is not embedded again.
         returns: list of document chunks"""
-        metadata_filter = self.buildFiltersFromRefs(docs=org_docs)
-        if metadata_filter == {}:
+        embeddings = embeddings or QueryEmbeddings(self.collections)
+        doc_sections, metadata_filter = self.buildSectionRefsFromDocs(docs=org_docs)
+        if doc_sections == [] and metadata_filter == {}:
             return []
-        print(f"\n\n secondary retrieval filter is \n** {metadata_filter}")
-        
-        #metadataOnlyRetriever = db.getRetriever(search_kwargs={'filter':metadata_filter,'k':1000})
+        print(f"\n\n secondary retrieval sections are \n** {doc_sections} \n and filter is \n** {metadata_filter}")
+
         additional_docs = []
         try:
-            additional_docs.extend(self.collections["spec"].queryDB(query_text=hyp_doc,k=num_docs_to_retrieve,filter=metadata_filter))
+            additional_docs.extend(self.collections["spec"].querySections(query_text=hyp_doc,k=num_docs_to_retrieve,doc_sections=doc_sections,filter=metadata_filter,query_embedding=embeddings.get("spec",hyp_doc)))
         except Exception as e:
-            print(f"error due to filter {metadata_filter}")
+            print(f"error due to sections {doc_sections} and filter {metadata_filter}")
             raise e
 
         return additional_docs
     
-    def retrieveFromSpecDB(self,hyp_doc:str):
+    def retrieveFromSpecDB(self,hyp_doc:str,embeddings:QueryEmbeddings|None=None):
         """We retrieve context info from the spec db.
+        @embeddings: query vectors of the current request. hyp_doc is embedded once for all the spec queries below.
         returns: first order and (possible) second order retrieval results"""
-        org_docs = self.collections["spec"].queryDB(query_text=hyp_doc,k=config["NUM_DOCS_INITIAL_RETRIEVAL"])
+        embeddings = embeddings or QueryEmbeddings(self.collections)
+        org_docs = self.collections["spec"].queryDB(query_text=hyp_doc,k=config["NUM_DOCS_INITIAL_RETRIEVAL"],query_embedding=embeddings.get("spec",hyp_doc))
 
         print(f"There are {len(org_docs)}, and they are {org_docs}")
         if config["IS_SMART_RETRIEVAL"] and config["NUM_EXTRA_DOCS"] > 0:
@@ -96,7 +172,7 @@ class MultiStageRetriever:
 
             cumulative_extra_retrieval = (num_recursions * budget_per_recursion) - NUM_EXTRA_DOCS # If we do more retrievals than needed, we need to adjust
             for i in range(1,num_recursions+1,1):
-                additional_docs = self.getAdditionalContext(docs_to_build_filters_from,hyp_doc=hyp_doc,num_docs_to_retrieve=budget_per_recursion)
+                additional_docs = self.getAdditionalContext(docs_to_build_filters_from,hyp_doc=hyp_doc,num_docs_to_retrieve=budget_per_recursion,embeddings=embeddings)
                 if len(additional_docs) < budget_per_recursion:
                     # If we didn't get enough docs, we need to adjust our budget
                     cumulative_extra_retrieval += (budget_per_recursion - len(additional_docs))
@@ -118,7 +194,7 @@ class MultiStageRetriever:
             if desired_total > current_total:
                 deficit = desired_total - current_total
                 print("No additional docs could be retrieved based on references, getting some more based on similarity")
-                org_docs = self.collections["spec"].queryDB(query_text=hyp_doc,k=(config["NUM_DOCS_INITIAL_RETRIEVAL"]+deficit))
+                org_docs = self.collections["spec"].queryDB(query_text=hyp_doc,k=(config["NUM_DOCS_INITIAL_RETRIEVAL"]+deficit),query_embedding=embeddings.get("spec",hyp_doc))
         else:
            secondary_retrieval_docs = []
 
@@ -152,22 +228,19 @@ class MultiStageRetriever:
     
     def buildFiltersFromQuery(self,query):
         """This builds filters if there are docIDs in the query. 
-        If there are no docIDs, returns empty dict."""
-        docIDs = getDocIDFromText(query)
+        If there are no docIDs, returns empty dict.
+        docIDs are extracted with regexes and spec name aliases, the LLM is only asked if those are ambiguous (see DocIDExtractor)."""
+        docIDs = self.docid_extractor.getDocIDs(query)
         print(f"\n\n docIDs from query \n **")
         print(docIDs)
         if docIDs == []:
             return {}
         return self.buildDocIDFilter(docIDs)
     
-    def getFiltersForDiscussionDB(self,query:str)->dict:
-        filters_from_query = self.buildFiltersFromQuery(query)
-        print(f"\n\n filters from query \n **")
-        print(filters_from_query)
-        if filters_from_query != {}:
-            return filters_from_query
-
-        diffs = self.collections["diff"].queryDB(query_text=query,k=4)
+    def buildFiltersFromDiffDB(self,query:str,embeddings:QueryEmbeddings|None=None)->dict:
+        """Filter on the docIDs of the diffs most similar to the query. Empty dict if there are none."""
+        embeddings = embeddings or QueryEmbeddings(self.collections)
+        diffs = self.collections["diff"].queryDB(query_text=query,k=4,query_embedding=embeddings.get("diff",query))
 
         filters_from_diffs = self.buildFiltersFromDiffs(diffs)
         print(f"\n\ndiffs\n*****")
@@ -181,38 +254,70 @@ class MultiStageRetriever:
         print(filters_from_diffs)
         return filters_from_diffs
 
-    def retrieveReasoning(self,query,hyp_doc):
+    def getFiltersForDiscussionDB(self,query:str,embeddings:QueryEmbeddings|None=None)->dict:
+        embeddings = embeddings or QueryEmbeddings(self.collections)
+        filters_from_query = self.buildFiltersFromQuery(query)
+        print(f"\n\n filters from query \n **")
+        print(filters_from_query)
+        if filters_from_query != {}:
+            return filters_from_query
+        return self.buildFiltersFromDiffDB(query,embeddings=embeddings)
+
+    def retrieveReasoning(self,query,hyp_doc,embeddings:QueryEmbeddings|None=None,metadata_filter:dict|None=None):
         """gets the change from diff db, and searches discussion db for relevant information on why the change was made.
+        @embeddings: query vectors of the current request, shared with the spec retrieval.
+        @metadata_filter: filter for the discussion db if it was already worked out (see invoke), otherwise getFiltersForDiscussionDB builds it.
         Returns: documents from discussion db"""
+        embeddings = embeddings or QueryEmbeddings(self.collections)
         #get diff similar to query
-        metadata_filter = self.getFiltersForDiscussionDB(query)
+        if metadata_filter is None:
+            metadata_filter = self.getFiltersForDiscussionDB(query,embeddings=embeddings)
 
-        reasoning_docs = self.collections["reasoning"].queryDB(query_text=hyp_doc,k=config["NUM_REASONING_DOCS_TO_RETRIEVE"],filter=metadata_filter)
+        reasoning_docs = self.collections["reasoning"].queryDB(query_text=hyp_doc,k=config["NUM_REASONING_DOCS_TO_RETRIEVE"],filter=metadata_filter,query_embedding=embeddings.get("reasoning",hyp_doc))
         if reasoning_docs == []:
             print("No reasoning docs could be retrieved based on diff/docID filtering, getting some more based on similarity")
-            reasoning_docs = self.collections["reasoning"].queryDB(query_text=hyp_doc,k=config["NUM_REASONING_DOCS_TO_RETRIEVE"])
+            reasoning_docs = self.collections["reasoning"].queryDB(query_text=hyp_doc,k=config["NUM_REASONING_DOCS_TO_RETRIEVE"],query_embedding=embeddings.get("reasoning",hyp_doc))
 
         print(f"\n\n reasoning_docs is \n**")
         print(reasoning_docs)
 
         return reasoning_docs
 
-    def invoke(self,query):
+    def generateHypotheticalDocument(self,query:str)->str:
         #invoke HypotheticalDocument here to get gpt response
         hyp_doc = self.hdg.generate_hypothetical_document(query)
         if hyp_doc == None:
             hyp_doc = query
-        
+
         print(f"\n\n hypothetical doc is \n**")
         print(hyp_doc)
+        return hyp_doc
 
-        org_docs,additional_docs = self.retrieveFromSpecDB(hyp_doc=hyp_doc)
+    def invoke(self,query):
+        """Runs the retrieval stages as a RetrievalGraph: spec depends on hyde, diff_filters on query_filters, and reasoning on
+        hyde, query_filters and diff_filters. The docID extraction and the diff query only need the question, so they run while
+        HyDE is generating. The diff query only runs if the question names no docIDs, since its filter would not be used otherwise.
+        The seconds each stage took are in RetrieverResult.timings."""
+        # every text of this request is embedded once, however many collections and rounds query with it
+        embeddings = QueryEmbeddings(self.collections)
+        graph = RetrievalGraph(self.executor)
+        graph.add("hyde",lambda: self.generateHypotheticalDocument(query))
+        graph.add("spec",lambda hyde: self.retrieveFromSpecDB(hyp_doc=hyde,embeddings=embeddings),deps=("hyde",))
         if config["NUM_REASONING_DOCS_TO_RETRIEVE"] != 0 and (config["IS_SMART_RETRIEVAL"] == True):
-            tdocs = self.retrieveReasoning(query,hyp_doc=hyp_doc)
-        else:
-            tdocs = []
+            graph.add("query_filters",lambda: self.buildFiltersFromQuery(query))
+            graph.add("diff_filters",lambda query_filters: {} if query_filters else self.buildFiltersFromDiffDB(query,embeddings=embeddings),deps=("query_filters",))
+            graph.add("reasoning",
+                lambda hyde,query_filters,diff_filters: self.retrieveReasoning(query,hyp_doc=hyde,embeddings=embeddings,metadata_filter=query_filters or diff_filters),
+                deps=("hyde","query_filters","diff_filters"))
+        results = graph.run()
+
+        org_docs,additional_docs = results["spec"]
+        tdocs = results.get("reasoning",[])
+        print(f"\n\n retrieval timings \n** {graph.timings}")
+        if self.hdg.cache is not None:
+            print(f"hyde cache: {self.hdg.cache.stats()}")
 
-        retriever_result = RetrieverResult(firstOrderSpecDocs=org_docs,secondOrderSpecDocs=additional_docs,retrievedDiscussionDocs=tdocs)
+        retriever_result = RetrieverResult(firstOrderSpecDocs=org_docs,secondOrderSpecDocs=additional_docs,retrievedDiscussionDocs=tdocs,timings=graph.timings)
         return retriever_result
     
     
\ No newline at end of file
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from collections.abc import Callable, Hashable
+from settings import config
+
+# Process wide LRU of query embeddings, shared by every DBClient. A /qa request queries several collections with the same few texts
+# (the question and its hypothetical document), and the same questions come back often, so most query embeddings are already here.
+# Keys include the embedding backend, model and dimension, so collections embedded differently never share vectors.
+# Stages of a request run concurrently and often embed the same text at the same moment (e.g. the HyDE cache lookup and the
+# diff query both embed the question), so a text is embedded once and the other callers wait for that call.
+
+QUERY_EMBEDDING_CACHE_SIZE = config.get("QUERY_EMBEDDING_CACHE_SIZE", 1024)
+
+class QueryEmbeddingCache:
+    def __init__(self,max_entries:int=QUERY_EMBEDDING_CACHE_SIZE):
+        """@max_entries: least recently used vectors are dropped beyond this. 0 disables the cache."""
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._vectors: OrderedDict[Hashable,list] = OrderedDict()
+        # keys being embedded right now
+        self._in_flight: dict[Hashable,Future] = {}
+        self._lock = threading.Lock()
+
+    def get_or_embed(self,key:Hashable,embed:Callable[[],list]):
+        """Returns the vector cached under @key, or calls @embed and caches its result. @embed runs outside the lock.
+        Callers asking for a key another thread is embedding wait for its vector (or its exception) and count as hits."""
+        with self._lock:
+            if key in self._vectors:
+                self._vectors.move_to_end(key)
+                self.hits += 1
+                return self._vectors[key]
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self._in_flight[key] = future = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if in_flight is not None:
+            return in_flight.result()
+
+        try:
+            vector = embed()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if self.max_entries > 0:
+                self._vectors[key] = vector
+                self._vectors.move_to_end(key)
+                while len(self._vectors) > self.max_entries:
+                    self._vectors.popitem(last=False)
+        future.set_result(vector)
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._vectors.clear()
+
+    def __len__(self)->int:
+        return len(self._vectors)
+
+    def __repr__(self):
+        return f'QueryEmbeddingCache(entries={len(self)}/{self.max_entries}, hits={self.hits}, misses={self.misses})'
+
+query_embedding_cache = QueryEmbeddingCache()
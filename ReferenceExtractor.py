@@ -3,11 +3,25 @@ from utils import RefObj, Document
 
 SRC_DOC = "Current_Doc"
 
+# 3gpp docIDs are two digits, a dot and three digits (38.331), with a part number for specs split in parts (38.101-1).
+# A version may follow without a space, as in "38.300v17".
+DOCID_END = r"(?:(?=v[0-9])|\b)"
+# a docID with an optional TS/TR handle, e.g. the source "[4, TS 38.211]" of a reference
+DOCID_REGX = re.compile(r"\b(?:T[SR]\s*)?(?P<series>[0-9]{2})\.(?P<number>[0-9]{3})(?P<part>(?:-[0-9]+)?)" + DOCID_END,re.IGNORECASE)
+# a docID after its TS/TR/3GPP handle. The dot may be left out there ("3GPP 38331"), the number cannot be anything else.
+HANDLED_DOCID_REGX = re.compile(r"\b(?P<handle>(?:3GPP\s+)?(?:T[SR]|3GPP))\s*(?P<series>[0-9]{2})\.?(?P<number>[0-9]{3})(?P<part>(?:-[0-9]+)?)" + DOCID_END,re.IGNORECASE)
+# a docID without a handle. It must not be part of a longer dotted number, so clause 5.38.331 is not taken for 38.331
+BARE_DOCID_REGX = re.compile(r"(?<![\w.])(?P<series>[0-9]{2})\.(?P<number>[0-9]{3})(?P<part>(?:-[0-9]+)?)(?:(?=v[0-9]+\b)|(?![\w.]*[0-9]))",re.IGNORECASE)
+
+def docIDOfMatch(match:re.Match)->str:
+    """docID matched by one of the docID regexes above, e.g. 38.331 for "TS 38331" """
+    return f"{match.group('series')}.{match.group('number')}{match.group('part')}"
+
 class ReferenceExtractor:
     def __init__(self):
         self.regxs=[]
         self.extractSrcStringRegx = re.compile(r"\[\d+, [A-Za-z0-9_\. ]*\]",re.IGNORECASE)
-        self.extractDocIDRegx = re.compile(r"\b(?:TS\s*)?([0-9]{2}\.[0-9]{3})\b",re.IGNORECASE)
+        self.extractDocIDRegx = DOCID_REGX
         patterns = [r"(clause\s+(\d+(.\d+)*).?(of \[\d+, [A-Za-z0-9_\. ]*\])?)",r"(Table\s+(\d+([.\d+|\-\d])*).?)",r"(subclause\s+(\d+(.\d+)*))",r"(subclauses\s+(\d+(.\d+)*) and (\d+(.\d+)*))"]
         for pattern in patterns:
             #re.compile turns a string into a regex. 
@@ -43,7 +57,7 @@ class ReferenceExtractor:
                 src = SRC_DOC
             refWithoutSrc = matchedStr.replace(f" of {src}","")
             if src != SRC_DOC:
-                src = self.extractDocIDRegx.search(src).group(1)
+                src = docIDOfMatch(self.extractDocIDRegx.search(src))
             references.append(RefObj(reference=refWithoutSrc,src=src))
         return references
 
@@ -95,18 +109,11 @@ class ReferenceExtractor:
     def extractDocIdsFromStrList(self,str_list:list[str])->list[str]:
         """@str_list: list of strings which may or may not have docid references in them.
         Docid is of the form xy.pqr usually and identifies a specific document.
-        returns: list of extracted docids with the handle they are prefaced by"""
+        returns: list of extracted docids with the handle they are prefaced by, e.g. "TS 38.331" """
         results = set()
-        patterns = [r"(TS (\d+(.\d+)*))",r"(TR (\d+(.\d+)*))"]
-        extractRegxs = [ re.compile(pattern) for pattern in patterns]
-        
         for st in str_list:
-            for regx in extractRegxs:
-                temp = regx.findall(st)
-                if temp:
-                    for tup in temp:
-                        if len(tup)>0 and tup[-1] != ".":
-                            results.add(tup[0])
+            for match in HANDLED_DOCID_REGX.finditer(st):
+                results.add(f"{' '.join(match.group('handle').split())} {docIDOfMatch(match)}")
         return list(results)
 
 
@@ -0,0 +1,50 @@
+import time
+from collections.abc import Callable
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+
+# Dependency graph of the retrieval stages of one request. Every node runs on a shared thread pool as soon as the nodes it
+# depends on have finished, so independent stages (the HyDE LLM call, docID extraction from the question, the diff query, and later
+# the spec and reasoning branches) overlap instead of adding up. Scheduling happens on the calling thread, so pool threads
+# never block waiting on other nodes and a small pool cannot deadlock.
+
+class RetrievalGraph:
+    def __init__(self,executor:Executor):
+        self.executor = executor
+        self.nodes: dict[str,tuple[Callable,tuple[str,...]]] = {}
+        # node -> seconds it ran for, filled in by run
+        self.timings: dict[str,float] = {}
+
+    def add(self,name:str,func:Callable,deps:tuple[str,...]=()):
+        """@func: called with the results of @deps as keyword arguments named after them"""
+        for dep in deps:
+            if dep not in self.nodes:
+                raise ValueError(f"RetrievalGraph: {name} depends on {dep}, which has not been added")
+        self.nodes[name] = (func,tuple(deps))
+
+    def _timed(self,name:str,func:Callable,kwargs:dict):
+        start = time.perf_counter()
+        try:
+            return func(**kwargs)
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def run(self)->dict:
+        """Returns: result of every node. The first node to raise cancels the nodes not started yet and its exception is re-raised."""
+        results = {}
+        pending = dict(self.nodes)
+        running = {}
+        start = time.perf_counter()
+        try:
+            while pending or running:
+                for name,(func,deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        running[self.executor.submit(self._timed,name,func,{dep:results[dep] for dep in deps})] = name
+                        del pending[name]
+                done, _ = wait(running,return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        finally:
+            for future in running:
+                future.cancel()
+            self.timings["total"] = time.perf_counter() - start
+        return results
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+import argparse
+import threading
+from contextlib import closing
+from collections.abc import Mapping
+from settings import config
+
+# Persisted (docID, section) -> chunk ids index of a collection, kept in a sqlite file next to chroma.sqlite3.
+# Secondary retrieval resolves most references to an exact docID and clause, so instead of a filtered vector query over the whole
+# spec collection it looks the chunks up here, fetches them by id and ranks the few candidates against the query vector.
+# DBClient updates the index whenever it writes or deletes chunks. Only collections whose index is complete (created empty with it,
+# or backfilled with `python SectionIndex.py`) are looked up, others keep using the filtered vector query.
+
+SECTION_INDEX_FILENAME = "section_index.sqlite3"
+SECTION_INDEX_BACKFILL_BATCH_SIZE = 5000
+LOOKUP_BATCH_SIZE = 500
+
+class SectionIndex:
+    def __init__(self,db_dir_path:str,collection_name:str):
+        self.path = os.path.join(db_dir_path,SECTION_INDEX_FILENAME)
+        self.collection_name = collection_name
+        os.makedirs(db_dir_path,exist_ok=True)
+        self._conn = sqlite3.connect(self.path,check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS section_chunks (collection TEXT NOT NULL, docID TEXT NOT NULL, section TEXT NOT NULL, chunk_id TEXT NOT NULL, PRIMARY KEY (collection, chunk_id))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS section_chunks_by_section ON section_chunks (collection, docID, section)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS complete_collections (collection TEXT PRIMARY KEY)")
+
+    @staticmethod
+    def is_complete(db_dir_path:str,collection_name:str)->bool:
+        """Whether every chunk of the collection is in the index. Does not create the sqlite file."""
+        path = os.path.join(db_dir_path,SECTION_INDEX_FILENAME)
+        if not os.path.exists(path):
+            return False
+        with closing(sqlite3.connect(path)) as conn:
+            try:
+                row = conn.execute("SELECT 1 FROM complete_collections WHERE collection = ?",(collection_name,)).fetchone()
+            except sqlite3.OperationalError:
+                return False
+        return row is not None
+
+    def set_complete(self,complete:bool=True):
+        with self._lock, self._conn:
+            if complete:
+                self._conn.execute("INSERT OR IGNORE INTO complete_collections (collection) VALUES (?)",(self.collection_name,))
+            else:
+                self._conn.execute("DELETE FROM complete_collections WHERE collection = ?",(self.collection_name,))
+
+    def add(self,chunk_ids:list[str],metadatas:list[Mapping]):
+        """Indexes chunks by the docID and section of their (full, not normalized) metadata. Chunks without either are skipped."""
+        rows = [
+            (self.collection_name,metadata["docID"],metadata["section"],chunk_id)
+            for chunk_id,metadata in zip(chunk_ids,metadatas)
+            if metadata and isinstance(metadata.get("docID"),str) and isinstance(metadata.get("section"),str)
+        ]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO section_chunks (collection, docID, section, chunk_id) VALUES (?, ?, ?, ?)",rows)
+
+    def remove(self,chunk_ids:list[str]):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM section_chunks WHERE collection = ? AND chunk_id = ?",[(self.collection_name,chunk_id) for chunk_id in chunk_ids])
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM section_chunks WHERE collection = ?",(self.collection_name,))
+
+    def lookup(self,doc_sections:list[tuple[str,str]])->dict[tuple[str,str],list[str]]:
+        """Returns: chunk ids of each (docID, section) pair that has any"""
+        found: dict[tuple[str,str],list[str]] = {}
+        doc_sections = list(dict.fromkeys(doc_sections))
+        with self._lock:
+            for i in range(0,len(doc_sections),LOOKUP_BATCH_SIZE):
+                batch = doc_sections[i:i+LOOKUP_BATCH_SIZE]
+                conditions = " OR ".join(["(docID = ? AND section = ?)"] * len(batch))
+                params = [self.collection_name] + [value for pair in batch for value in pair]
+                for docID,section,chunk_id in self._conn.execute(f"SELECT docID, section, chunk_id FROM section_chunks WHERE collection = ? AND ({conditions})",params):
+                    found.setdefault((docID,section),[]).append(chunk_id)
+        return found
+
+    def doc_ids(self)->list[str]:
+        with self._lock:
+            return [docID for (docID,) in self._conn.execute("SELECT DISTINCT docID FROM section_chunks WHERE collection = ?",(self.collection_name,))]
+
+    def backfill(self,db_client)->int:
+        """Indexes every chunk already in the collection of @db_client and marks the index complete. Returns: number of chunks read"""
+        self.clear()
+        total = db_client.collection.count()
+        offset = 0
+        while offset < total:
+            db_resp = db_client.collection.get(include=["metadatas"],limit=SECTION_INDEX_BACKFILL_BATCH_SIZE,offset=offset)
+            if not db_resp['ids']:
+                break
+            offset += len(db_resp['ids'])
+            self.add(db_resp['ids'],[db_client._loaded_metadata(metadata) for metadata in db_resp['metadatas']])
+            print(f"{self.collection_name}: indexed {offset}/{total} chunks")
+        self.set_complete()
+        return offset
+
+    def __repr__(self):
+        return f'SectionIndex(collection={self.collection_name}, path={self.path})'
+
+if __name__ == "__main__":
+    from DBClient import DBClient
+    from CollectionNames import SPECS_AND_DISCUSSIONS as SPEC_COLL_NAME
+    argparser = argparse.ArgumentParser(description="Builds the (docID, section) index of an existing collection")
+    argparser.add_argument('--db-dir', type=str, default=config["CHROMA_DIR"])
+    argparser.add_argument('--collection', '-c', type=str, default=SPEC_COLL_NAME)
+    args = argparser.parse_args()
+
+    db_client = DBClient(collection_name=args.collection,db_dir_path=args.db_dir)
+    num_chunks = SectionIndex(args.db_dir,args.collection).backfill(db_client)
+    print(f"indexed the {num_chunks} chunks of {args.collection}")
@@ -23,7 +23,7 @@ class Chat3GPPRetriever:
         self.bm25Retriever = BM25Retriever()
         self.all_documents = None
         
-        self.dbclient = DBClient(embedding_model_name='text-embedding-3-large',collection_name=collection_name,db_dir_path=db_dir_path)
+        self.dbclient = DBClient(collection_name=collection_name,db_dir_path=db_dir_path)
 
         self.reranker_model = None
         self.tokenizer = None
@@ -54,13 +54,13 @@ class Chat3GPPRetriever:
         cos_lookup = {}
         
         for rank,doc in enumerate(bm25_results):
-            str_metadata = json.dumps(doc.metadata)
+            str_metadata = json.dumps(dict(doc.metadata),sort_keys=True)
             dict_key = (doc.page_content,str_metadata)
             all_docs[dict_key] = {"bm25_rank": rank+1, "vector_rank": None}
 
         # Process Dense ranks
         for rank, (doc, cosine_score) in enumerate(cos_results):
-            str_metadata = json.dumps(doc.metadata)
+            str_metadata = json.dumps(dict(doc.metadata),sort_keys=True)
             dict_key = (doc.page_content,str_metadata)
             if dict_key not in all_docs:
                 all_docs[dict_key] = {"bm25_rank":None, "vector_rank":rank+1}
@@ -73,8 +73,10 @@ class SimpleRAGController:
         Returns:
             Number of documents added
         """
-        # Load and chunk documents
-        convertAllDocToDocx(doc_dir_path)
+        # Convert any .doc files on a pool of LibreOffice workers, then load and chunk documents
+        failed = [result.src for result in convertAllDocToDocx(doc_dir_path) if result.status == "failed"]
+        if failed:
+            print(f"could not convert {len(failed)} .doc files, they are left out: {failed}")
         
         # Get all files matching extensions
         file_list = getAllFilesInDirMatchingFormat(doc_dir_path, file_extensions=[".docx"])
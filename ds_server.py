@@ -19,7 +19,7 @@ class ClauseHistoryRequest(BaseModel):
     clause_id: str
 
 def _serialize_document_list(docs:list[Document]) -> list[dict]:
-    return [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+    return [{"page_content": doc.page_content, "metadata": dict(doc.metadata)} for doc in docs]
 
 ################
 # Rate Limiter #
@@ -2,7 +2,8 @@ import sys
 sys.path.append("../")
 from ReferenceExtractor import ReferenceExtractor
 from utils import RefObj, Document
-from MetadataAwareChunker import getFullSectionChunks
+from MetadataAwareChunker import clean_file_name
+from ChunkCorpus import getFullSectionCorpus
 from AutoFetcher import AutoFetcher
 from utils import unzipFile,getAllFilesInDirMatchingFormat
 from typing import Tuple
@@ -72,8 +73,9 @@ if __name__ == "__main__":
     results = []
     file_list = getAllFilesInDirMatchingFormat(".")
     print(file_list)
+    corpus = getFullSectionCorpus(file_list)
     for file in file_list:
-        chunks_with_metadata = filter_chunks(getFullSectionChunks([file]))
+        chunks_with_metadata = filter_chunks(corpus.where(source=clean_file_name(file)))
         for chunk in chunks_with_metadata:
             print(chunk.metadata["section"])
         print(len(chunks_with_metadata))
@@ -5,7 +5,8 @@ from ReferenceExtractor import ReferenceExtractor
 from concurrent.futures import ThreadPoolExecutor, as_completed, ProcessPoolExecutor
 import json
 from tqdm import tqdm
-from MetadataAwareChunker import getSectionedChunks,getFullSectionChunks,clean_file_name
+from MetadataAwareChunker import getSectionedChunks,clean_file_name
+from ChunkCorpus import getFullSectionCorpus
 from settings import config
 from utils import RefObj, RetrieverResult
 from typing import Tuple
@@ -155,7 +156,7 @@ if __name__ == "__main__":
                  "../dataformicrobenchmark/38211-i70.docx","../dataformicrobenchmark/38212-i70.docx", "../dataformicrobenchmark/38213-i70.docx",\
                     "../dataformicrobenchmark/38214-i70.docx", "../dataformicrobenchmark/38215-i40.docx","../dataformicrobenchmark/38300-i70.docx",\
                     "../dataformicrobenchmark/38304-i40.docx"    ]
-    all_chunks = getFullSectionChunks(file_list)
+    all_chunks = getFullSectionCorpus(file_list)
 
     # group by file
     chunks_by_file = {}
@@ -1,7 +1,8 @@
 import sys
 sys.path.append("..")
 from ReferenceExtractor import ReferenceExtractor
-from MetadataAwareChunker import getFullSectionChunks,clean_file_name
+from MetadataAwareChunker import clean_file_name
+from ChunkCorpus import getFullSectionCorpus
 from get_misalignment_score import get_chunks_with_refs, get_refs_without_tables, process_document_into_dict
 import json 
 
@@ -12,7 +13,7 @@ if __name__ == "__main__":
                  "../dataformicrobenchmark/38211-i70.docx","../dataformicrobenchmark/38212-i70.docx", "../dataformicrobenchmark/38213-i70.docx",\
                     "../dataformicrobenchmark/38214-i70.docx", "../dataformicrobenchmark/38215-i40.docx","../dataformicrobenchmark/38300-i70.docx",\
                     "../dataformicrobenchmark/38304-i40.docx"    ]
-    all_chunks = getFullSectionChunks(file_list)
+    all_chunks = getFullSectionCorpus(file_list)
 
     id_section_to_chunk = {}
     for chunk in all_chunks:
@@ -12,7 +12,8 @@ from chromadb.config import Settings
 from chromadb.utils import embedding_functions
 
 from utils import getAllFilesInDirMatchingFormat
-from MetadataAwareChunker import getFullSectionChunks,addExtraDocumentWideMetadataForReason
+from MetadataAwareChunker import addExtraDocumentWideMetadataForReason
+from ChunkCorpus import getFullSectionCorpus
 from DBClient import DBClient
 from settings import config
 from ChangeTracker import ChangeTracker, get_empty_document
@@ -31,8 +32,9 @@ def get_diff_list():
     versionToSectionToChunk = {}
     versionToMetadata = {}
     file_list = getAllFilesInDirMatchingFormat(DIFF_DOC_DIR)
+    corpus = getFullSectionCorpus([os.path.join(DIFF_DOC_DIR,file) for file in file_list],addExtraDocumentWideMetadataForReason)
     for file in file_list:
-        chunks = getFullSectionChunks([os.path.join(DIFF_DOC_DIR,file)],addExtraDocumentWideMetadataForReason)
+        chunks = corpus.where(source=file)
         version = chunks[0].metadata["version"]
         versionToSectionToChunk[version] = {}
         versionToMetadata[version] = chunks[0].metadata
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules under test live at the repo root and import each other by bare name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
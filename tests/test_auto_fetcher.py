@@ -0,0 +1,148 @@
+import io
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# AutoFetcher needs requests and bs4 from requirements.txt
+pytest.importorskip("requests")
+pytest.importorskip("bs4")
+from AutoFetcher import AutoFetcher
+
+CONTENT = bytes(range(256)) * 64
+ETAG = '"v1"'
+
+def zip_of(names:list[str])->bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer,'w') as zf:
+        for name in names:
+            zf.writestr(name,b"contents of " + name.encode())
+    return buffer.getvalue()
+
+# path -> contents of the files the server has, besides the listing
+FILES = {
+    "/specs/38211-i60.zip":CONTENT,
+    "/specs/38212-i60.zip":CONTENT[::-1],
+    "/tdocs/R2-2400001.zip":zip_of(["R2-2400001.docx"]),
+    "/tdocs/R2-9900001.zip":zip_of(["R2-9900001.doc"]),
+}
+
+class SpecServer(BaseHTTPRequestHandler):
+    """Serves a directory listing with relative links and the FILES, honouring If-None-Match, Range and If-Range"""
+    requests_seen = []
+
+    def log_message(self,*args):
+        pass
+
+    def _send(self,status:int,body:bytes=b"",headers:dict|None=None):
+        self.send_response(status)
+        for name,value in (headers or {}).items():
+            self.send_header(name,value)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.requests_seen.append((self.path,dict(self.headers)))
+        if self.path == "/specs/":
+            self._send(200,b'<html><a href="38211-i60.zip">38211-i60.zip</a><a href="/specs/38212-i60.zip">38212</a></html>',{"Content-Type":"text/html"})
+        elif self.path in FILES:
+            content = FILES[self.path]
+            if self.headers.get("If-None-Match") == ETAG:
+                self._send(304)
+            elif self.headers.get("Range") and self.headers.get("If-Range") == ETAG:
+                start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+                self._send(206,content[start:],{"ETag":ETAG,"Content-Range":f"bytes {start}-{len(content)-1}/{len(content)}"})
+            else:
+                self._send(200,content,{"ETag":ETAG})
+        else:
+            self._send(404)
+
+@pytest.fixture
+def server():
+    SpecServer.requests_seen = []
+    httpd = ThreadingHTTPServer(("127.0.0.1",0),SpecServer)
+    thread = threading.Thread(target=httpd.serve_forever,daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def make_fetcher(tmp_path)->AutoFetcher:
+    return AutoFetcher([],post_processing_func=lambda filepath,doc_dir: None,doc_dir_path=str(tmp_path))
+
+def test_relative_links_are_resolved_against_the_page(server,tmp_path):
+    fetcher = make_fetcher(tmp_path)
+    fetcher.extractLinksFromEndpoint(f"{server}/specs/",params=None)
+    assert fetcher.links[f"{server}/specs/"] == [f"{server}/specs/38211-i60.zip",f"{server}/specs/38212-i60.zip"]
+
+def test_unchanged_file_is_not_downloaded_again(server,tmp_path):
+    fetcher = make_fetcher(tmp_path)
+    link = f"{server}/specs/38211-i60.zip"
+    assert fetcher.downloadFileFromLink(link) == "38211-i60.zip"
+    # a new fetcher reads the ETag back from the state file
+    assert make_fetcher(tmp_path).downloadFileFromLink(link) is None
+    assert SpecServer.requests_seen[-1][1].get("If-None-Match") == ETAG
+    with open(tmp_path / "38211-i60.zip",'rb') as f:
+        assert f.read() == CONTENT
+
+def test_partial_download_is_resumed_with_if_range(server,tmp_path):
+    link = f"{server}/specs/38211-i60.zip"
+    fetcher = make_fetcher(tmp_path)
+    with open(tmp_path / "38211-i60.zip.part",'wb') as f:
+        f.write(CONTENT[:1000])
+    fetcher.state.entries[link] = {"partial_validator":ETAG}
+    assert fetcher.downloadFileFromLink(link) == "38211-i60.zip"
+    headers = SpecServer.requests_seen[-1][1]
+    assert headers.get("Range") == "bytes=1000-"
+    assert headers.get("If-Range") == ETAG
+    with open(tmp_path / "38211-i60.zip",'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(tmp_path / "38211-i60.zip.part")
+
+def test_changed_file_replaces_the_partial_download(server,tmp_path):
+    link = f"{server}/specs/38211-i60.zip"
+    fetcher = make_fetcher(tmp_path)
+    with open(tmp_path / "38211-i60.zip.part",'wb') as f:
+        f.write(b"x" * 1000)
+    # the part file belongs to an older version of the file, so the server answers If-Range with the whole file
+    fetcher.state.entries[link] = {"partial_validator":'"v0"'}
+    assert fetcher.downloadFileFromLink(link) == "38211-i60.zip"
+    with open(tmp_path / "38211-i60.zip",'rb') as f:
+        assert f.read() == CONTENT
+
+def test_all_files_from_link_are_downloaded_once(server,tmp_path):
+    endpoint = f"{server}/specs/"
+    fetcher = AutoFetcher([endpoint],post_processing_func=lambda filepath,doc_dir: None,doc_dir_path=str(tmp_path))
+    assert fetcher.run(getAllFilesFromLink=True) == ["38211-i60.zip","38212-i60.zip"]
+    for path in ("/specs/38211-i60.zip","/specs/38212-i60.zip"):
+        with open(tmp_path / path.split("/")[-1],'rb') as f:
+            assert f.read() == FILES[path]
+    # every file is unchanged on the server, so a new fetcher downloads nothing
+    SpecServer.requests_seen = []
+    assert AutoFetcher([endpoint],post_processing_func=lambda filepath,doc_dir: None,doc_dir_path=str(tmp_path)).run(getAllFilesFromLink=True) == []
+    file_requests = [headers for path,headers in SpecServer.requests_seen if path in FILES]
+    assert len(file_requests) == 2
+    assert all(headers.get("If-None-Match") == ETAG for headers in file_requests)
+
+class IndexingDB:
+    """Stands in for the DBClient of runIntoDB: every streamed docx counts as stored"""
+    def __init__(self):
+        self.names = []
+
+    def updateDBFromDocxStream(self,named_contents,metadata_func=None,requested_chunking_type=None,on_file_done=None):
+        for name,_ in named_contents:
+            self.names.append(name)
+            on_file_done(name,[f"chunk of {name}"])
+
+def test_only_fully_indexed_archives_are_recorded(server,tmp_path):
+    docx_link, doc_link = f"{server}/tdocs/R2-2400001.zip", f"{server}/tdocs/R2-9900001.zip"
+    db = IndexingDB()
+    fetcher = AutoFetcher([docx_link,doc_link],post_processing_func=lambda filepath,doc_dir: None,doc_dir_path=str(tmp_path))
+    with pytest.warns(UserWarning,match="R2-9900001.doc"):
+        fetcher.runIntoDB(db,areEndpointsGettable=True)
+    assert db.names == [f"{docx_link}/R2-2400001.docx"]
+    assert set(fetcher.state.entries) == {docx_link}
+    # the .doc archive is fetched again, so `run` can still download it for conversion
+    assert AutoFetcher([doc_link],post_processing_func=lambda filepath,doc_dir: None,doc_dir_path=str(tmp_path)).run(areEndpointsGettable=True) == ["R2-9900001.zip"]
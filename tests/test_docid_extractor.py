@@ -0,0 +1,40 @@
+import pytest
+
+# DocIDExtractor imports the LLM fallback from utils, which needs openai and tiktoken from requirements.txt
+pytest.importorskip("openai")
+pytest.importorskip("tiktoken")
+from DocIDExtractor import DocIDExtractor
+from ReferenceExtractor import ReferenceExtractor
+
+KNOWN_DOCUMENTS = {
+    "38.331":"NR; Radio Resource Control (RRC); Protocol specification",
+    "38.300":"NR; NR and NG-RAN Overall description; Stage-2",
+    "38.101-1":"NR; User Equipment (UE) radio transmission and reception; Part 1",
+    "37.324":"NR; Service Data Adaptation Protocol (SDAP) specification",
+}
+
+@pytest.mark.parametrize("question,docIDs",[
+    ("What does TS 38.331 say about RRC reestablishment?",["38.331"]),
+    ("what changed in ts 38.300v17?",["38.300"]),
+    ("Is 38.300 V17 different from 3GPP 38331?",["38.331","38.300"]),
+    ("Which power class does TS 38.101-1 define?",["38.101-1"]),
+    ("How does the SDAP spec map QoS flows?",["37.324"]),
+    ("What triggers RRC reestablishment in clause 5.3.7?",[]),
+])
+def test_docids_are_found_without_the_llm(question,docIDs):
+    extractor = DocIDExtractor(KNOWN_DOCUMENTS,llm_fallback=False)
+    found, ambiguous = extractor.extract(question)
+    assert sorted(found) == sorted(docIDs)
+    assert not ambiguous
+
+def test_documents_ingested_later_are_picked_up():
+    known_documents = dict(KNOWN_DOCUMENTS)
+    extractor = DocIDExtractor(lambda: known_documents,llm_fallback=False,refresh_seconds=0)
+    assert extractor.extract("What is new in 38.214?") == ([],True)
+    known_documents["38.214"] = "NR; Physical layer procedures for data"
+    assert extractor.extract("What is new in 38.214?") == (["38.214"],False)
+
+def test_reference_sources_keep_their_docid():
+    refs = ReferenceExtractor().runREWithStrList(["as defined in clause 6.1.2.1.1 of [4, TS 38.211]"])
+    assert [ref.src for ref in refs] == ["38.211"]
+    assert sorted(ReferenceExtractor().extractDocIdsFromStrList(["see TS 38.300v17 and TR 38.912"])) == ["TR 38.912","TS 38.300"]
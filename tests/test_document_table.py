@@ -0,0 +1,39 @@
+import pytest
+
+# DocumentTable imports utils, which needs openai and tiktoken from requirements.txt
+pytest.importorskip("openai")
+pytest.importorskip("tiktoken")
+from DocumentTable import DocumentTable, DOC_KEY_FIELD, NO_DOCUMENT_KEY
+
+V1 = {"source":"38331-i60.docx","docID":"38.331","version":"18.6.0","section":"5.3"}
+V2 = {"source":"38331-i70.docx","docID":"38.331","version":"18.7.0","section":"5.3"}
+
+def test_normalized_metadata_expands_back(tmp_path):
+    table = DocumentTable(str(tmp_path),"specs")
+    stored = table.normalize(V1)
+    assert set(stored) == {DOC_KEY_FIELD,"section"}
+    assert table.expand(stored) == V1
+    assert table.normalize(dict(V1,section="6.1"))[DOC_KEY_FIELD] == stored[DOC_KEY_FIELD]
+    assert len(table) == 1
+
+def test_filters_on_document_fields_become_key_filters(tmp_path):
+    table = DocumentTable(str(tmp_path),"specs")
+    key1 = table.normalize(V1)[DOC_KEY_FIELD]
+    key2 = table.normalize(V2)[DOC_KEY_FIELD]
+    assert table.rewrite_filter({"version":"18.7.0"}) == {DOC_KEY_FIELD:{"$in":[key2]}}
+    assert table.rewrite_filter({"docID":{"$in":["38.331"]}}) == {DOC_KEY_FIELD:{"$in":sorted([key1,key2])}}
+    assert table.rewrite_filter({"$and":[{"version":"18.6.0"},{"section":"5.3"}]}) == {"$and":[{DOC_KEY_FIELD:{"$in":[key1]}},{"section":"5.3"}]}
+    assert table.rewrite_filter({"version":"17.0.0"}) == {DOC_KEY_FIELD:{"$in":[NO_DOCUMENT_KEY]}}
+
+def test_reingested_document_is_seen_by_another_process(tmp_path):
+    server = DocumentTable(str(tmp_path),"specs")
+    ingestion = DocumentTable(str(tmp_path),"specs")
+    key1 = ingestion.normalize(V1)[DOC_KEY_FIELD]
+    assert server.expand({DOC_KEY_FIELD:key1,"section":"5.3"}) == V1
+    # the file changed: its old document goes and the new one comes, the number of rows stays the same
+    ingestion.remove([key1])
+    key2 = ingestion.normalize(V2)[DOC_KEY_FIELD]
+    assert server.rewrite_filter({"version":"18.7.0"}) == {DOC_KEY_FIELD:{"$in":[key2]}}
+    assert server.rewrite_filter({"version":"18.6.0"}) == {DOC_KEY_FIELD:{"$in":[NO_DOCUMENT_KEY]}}
+    assert server.expand({DOC_KEY_FIELD:key2,"section":"5.3"}) == V2
+    assert len(server) == 1
@@ -0,0 +1,15 @@
+import pytest
+
+# the query path entrypoints need chromadb and openai from requirements.txt
+pytest.importorskip("chromadb")
+pytest.importorskip("openai")
+from CheckImportBudget import QUERY_PATH_MODULES, DEFAULT_BUDGET_SECONDS, check_module
+
+# entrypoint -> extra package from requirements.txt it needs
+EXTRA_REQUIREMENTS = {"frontend":"gradio"}
+
+@pytest.mark.parametrize("module",QUERY_PATH_MODULES)
+def test_query_path_imports_within_budget(module):
+    if module in EXTRA_REQUIREMENTS:
+        pytest.importorskip(EXTRA_REQUIREMENTS[module])
+    assert check_module(module,DEFAULT_BUDGET_SECONDS,top=10)
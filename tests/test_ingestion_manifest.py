@@ -0,0 +1,24 @@
+import json
+import IngestionManifest
+from IngestionManifest import IngestionManifest as Manifest, MANIFEST_FILENAME
+
+def test_recorded_files_are_saved_in_batches(tmp_path,monkeypatch):
+    monkeypatch.setattr(IngestionManifest,"MANIFEST_SAVE_EVERY_FILES",3)
+    monkeypatch.setattr(IngestionManifest,"MANIFEST_SAVE_EVERY_SECONDS",3600)
+    manifest = Manifest(str(tmp_path / "db"),"specs")
+    manifest.save()
+    def saved_paths():
+        with open(tmp_path / "db" / MANIFEST_FILENAME,encoding="utf-8") as f:
+            return set(json.load(f)["specs"])
+
+    paths = []
+    for i in range(7):
+        path = tmp_path / f"{i}.docx"
+        path.write_bytes(b"docx %d" % i)
+        paths.append(str(path))
+        manifest.record(str(path),"section",[f"chunk {i}"])
+        manifest.save_if_due()
+    # saved after the 3rd and 6th file only
+    assert saved_paths() == set(paths[:6])
+    manifest.save()
+    assert saved_paths() == set(paths)
@@ -0,0 +1,30 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from LLMCache import LLMCache
+
+class FakeSchema:
+    @staticmethod
+    def model_json_schema():
+        return {"type":"object"}
+
+def test_cache_hits_from_many_threads(tmp_path):
+    cache = LLMCache(path=str(tmp_path / "llm_cache.sqlite"),bypass=False)
+    llm_calls = []
+    lock = threading.Lock()
+
+    @cache.cached(schema=FakeSchema)
+    def extract(text_chunk:str):
+        with lock:
+            llm_calls.append(text_chunk)
+        return {"answer":text_chunk.upper()}
+
+    texts = [f"chunk {i}" for i in range(10)]
+    for text in texts:
+        extract(text)
+    assert len(llm_calls) == len(texts)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(extract,texts * 8))
+    assert results == [{"answer":text.upper()} for text in texts * 8]
+    # every call from the pool threads is answered from the cache
+    assert len(llm_calls) == len(texts)
@@ -0,0 +1,27 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from QueryEmbeddingCache import QueryEmbeddingCache
+
+def test_concurrent_lookups_share_one_embedding():
+    cache = QueryEmbeddingCache(max_entries=8)
+    calls = []
+    def embed():
+        calls.append(threading.get_ident())
+        time.sleep(0.2)
+        return [1.0,2.0]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        vectors = list(executor.map(lambda _: cache.get_or_embed(("model","question"),embed),range(4)))
+    assert vectors == [[1.0,2.0]] * 4
+    assert len(calls) == 1
+    assert (cache.hits,cache.misses) == (3,1)
+
+def test_failed_embedding_is_not_cached():
+    cache = QueryEmbeddingCache(max_entries=8)
+    def fail():
+        raise RuntimeError("embedding service down")
+    with pytest.raises(RuntimeError):
+        cache.get_or_embed("question",fail)
+    assert cache.get_or_embed("question",lambda: [1.0]) == [1.0]
@@ -1,17 +1,16 @@
 import enum
-from pydoc import text
 from zipfile import ZipFile
 import os
-import subprocess
 import json
-import pandas as pd
 import hashlib
+import functools
 import uuid
-from markitdown import MarkItDown
+from collections.abc import Mapping, MutableMapping
 from openai import OpenAI
 from pydantic import BaseModel, Field
 from typing import List
 from settings import config
+from LLMCache import llm_cache
 import tiktoken
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
@@ -31,16 +30,20 @@ def unzipFile(filepath,dest_dir):
 def format_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
 
-def convertAllDocToDocx(input_dir:str,output_dir:str=None):
+def convertAllDocToDocx(input_dir:str,output_dir:str=None,num_workers:int|None=None):
     """Converts all the .doc files in `input_dir` to .docx, and then removes the old docs.
-    the .docx files will be stored in `output_dir` which defaults to the same as `input_dir`"""
+    the .docx files will be stored in `output_dir` which defaults to the same as `input_dir`.
+    Conversions run on a DocConversionPool of `num_workers` LibreOffice instances (DOC_CONVERSION_WORKERS by default).
+    Files whose .docx is already newer are not converted again, and .doc files that fail to convert are kept.
+    Returns: the ConversionResult of every .doc file"""
+    from DocConverter import DocConversionPool, DOC_CONVERSION_WORKERS
     if not output_dir:
         output_dir = input_dir
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".doc"):
-            filepath = os.path.join(input_dir,filename)
-            subprocess.run(['soffice','--headless','--convert-to','docx','--outdir',output_dir,filepath])
-            os.remove(filepath)
+    paths = [os.path.join(input_dir,filename) for filename in os.listdir(input_dir) if filename.endswith(".doc")]
+    if not paths:
+        return []
+    with DocConversionPool(num_workers=num_workers or DOC_CONVERSION_WORKERS) as pool:
+        return pool.convert_files(paths,output_dir,remove_source=True)
 
 def getAllFilesInDirMatchingFormat(target_dir:str,accepted_extensions:list[str]=[".docx"])->list[str]:
     """Helper function to return the names of all the files in `@target_dir` that match any one of the `@accepted_extensions`"""
@@ -52,6 +55,7 @@ def getAllFilesInDirMatchingFormat(target_dir:str,accepted_extensions:list[str]=
     return list(file_list)
 
 def convertJsonToCsv(input_filename:str,output_filename:str):
+    import pandas as pd
     with open(input_filename, "r") as read_file:
         data = json.load(read_file)
     df = pd.DataFrame(data)
@@ -61,24 +65,37 @@ def convertJsonToCsv(input_filename:str,output_filename:str):
 ##############################
 ### Chunking Tools Section ###
 ##############################
+# The docx readers (DocxStreamParser/lxml, markitdown) are imported inside these functions
+# so the query path can import utils without pulling in any ingestion dependency.
 
-def getFirstPageOfDocxInMarkdown(filepath:str):
-    """filepath must be an absolute path"""
+FIRST_PAGE_NUM_CHARS = 500
+FIRST_TWO_PAGES_NUM_CHARS = 9000
+
+def getDocxHeaderInMarkdown(filepath:str,num_chars:int)->str:
+    """filepath must be an absolute path.
+    Returns the first @num_chars characters of the docx as markdown. Only the start of the document is read from the zip,
+    so this costs the same for a 5 page CR and a 500 page spec. Falls back to a full MarkItDown conversion if the streaming read fails."""
+    from DocxStreamParser import read_docx_header_markdown
+    try:
+        return read_docx_header_markdown(filepath,max_chars=num_chars)
+    except Exception as e:
+        print(f"issue in file {filepath} with header extraction ({e}), falling back to full md conversion")
+    from markitdown import MarkItDown
     md = MarkItDown(enable_plugins=False) # Set to True to enable plugins
     try:
         result = md.convert(filepath)
     except:
         print(f"issue in file {filepath} with md conversion")
-    return result.text_content[:500]
+        return ""
+    return result.text_content[:num_chars]
+
+def getFirstPageOfDocxInMarkdown(filepath:str):
+    """filepath must be an absolute path"""
+    return getDocxHeaderInMarkdown(filepath,FIRST_PAGE_NUM_CHARS)
 
 def getFirstTwoPagesOfDocxInMarkdown(filepath:str):
     """filepath must be an absolute path"""
-    md = MarkItDown(enable_plugins=False) # Set to True to enable plugins
-    try:
-        result = md.convert(filepath)
-    except:
-        print(f"issue in file {filepath} with md conversion")
-    return result.text_content[:9000]
+    return getDocxHeaderInMarkdown(filepath,FIRST_TWO_PAGES_NUM_CHARS)
 
 class ChangeChunk(BaseModel):
     summary: str = Field(..., description="Change summary (bullet or sentence)")
@@ -88,6 +105,13 @@ class ChangeChunk(BaseModel):
 class ChangeChunkList(BaseModel):
     changeChunks: List[ChangeChunk] = Field(..., description="List of change chunks extracted from the CR")
 
+class DocumentWideMetadata(BaseModel):
+    version:str
+    docID:str
+    timestamp:str
+    release:str
+
+@llm_cache.cached(schema=ChangeChunkList)
 def getCRContentFromLLM(text_chunk:str)->list[ChangeChunk] | list[dict]:
     """Extract change chunks from a CR markdown text.
 
@@ -118,6 +142,7 @@ def getCRContentFromLLM(text_chunk:str)->list[ChangeChunk] | list[dict]:
     return [dict(chunk) for chunk in response.output_parsed.changeChunks]
     
 
+@llm_cache.cached(schema=DocumentWideMetadata)
 def getMetadataFromLLM(text_chunk:str)->dict:
     """Passes text to the LLM which then parses it into metadata"""
     client = OpenAI(api_key=config["API_KEY"])
@@ -146,6 +171,7 @@ class DocIDFromText(BaseModel):
 class DocIDFromTextList(BaseModel):
     docIDs: List[DocIDFromText] = Field(..., description="List of extracted document identifiers")
 
+@llm_cache.cached(schema=DocIDFromTextList)
 def getDocIDFromText(text_chunk:str)->List[str]:
     """Extracts the docID from a given text chunk using the LLM."""
     client = OpenAI(api_key=config["API_KEY"])
@@ -167,7 +193,7 @@ def getDocIDFromText(text_chunk:str)->List[str]:
     return [docIDchunk.docID for docIDchunk in response.output_parsed.docIDs if docIDchunk.docID != ""]
 
 def deterministic_id(text: str, metadata: dict) -> str:
-    mjson = json.dumps(metadata, sort_keys=True, ensure_ascii=False)
+    mjson = json.dumps(dict(metadata), sort_keys=True, ensure_ascii=False)
     h = hashlib.sha256()
     h.update(text.encode("utf-8"))
     h.update(mjson.encode("utf-8"))
@@ -178,22 +204,26 @@ def deterministic_id(text: str, metadata: dict) -> str:
 ## Tokenizing Tools ##
 ######################
 
-def getTokenCount(text:str,model_name:str,supressWarning:bool=True):
-    """Use this to get a picture of how many tokens the @text contains."""
-    print(f"Getting token count for model {model_name}\n\n")
+TOKENIZER_THREADS = config.get("TOKENIZER_THREADS", 8)
+
+@functools.lru_cache(maxsize=None)
+def getEncoder(model_name:str)->tiktoken.Encoding:
+    """Returns the tiktoken encoding for @model_name. Looked up once per model and reused."""
     if "gpt" in model_name or model_name=="text-embedding-3-large":
         try:
-            encoding = tiktoken.encoding_for_model(model_name)
-            print(f'used models own ecoding {encoding}')
+            return tiktoken.encoding_for_model(model_name)
         except Exception as e:
-            if not supressWarning:
-                print(f"ran into exception {e} when tokenizing, defaulting to 4o mini's tokenizer")
-            encoding = tiktoken.encoding_for_model("gpt-4o-mini")
-        finally:
-            num_tokens = len(encoding.encode(text))
-    else:
-        raise Exception("Unsupported model type!")
-    return num_tokens
+            print(f"ran into exception {e} when tokenizing, defaulting to 4o mini's tokenizer")
+            return tiktoken.encoding_for_model("gpt-4o-mini")
+    raise Exception("Unsupported model type!")
+
+def getTokenCount(text:str,model_name:str,supressWarning:bool=True):
+    """Use this to get a picture of how many tokens the @text contains."""
+    return len(getEncoder(model_name).encode_ordinary(text))
+
+def getTokenCounts(texts:list[str],model_name:str,num_threads:int=TOKENIZER_THREADS)->list[int]:
+    """Token counts of all @texts, tokenized in one threaded encode_batch call."""
+    return [len(tokens) for tokens in getEncoder(model_name).encode_ordinary_batch(texts,num_threads=num_threads)]
 
 ####################
 ## Miscellaneous  ##
@@ -232,26 +262,124 @@ class RefObj:
     def __repr__(self):
         return f'Reference: {self.reference}, Source Document: {self.src}'
 
+# metadata fields that are the same for every chunk of a file. Chunks share one interned copy of these instead of each holding their own
+DOCUMENT_LEVEL_METADATA_KEYS = frozenset(['source','docID','version','release','timestamp','author','title','subject'])
+
+class _SharedMetadata(dict):
+    """Interned document level metadata. Never modified once interned, changes to a Document's copy re-intern it."""
+    __slots__ = ()
+
+# one entry per distinct document level metadata seen, i.e. roughly one per file version, so it is never pruned
+_shared_metadata_pool: dict[tuple,_SharedMetadata] = {}
+
+# the chunks of a file are built one after the other, so most lookups are for the copy interned last
+_last_interned: _SharedMetadata = _SharedMetadata()
+
+def _intern_metadata(fields:dict)->_SharedMetadata:
+    global _last_interned
+    last = _last_interned
+    if fields is last or fields == last:
+        # skips sorting and hashing the fields
+        return last
+    try:
+        key = tuple(sorted(fields.items()))
+        _last_interned = _shared_metadata_pool.setdefault(key,_SharedMetadata(fields))
+        return _last_interned
+    except TypeError:
+        # unhashable values cannot be interned, the document keeps a copy of its own
+        return _SharedMetadata(fields)
+
+class DocumentMetadata(MutableMapping):
+    """Metadata of a Document, split into the document level fields (interned, shared by every chunk of a file)
+    and the chunk level fields such as the section. Reads and writes like a dict; pass dict(metadata) to anything that
+    needs a real dict (chroma, json).
+    The chunk level fields are kept as a flat (key, value, key, value, ...) tuple, as there are usually only one or two."""
+    __slots__ = ("shared","own")
+
+    def __init__(self,metadata:Mapping|None=None):
+        shared, own = {}, ()
+        for key,value in (metadata or {}).items():
+            if key in DOCUMENT_LEVEL_METADATA_KEYS:
+                shared[key] = value
+            else:
+                own += (key,value)
+        self.shared = _intern_metadata(shared)
+        self.own = own
+
+    def _own_index(self,key)->int:
+        for i in range(0,len(self.own),2):
+            if self.own[i] == key:
+                return i
+        return -1
+
+    def __getitem__(self,key):
+        i = self._own_index(key)
+        if i >= 0:
+            return self.own[i+1]
+        return self.shared[key]
+
+    def __setitem__(self,key,value):
+        if key in DOCUMENT_LEVEL_METADATA_KEYS:
+            self.shared = _intern_metadata({**self.shared,key:value})
+            return
+        i = self._own_index(key)
+        if i >= 0:
+            self.own = self.own[:i+1] + (value,) + self.own[i+2:]
+        else:
+            self.own += (key,value)
+
+    def __delitem__(self,key):
+        i = self._own_index(key)
+        if i >= 0:
+            self.own = self.own[:i] + self.own[i+2:]
+        elif key in self.shared:
+            self.shared = _intern_metadata({k: v for k,v in self.shared.items() if k != key})
+        else:
+            raise KeyError(key)
+
+    def __contains__(self,key):
+        return key in self.shared or self._own_index(key) >= 0
+
+    def __iter__(self):
+        yield from self.shared
+        yield from self.own[::2]
+
+    def __len__(self):
+        return len(self.shared) + len(self.own) // 2
+
+    def __reduce__(self):
+        # interned again on load
+        return (DocumentMetadata,(dict(self),))
+
+    def __repr__(self):
+        return repr(dict(self))
+
 class Document:
-    def __init__(self, page_content:str, metadata:dict):
+    __slots__ = ("page_content","_metadata")
+
+    def __init__(self, page_content:str, metadata:Mapping):
         self.page_content = page_content
         self.metadata = metadata
-    
+
+    @property
+    def metadata(self)->DocumentMetadata:
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self,metadata:Mapping):
+        self._metadata = metadata if type(metadata) is DocumentMetadata else DocumentMetadata(metadata)
+
     def __repr__(self):
         return f'metadata={self.metadata}, page_content="{self.page_content}"'
     
 
-class DocumentWideMetadata(BaseModel):
-    version:str
-    docID:str
-    timestamp:str
-    release:str
-
 class RetrieverResult:
-    def __init__(self,firstOrderSpecDocs,secondOrderSpecDocs,retrievedDiscussionDocs):
+    def __init__(self,firstOrderSpecDocs,secondOrderSpecDocs,retrievedDiscussionDocs,timings:dict[str,float]|None=None):
+        """@timings: seconds taken by each retrieval stage, and by all of them together under 'total'"""
         self.firstOrderSpecDocs = firstOrderSpecDocs
         self.secondOrderSpecDocs = secondOrderSpecDocs
         self.retrievedDiscussionDocs = retrievedDiscussionDocs
+        self.timings = timings or {}
 
 if __name__ == "__main__":
     #print(getFirstPageOfDocxInMarkdown("./data/R299-041.docx"))